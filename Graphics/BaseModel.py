@@ -1,3 +1,5 @@
+import ctypes
+
 # imports all openGL functions
 from OpenGL.GL import *
 
@@ -5,6 +7,7 @@ from OpenGL.GL import *
 from matutils import *
 
 from material import Material
+from vertexformat import pack_vertices, constant_color, STRIDE, POSITION_OFFSET, NORMAL_OFFSET
 
 class BaseModel:
     '''
@@ -49,27 +52,35 @@ class BaseModel:
         # store the position of the model in the scene, ...
         self.M = M
 
-    def initialise_vbo(self, name, data):
+        # number of indices (or vertices) drawn, all of them if None
+        self.draw_count = None
+
+        # (firsts, counts) arrays of the index ranges drawn with a single multi-draw call, instead of draw_count
+        self.draw_ranges = None
+
+        # if this flag is set, positions and normals are interleaved in one compact buffer (see vertexformat.py),
+        # and a colour shared by all vertices is set when drawing instead of being stored per vertex
+        self.packed = False
+        self.packed_vertices = None
+        self.color = None
+
+    def initialise_vbo(self, name, data, location=None):
 
         # bind the GLSL program to find the attribute locations
         #glUseProgram(self.scene.shaders.program)
 
-        # bind the location of the attribute in the GLSL program to the next index
+        # bind the location of the attribute in the GLSL program to the next index, unless given
         # the name of the location must correspond to a 'in' variable in the GLSL vertex shader code
-        self.attributes[name] = len(self.vbos)
+        self.attributes[name] = len(self.vbos) if location is None else location
 
         if data is None:
             print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
                 self.__class__.__name__, name))
             return
 
-        # create a buffer object...
-        self.vbos[name] = glGenBuffers(1)
-        # and bind it
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
-
-        # ... and we set the data in the buffer as the vertex array
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+        # create a buffer object owned by the scene buffer manager, bind it and set the data in the buffer
+        # as the vertex array
+        self.vbos[name] = self.scene.buffers.create_buffer(self, data, GL_ARRAY_BUFFER)
 
         # enable the attribute
         glEnableVertexAttribArray(self.attributes[name])
@@ -94,6 +105,31 @@ class BaseModel:
             glEnableVertexAttribArray(self.attributes[attribute])
 
 
+    def initialise_packed_vbo(self):
+        '''
+        Store the positions and normals in a single interleaved buffer, in the same attribute locations as
+        the separate buffers.
+        '''
+        self.attributes['position'] = 0
+        self.attributes['normal'] = 1
+        self.attributes['color'] = 2
+
+        self.packed_vertices = pack_vertices(self.vertices, self.normals)
+        self.vbos['vertex'] = self.scene.buffers.create_buffer(self, self.packed_vertices, GL_ARRAY_BUFFER)
+
+        # each vertex holds 3 floats for the position, then the normal in one word unpacked to a vec3
+        glEnableVertexAttribArray(self.attributes['position'])
+        glVertexAttribPointer(index=self.attributes['position'], size=3, type=GL_FLOAT, normalized=False,
+                              stride=STRIDE, pointer=ctypes.c_void_p(POSITION_OFFSET))
+        glEnableVertexAttribArray(self.attributes['normal'])
+        glVertexAttribPointer(index=self.attributes['normal'], size=4, type=GL_INT_2_10_10_10_REV, normalized=True,
+                              stride=STRIDE, pointer=ctypes.c_void_p(NORMAL_OFFSET))
+
+        # the colour attribute is left disabled when constant, its value being set when drawing
+        self.color = constant_color(self.vertex_colors)
+        if self.color is None:
+            self.initialise_vbo('color', self.vertex_colors, location=self.attributes['color'])
+
     def bind(self):
         '''
         This method stores the vertex data in a Vertex Buffer Object (VBO) that can be uploaded
@@ -101,24 +137,23 @@ class BaseModel:
         '''
 
         # We use a Vertex Array Object to pack all buffers for rendering in the GPU (see lecture on OpenGL)
-        self.vao = glGenVertexArrays(1)
-
-        # bind the VAO to retrieve all buffers and rendering context
-        glBindVertexArray(self.vao)
+        # the scene buffer manager creates it and binds it to retrieve all buffers and rendering context
+        self.vao = self.scene.buffers.create_vertex_array(self)
 
         if self.vertices is None:
             print('(W) Warning in {}.bind(): No vertex array!'.format(self.__class__.__name__))
 
-        # initialise vertex position VBO and link to shader program attribute
-        self.initialise_vbo('position', self.vertices)
-        self.initialise_vbo('normal', self.normals)
-        self.initialise_vbo('color', self.vertex_colors)
+        if self.packed:
+            self.initialise_packed_vbo()
+        else:
+            # initialise vertex position VBO and link to shader program attribute
+            self.initialise_vbo('position', self.vertices)
+            self.initialise_vbo('normal', self.normals)
+            self.initialise_vbo('color', self.vertex_colors)
 
         # if indices are provided, put them in a buffer too
         if self.indices is not None:
-            self.index_buffer = glGenBuffers(1)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.indices, GL_STATIC_DRAW)
+            self.index_buffer = self.scene.buffers.create_buffer(self, self.indices, GL_ELEMENT_ARRAY_BUFFER)
 
         # bind all attributes to the correct locations in the VAO
         for name in self.attributes:
@@ -156,20 +191,34 @@ class BaseModel:
             # bind the Vertex Array Object so that all buffers are bound correctly and the following operations affect them
             glBindVertexArray(self.vao)
 
+            # the value of a disabled attribute is not stored in the VAO, so the constant colour is set for each draw
+            if self.color is not None:
+                glVertexAttrib3f(self.attributes['color'], *self.color)
+
             # check whether the data is stored as vertex array or index array
-            if self.indices is not None:
+            if self.indices is not None and self.draw_ranges is not None:
+                # draw only some ranges of the index array, the offsets being in bytes
+                firsts, counts = self.draw_ranges
+                if counts.shape[0] > 0:
+                    offsets = (ctypes.c_void_p * counts.shape[0])(*(4 * np.asarray(firsts, dtype=np.int64)).tolist())
+                    glMultiDrawElements(self.primitive, np.ascontiguousarray(counts, dtype=np.int32), GL_UNSIGNED_INT,
+                                        offsets, counts.shape[0])
+            elif self.indices is not None:
                 # draw the data in the buffer using the index array
-                glDrawElements(self.primitive, self.indices.flatten().shape[0], GL_UNSIGNED_INT, None )
+                count = self.indices.size if self.draw_count is None else self.draw_count
+                glDrawElements(self.primitive, count, GL_UNSIGNED_INT, None )
             else:
                 # draw the data in the buffer using the vertex array ordering only.
-                glDrawArrays(self.primitive, 0, self.vertices.shape[0])
+                count = self.vertices.shape[0] if self.draw_count is None else self.draw_count
+                glDrawArrays(self.primitive, 0, count)
             # unbind the shader to avoid side effects
             glBindVertexArray(0)
 
-def __del__(self):
-    '''
-    Release all VBO objects when finished.
-    '''
-    for vbo in self.vbos.items():
-        glDeleteBuffers(1,vbo)
+    def release(self):
+        '''
+        Release the VAO and all VBO objects when the model is removed from the scene.
+        '''
+        self.scene.buffers.release(self)
+        self.vbos = {}
+        self.vao = None
 
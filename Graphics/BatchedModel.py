@@ -0,0 +1,98 @@
+import ctypes
+
+from OpenGL.GL import *
+from matutils import *
+from BaseModel import BaseModel
+
+
+def batch_meshes(meshes):
+    '''
+    Merge meshes into single vertex and index arrays, the faces being grouped by material so that each material
+    is one contiguous range of the index array.
+    :param meshes: list of meshes, several of them may share a material
+    :return: (V, 3) vertices, (V, 3) normals, (T, 3) uint32 indices, and the list of (material, first index, number
+    of indices) of each material, in the order of their first mesh
+    '''
+    # vertex offset of each mesh in the merged vertex array
+    sizes = [mesh.vertices.shape[0] for mesh in meshes]
+    offsets = np.cumsum([0] + sizes[:-1])
+
+    # meshes of each material, the materials of the loaders being shared objects
+    groups = {}
+    for m, mesh in enumerate(meshes):
+        groups.setdefault(id(mesh.material), []).append(m)
+
+    indices = []
+    batches = []
+    first = 0
+    for group in groups.values():
+        faces = [meshes[m].faces.astype(np.uint32) + np.uint32(offsets[m]) for m in group]
+        count = sum(f.size for f in faces)
+        indices.extend(faces)
+        batches.append((meshes[group[0]].material, first, count))
+        first += count
+
+    vertices = np.concatenate([mesh.vertices for mesh in meshes]).astype('f')
+    normals = np.concatenate([mesh.normals for mesh in meshes]).astype('f')
+    return vertices, normals, np.concatenate(indices), batches
+
+
+class BatchedModel(BaseModel):
+    '''
+    Draws all the meshes of an object file from shared vertex and index buffers in a single Vertex Array Object.
+    The faces are sorted by material, so the model is drawn with one call per material, binding the program and
+    the matrices once and only changing the material uniforms between calls.
+    '''
+
+    def __init__(self, scene, meshes, M=poseMatrix(), packed=False):
+        '''
+        :param scene: reference to the scene the model is instantiated in
+        :param meshes: list of meshes from the object file loaders
+        :param M: position matrix
+        :param packed: whether to store the vertices in the compact interleaved format (see vertexformat.py)
+        '''
+        BaseModel.__init__(self, scene=scene, M=M, primitive=GL_TRIANGLES, visible=True)
+        self.packed = packed
+
+        self.vertices, self.normals, self.indices, self.batches = batch_meshes(meshes)
+
+        # default vertex colors to one (white)
+        self.vertex_colors = np.ones((self.vertices.shape[0], 3), dtype='f')
+
+    def draw_calls(self):
+        '''
+        :return: the number of draw calls of each frame, one per material
+        '''
+        return len(self.batches)
+
+    def draw(self, Mp, shaders):
+        '''
+        Draw the range of each material, the uniforms which do not depend on the material being sent once
+        '''
+        if self.visible:
+            glUseProgram(shaders.program)
+
+            # bind the matrices, mode and light with the first material
+            shaders.bind(
+                P=self.scene.P,
+                V=self.scene.camera.V,
+                M=np.matmul(Mp, self.M),
+                mode=self.scene.mode,
+                material=self.batches[0][0],
+                light=self.scene.light
+            )
+
+            glBindVertexArray(self.vao)
+
+            # the value of a disabled attribute is not stored in the VAO, so the constant colour is set for each draw
+            if self.color is not None:
+                glVertexAttrib3f(self.attributes['color'], *self.color)
+
+            for b, (material, first, count) in enumerate(self.batches):
+                if b > 0:
+                    shaders.bind_material(material)
+
+                # the offset of the range is in bytes
+                glDrawElements(self.primitive, count, GL_UNSIGNED_INT, ctypes.c_void_p(4 * first))
+
+            glBindVertexArray(0)
@@ -0,0 +1,170 @@
+import numpy as np
+
+# time step of one simulation step, one step being taken per frame
+TIME_STEP = 1 / 60
+
+# acceleration of the hairs, in world coordinates and units per second squared
+GRAVITY = (0, -2, 0)
+
+
+def rest_strands(roots, tips, segments):
+    '''
+    Straight hairs from their roots to their tips, each one split into segments of equal length.
+    :param roots: (N, 3) array of hair roots
+    :param tips: (N, 3) array of hair tips
+    :param segments: number of segments of each hair
+    :return: (segments + 1, N, 3) float32 array of the points of the hairs, from the roots to the tips
+    '''
+    steps = np.linspace(0, 1, segments + 1, dtype='f')[:, np.newaxis, np.newaxis]
+    return (roots + steps * (tips - roots)).astype('f')
+
+
+class StrandPhysics:
+    '''
+    Simulation of multi-segment hairs, all of them at once, with Verlet integration. Each step applies gravity,
+    pulls each segment back towards its rest direction from the point before it (stiffness), keeps the length of
+    the segments, and keeps the hairs out of the body of the model. As the stiffness only keeps the shape of each
+    segment relative to the previous one, the bending of the segments adds up from the root to the tip and the
+    hairs sag under gravity.
+
+    The points are stored as a (segments + 1, N, 3) array, the n-th point of every hair being contiguous, so that
+    each constraint is applied to all hairs with one vectorized operation per segment. Flattened, the array is the
+    position buffer of the hair model: the roots, which never move, first, then the following points of all hairs.
+    '''
+
+    def __init__(self, rest, center, gravity=GRAVITY, stiffness=0.1, damping=0.95, rest_motion=1e-6):
+        '''
+        :param rest: (segments + 1, N, 3) array of the points of the hairs at rest, see rest_strands()
+        :param center: centre of the bounding sphere of the model, the hairs colliding with the sphere centred there
+        and going through their root
+        :param gravity: acceleration applied to the hairs, in model coordinates and units per second squared
+        :param stiffness: fraction of the distance to the rest direction of each segment recovered at each step, 0
+        for hairs hanging freely
+        :param damping: fraction of the velocity kept at each step
+        :param rest_motion: distance under which the hairs are considered at rest when no point moved further in
+        a step
+        '''
+        self.center = np.asarray(center, dtype='f')
+        self.gravity = np.asarray(gravity, dtype='f')
+        self.stiffness = stiffness
+        self.damping = damping
+        self.rest_motion = rest_motion
+        self.set_rest(rest)
+
+    def set_rest(self, rest):
+        '''
+        Change the rest shape of the hairs, eg for a new fur length or direction, the hairs restarting from it
+        :param rest: (segments + 1, N, 3) array of the points of the hairs at rest
+        '''
+        self.rest = np.ascontiguousarray(rest, dtype='f')
+        self.positions = self.rest.copy()
+        self.previous = self.rest.copy()
+
+        # the first segment of the rest shape, which the stiffness pulls the first segments towards, and the change
+        # of each following segment from the segment before it, which the stiffness keeps
+        self.rest_segments = self.rest[1:] - self.rest[:-1]
+        self.rest_segments[1:] -= self.rest[1:-1] - self.rest[:-2]
+
+        # length of the segments of each hair
+        self.segment_lengths = np.linalg.norm(self.rest[1] - self.rest[0], axis=1).astype('f')
+
+        # a sphere containing the whole model would hold every hair, so each hair collides with the sphere through
+        # its root instead, or through the closest point of its rest shape for hairs growing inwards
+        self.radii = np.linalg.norm(self.rest - self.center, axis=2).min(axis=0).astype('f')
+
+        # whether no point moved by more than rest_motion in the last step
+        self.at_rest = False
+
+    def step(self, dt=TIME_STEP, hairs=None):
+        '''
+        Advance the simulation of some hairs by one time step, the roots staying in place
+        :param dt: time step in seconds
+        :param hairs: [optional] the hairs to simulate, as the number of the first hairs or as an array of hair
+        indices, all hairs by default. The other hairs keep their positions and velocity until simulated again.
+        :return: the largest distance a tip moved, the tips moving the most
+        '''
+        if hairs is None or np.isscalar(hairs) and hairs >= self.positions.shape[1]:
+            # the new positions are calculated in place of the previous ones before swapping both arrays
+            self.integrate(dt, self.positions, self.previous)
+            self.positions, self.previous = self.previous, self.positions
+            positions, previous = self.positions, self.previous
+            self.satisfy_constraints(positions, self.rest_segments, self.segment_lengths, self.radii)
+
+        elif np.isscalar(hairs):
+            # the first hairs are simulated in place, the previous and new positions being swapped by copy
+            positions, previous = self.positions[:, :hairs], self.previous[:, :hairs]
+            self.integrate(dt, positions, previous)
+            current = positions[1:].copy()
+            positions[1:] = previous[1:]
+            previous[1:] = current
+            self.satisfy_constraints(positions, self.rest_segments[:, :hairs], self.segment_lengths[:hairs],
+                                     self.radii[:hairs])
+
+        else:
+            # copies of the hairs, the new positions being calculated in place of the previous ones
+            positions, previous = self.previous[:, hairs], self.positions[:, hairs]
+            self.integrate(dt, previous, positions)
+            self.satisfy_constraints(positions, self.rest_segments[:, hairs], self.segment_lengths[hairs],
+                                     self.radii[hairs])
+            self.positions[:, hairs] = positions
+            self.previous[:, hairs] = previous
+
+        motion = float(np.abs(positions[-1] - previous[-1]).max()) if positions.shape[1] > 0 else 0.0
+        self.at_rest = motion < self.rest_motion
+        return motion
+
+    def integrate(self, dt, positions, previous):
+        '''
+        Verlet integration of the points following the roots, the velocity being the difference with the previous
+        positions
+        :param dt: time step in seconds
+        :param positions: (segments + 1, K, 3) array of the current points of the hairs
+        :param previous: (segments + 1, K, 3) array of their points at the previous step, replaced by the new ones
+        '''
+        points = positions[1:]
+        new_points = previous[1:]
+        new_points -= points
+        new_points *= -np.float32(self.damping)
+        new_points += points
+        new_points += self.gravity * np.float32(dt * dt)
+
+    def satisfy_constraints(self, positions, rest_segments, segment_lengths, radii):
+        '''
+        Pull the segments towards their rest direction, keep the hairs out of their collision sphere and keep the
+        length of their segments, from the roots to the tips so that a single pass is enough, each point following
+        the point before it once that one is in place
+        '''
+        squared_radii = radii ** 2
+
+        for s in range(1, positions.shape[0]):
+            # stiffness, as a pull of every point towards the continuation of the segment before it, bent as at
+            # rest, the first segment being pulled towards its rest direction from the root
+            if self.stiffness > 0:
+                target = positions[s - 1] + rest_segments[s - 1]
+                if s > 1:
+                    target += positions[s - 1]
+                    target -= positions[s - 2]
+                target -= positions[s]
+                target *= np.float32(self.stiffness)
+                positions[s] += target
+
+            # push the points inside the collision sphere of their hair out to its surface
+            offsets = positions[s] - self.center
+            squared_distances = np.einsum('ij,ij->i', offsets, offsets)
+            inside = np.flatnonzero(squared_distances < squared_radii)
+            if inside.shape[0] > 0:
+                scales = radii[inside] / np.sqrt(np.maximum(squared_distances[inside], 1e-18))
+                positions[s, inside] = self.center + offsets[inside] * scales[:, np.newaxis]
+
+            # then put the points back at the length of their segment from the previous points, in place
+            points = positions[s]
+            points -= positions[s - 1]
+            distances = np.sqrt(np.einsum('ij,ij->i', points, points))
+            points *= (segment_lengths / np.maximum(distances, 1e-9))[:, np.newaxis]
+            points += positions[s - 1]
+
+    def tips(self):
+        '''
+        :return: (N, 3) array of the current hair tips
+        '''
+        return self.positions[-1]
@@ -1,9 +1,329 @@
 from material import Material
 from OpenGL.GL import *
-from HairModel import HairModel
+from HairModel import HairModel, InstancedHairModel
+from mesh import Mesh, triangulate_faces, triangle_areas, normalize
+from lod import FurLOD, bounding_sphere
+from culling import StrandClusters
+from FurPhysics import StrandPhysics, rest_strands, GRAVITY
+import strandfile
 from material import Material
 import numpy as np
-import random
+import collections
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# corners joined with the face origin to build the sub-triangles of each subdivision level
+TRIANGLE_SPLIT = np.array([[0, 1], [0, 2], [1, 2]])
+QUAD_SPLIT = np.array([[0, 1], [1, 2], [2, 3], [3, 0]])
+
+# step of the low discrepancy sequence ordering the root pool
+GOLDEN_RATIO_CONJUGATE = (np.sqrt(5) - 1) / 2
+
+# the buffers of a pool of hairs hold this many times the hairs of the pool, so that increasing the density appends
+# the new hairs to the buffers, which only need to be allocated again once full
+POOL_GROWTH = 2
+
+# keys of the random streams drawn from the seed of a fur, so that each one only depends on the seed and the hairs
+LENGTH_STREAM = 1
+DIRECTION_STREAM = 2
+TEXTURE_STREAM = 3
+
+
+def golden_ratio_order(count):
+    """
+    :param count: number of items
+    :return: (count,) permutation of the items, each one placed at the position of its rank in the golden ratio
+    sequence, so that any prefix of the permuted items is spread evenly over the original order
+    """
+    return np.argsort(np.argsort((np.arange(count) * GOLDEN_RATIO_CONJUGATE) % 1.0, kind='stable'), kind='stable')
+
+
+def subdivide_faces(vertex_faces, normal_faces, density, interleave=False):
+    """
+    Simulate splitting of all faces at once to generate new coordinates. Each level of density adds the
+    origin of every face, then splits each face into small triangles made of two corners and that origin
+    (3 for triangles, 4 for quads), which are split again at the next level.
+    :param vertex_faces: (F, 3 or 4, 3) array of face vertices
+    :param normal_faces: (F, 3 or 4, 3) array of face normals
+    :param density: desired density
+    :param interleave: whether to order the origins of each level along the golden ratio sequence rather than
+    face by face, so that the first origins of a level cover the whole model (see golden_ratio_order)
+    :return: (N, 3) arrays of new vertices and normals, ordered level by level
+    """
+    # count the levels the same way the per-face recursion did, so fractional densities behave as before
+    levels = 0
+    while density > 0:
+        levels += 1
+        density -= 1
+
+    vert_origins = []
+    norm_origins = []
+    for level in range(levels):
+        # Find strand origins of every face
+        vert_origin = vertex_faces.sum(axis=1) / vertex_faces.shape[1]
+        norm_origin = normal_faces.sum(axis=1) / normal_faces.shape[1]
+        order = golden_ratio_order(vert_origin.shape[0]) if interleave else slice(None)
+        vert_origins.append(vert_origin[order])
+        norm_origins.append(norm_origin[order])
+
+        # Density not yet reached: create the small triangles for the next level
+        if level + 1 < levels:
+            split = TRIANGLE_SPLIT if vertex_faces.shape[1] == 3 else QUAD_SPLIT
+            vertex_faces = split_faces(vertex_faces, vert_origin, split)
+            normal_faces = split_faces(normal_faces, norm_origin, split)
+
+    if len(vert_origins) == 0:
+        return np.zeros((0, 3), 'f'), np.zeros((0, 3), 'f')
+
+    return np.concatenate(vert_origins), np.concatenate(norm_origins)
+
+
+def split_faces(faces, origins, split):
+    """
+    Build the sub-triangles of each face from pairs of its corners and its origin
+    :param faces: (F, K, 3) array of face corners
+    :param origins: (F, 3) array of face origins
+    :param split: (C, 2) array of corner pairs
+    :return: (F * C, 3, 3) array of triangles
+    """
+    first = faces[:, split[:, 0]]
+    second = faces[:, split[:, 1]]
+    origin = np.broadcast_to(origins[:, np.newaxis, :], first.shape)
+    return np.stack((first, second, origin), axis=2).reshape(-1, 3, 3)
+
+
+def strand_count(vertex_count, faces, density):
+    """
+    Count the strands the line fur has for a density, without generating them: the vertices, plus the origin of
+    every face at each level of subdivision, each level splitting the faces into 3 (triangles) or 4 (quads), the
+    faces being triangles after the first level.
+    :param vertex_count: number of vertices of the mesh
+    :param faces: (F, 3 or 4) array of vertex indices
+    :param density: fur density
+    :return: the number of strands
+    """
+    count = vertex_count
+    faces_at_level = faces.shape[0]
+    corners = faces.shape[1]
+    while density > 0:
+        count += faces_at_level
+        # each face is split into one triangle per corner, so quads only give 4 faces at the first level
+        faces_at_level *= corners
+        corners = 3
+        density -= 1
+    return count
+
+
+def strand_budget(vertex_count, faces, density):
+    """
+    Continuous version of strand_count: the number of strands grows linearly between two integer densities,
+    which give the same number of strands as the subdivision
+    :param vertex_count: number of vertices of the mesh
+    :param faces: (F, 3 or 4) array of vertex indices
+    :param density: fur density
+    :return: the number of strands
+    """
+    count = vertex_count
+    faces_at_level = faces.shape[0]
+    corners = faces.shape[1]
+    while density > 0:
+        count += faces_at_level * min(density, 1)
+        faces_at_level *= corners
+        corners = 3
+        density -= 1
+    return int(round(count))
+
+
+def sample_roots(vertices, normals, faces, count=None, per_area=None, seed=None, areas=None, interleave=False):
+    """
+    Sample hair roots over the surface of a mesh, the number of roots on each triangle being proportional to its
+    area whatever the tessellation. The sampling is stratified: the roots split the cumulative area of the
+    triangles into equal strata and one root is drawn at random within each, so that no region is left bare or
+    crowded by chance. The normal of each root is interpolated from the triangle vertices.
+    :param vertices: (V, 3) array of vertices
+    :param normals: (V, 3) array of vertex normals
+    :param faces: (F, 3 or 4) array of vertex indices, quads are split in two triangles
+    :param count: number of roots
+    :param per_area: number of roots per unit area, used instead of count
+    :param seed: [optional] seed of the random generator, the same seed gives the same roots
+    :param areas: [optional] (F,) array of the area of each face (see Mesh.face_areas), only used for triangles, the
+    triangles of other polygons being measured again
+    :param interleave: whether to visit the strata along the golden ratio sequence rather than in order, so that the
+    first roots cover the whole surface (see golden_ratio_order)
+    :return: (N, 3) arrays of roots and normals
+    """
+    triangles = triangulate_faces(faces)
+    if areas is None or faces.shape[1] > 3:
+        areas = triangle_areas(vertices[triangles])
+    if count is None:
+        count = int(round(per_area * areas.sum()))
+
+    generator = np.random.default_rng(seed)
+
+    # one root at a random position within each stratum of the cumulative area
+    rank = golden_ratio_order(count) if interleave else np.arange(count)
+    strata = (rank + generator.random(count)) / count
+    return place_roots(vertices, normals, triangles, areas, strata, generator)
+
+
+def sample_root_pool(vertices, normals, faces, count, start=0, seed=None, areas=None):
+    """
+    Sample a prioritized pool of hair roots over the surface of a mesh, any prefix of the pool being spread over
+    the surface in proportion to the face areas. Drawing the first n roots of the pool gives an even fur for any n,
+    so the density can change by drawing more or fewer roots, and the pool can grow by appending roots.
+    The positions along the cumulative area follow the golden ratio sequence, whose prefixes are all evenly spread.
+    :param vertices: (V, 3) array of vertices
+    :param normals: (V, 3) array of vertex normals
+    :param faces: (F, 3 or 4) array of vertex indices, quads are split in two triangles
+    :param count: number of roots
+    :param start: position of the first root in the pool, to append roots to an existing pool
+    :param seed: [optional] seed of the random generator, the same seed gives the same pool
+    :param areas: [optional] (F,) array of the area of each face (see Mesh.face_areas), only used for triangles, the
+    triangles of other polygons being measured again
+    :return: (count, 3) arrays of roots and normals
+    """
+    triangles = triangulate_faces(faces)
+    if areas is None or faces.shape[1] > 3:
+        areas = triangle_areas(vertices[triangles])
+
+    # the roots appended to a pool are drawn from their own generator, so a pool is the same however it was grown
+    generator = np.random.default_rng(None if seed is None else [seed, start])
+
+    strata = (0.5 + np.arange(start, start + count) * GOLDEN_RATIO_CONJUGATE) % 1.0
+    return place_roots(vertices, normals, triangles, areas, strata, generator)
+
+
+def place_roots(vertices, normals, triangles, areas, strata, generator):
+    """
+    Place one root on the triangle found at each position along the cumulative area of the triangles, at a
+    random point within the triangle
+    :param vertices: (V, 3) array of vertices
+    :param normals: (V, 3) array of vertex normals
+    :param triangles: (T, 3) array of vertex indices
+    :param areas: (T,) array of triangle areas
+    :param strata: (N,) array of positions in [0, 1) along the cumulative area
+    :param generator: numpy random generator
+    :return: (N, 3) arrays of roots and normals
+    """
+    count = strata.shape[0]
+    cumulative = np.cumsum(areas)
+    chosen = np.minimum(np.searchsorted(cumulative, strata * cumulative[-1], side='right'), triangles.shape[0] - 1)
+
+    # uniform barycentric coordinates within the triangle
+    u = np.sqrt(generator.random(count))
+    v = generator.random(count)
+    weights = np.stack((1 - u, u * (1 - v), u * v), axis=1)[:, :, np.newaxis]
+
+    corners = triangles[chosen]
+    roots = (vertices[corners] * weights).sum(axis=1)
+    root_normals = normalize((normals[corners] * weights).sum(axis=1))
+    return roots.astype('f'), root_normals.astype('f')
+
+
+def check_strands(arrays, parameters):
+    """
+    Check that the hairs read from a strand file hold all the arrays and parameters used, with consistent shapes
+    :param arrays: dictionary of the arrays of the file, by name
+    :param parameters: dictionary of the parameters of the file
+    :raise KeyError: if an array or a parameter is missing
+    :raise ValueError: if the shape of an array does not match the number of hairs
+    """
+    count = arrays['roots'].shape[0]
+    shapes = {'roots': (count, 3), 'root_normals': (count, 3), 'length_factors': (count,)}
+    if 'points' in arrays:
+        shapes['points'] = (parameters['segments'] + 1, count, 3)
+
+    for name, shape in shapes.items():
+        if arrays[name].shape != shape:
+            raise ValueError('(E) Error: {} has the shape {}, {} expected'.format(name, arrays[name].shape, shape))
+
+    missing = [name for name in ('mesh_hash', 'fur_length', 'fur_density', 'fur_angle', 'sampling', 'seed', 'culling',
+                                 'segments') if name not in parameters]
+    if len(missing) > 0:
+        raise KeyError('(E) Error: the parameters {} are missing'.format(', '.join(missing)))
+
+
+def mesh_hash(*arrays):
+    """
+    :param arrays: the arrays describing a mesh, eg its vertices, normals and faces
+    :return: a digest of their content, the same for the same mesh
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(str(array.shape).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def array_bytes(value):
+    """
+    :param value: an array, a tuple of values or an object holding arrays as attributes (eg StrandClusters)
+    :return: the size in bytes of all the arrays it holds
+    """
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(array_bytes(item) for item in value)
+    return sum(item.nbytes for item in vars(value).values() if isinstance(item, np.ndarray))
+
+
+class StrandCache:
+    """
+    Least recently used cache of generated hairs, bounded by the memory they take, so that going back to a previous
+    density reuses its hairs instead of generating them again. It is shared by the main and the worker threads.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        :param max_bytes: maximum size of the arrays held, the least recently used entries being dropped first
+        """
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: the parameters the hairs were generated for
+        :return: the cached value, or None
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        """
+        Store the hairs generated for a key, unless they are larger than the whole cache
+        """
+        size = array_bytes(value)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.sizes.pop(key)
+                del self.entries[key]
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = value
+            self.sizes[key] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                oldest, _ = self.entries.popitem(last=False)
+                self.total_bytes -= self.sizes.pop(oldest)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
 
 
 class FurUtils:
@@ -11,7 +331,9 @@ class FurUtils:
     A utility class which handles the necessary fur transformations
     """
 
-    def __init__(self, M, scene, vertices, normals, indices, fur_length, fur_density, fur_angle):
+    def __init__(self, M, scene, vertices, normals, indices, fur_length, fur_density, fur_angle, instanced=False,
+                 background=True, sampling='subdivide', seed=None, lod=False, culling=False,
+                 packed=False, physics=False, segments=4, cache_bytes=64 * 1024 * 1024, strands=None):
         """
         The constructor takes the same information a model would, namely:
         :param scene: The scene reference
@@ -21,13 +343,33 @@ class FurUtils:
         :param fur_length: fur length parameter
         :param fur_density: fur density parameter
         :param fur_angle: fur angle parameter
+        :param instanced: whether to upload only the hair roots and expand them into lines on the GPU
+        :param background: whether density changes regenerate the hairs in a worker thread, the current hair model
+        being drawn until the new one is ready
+        :param sampling: 'subdivide' to grow hairs on the vertices and the subdivided faces, 'area' to sample as many
+        hairs over the surface with a density proportional to the face areas (see sample_roots), or 'progressive' to
+        draw a number of hairs growing continuously with the density from a pool of area sampled hairs, so that
+        changing the density only changes the number of hairs drawn (see sample_root_pool)
+        :param seed: [optional] seed of the random hair lengths, shared direction and area sampling, the same seed
+        giving the same hairs. A seed is drawn when not given, so that the hairs only depend on the parameters.
+        :param lod: whether to draw fewer hairs as the model gets smaller on screen (see FurLOD)
+        :param culling: whether to skip drawing the clusters of hairs out of view or on the far side of the model
+        (see StrandClusters)
+        :param packed: whether the line hair models store their vertices in the compact interleaved format
+        :param physics: whether to simulate the line hairs as strands of several segments under gravity, every frame
+        (see StrandPhysics)
+        :param segments: number of segments of each simulated hair
+        :param cache_bytes: memory bound of the cache of the hairs generated for each density (see StrandCache)
+        :param strands: [optional] file of hairs saved by save_strands(), loaded instead of generating the hairs
         """
         # create a two way relationship with the scene
         self.scene = scene
         self.scene.fur_model = self
         self.M = M
 
-        # initialize mesh information
+        # initialize mesh information, the mesh keeping the per face data used by each regeneration. The faces are
+        # not triangulated, as the hairs are grown on the original faces
+        self.mesh = Mesh(vertices, indices, normals, verbose=False, triangulate=False)
         self.initial_vertices = vertices
         self.initial_normals = normals
         self.indices = indices
@@ -36,9 +378,63 @@ class FurUtils:
         self.fur_length = fur_length
         self.fur_density = fur_density
         self.fur_angle = fur_angle
-
-        # generate new vertices for the fur model
-        self.create_vertices()
+        self.instanced = instanced
+        self.packed = packed
+        self.sampling = sampling
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+        self.random_seed = seed is None
+
+        # hairs generated for each density, the mesh being identified by its content
+        self.cache = StrandCache(cache_bytes)
+        self.mesh_hash = mesh_hash(vertices, normals, indices)
+
+        # the level of detail follows the bounding sphere of the mesh on screen
+        self.lod = FurLOD(*bounding_sphere(vertices)) if lod else None
+
+        # clusters of the current hairs, their buffers being sorted by cluster, and hairs culled and ranges of the
+        # buffers drawn in the last frame
+        self.culling = culling
+        self.clusters = None
+        self.culled_fraction = 0.0
+        self.draw_ranges = None
+
+        # the hairs expanded by the fur shader program cannot be simulated
+        if physics and instanced:
+            print('(W) Warning: hair physics is only available for line hairs and will not be simulated')
+            physics = False
+
+        # simulation of the current hairs, the hairs simulated in the last frame, and gravity and collision sphere in
+        # model coordinates
+        self.physics = None
+        self.simulated_hairs = None
+        self.simulated = physics
+        self.segments = segments if physics else 1
+        self.gravity = np.linalg.solve(np.asarray(M)[:3, :3], GRAVITY)
+        self.center = bounding_sphere(vertices)[0]
+
+        # strands kept between updates, so that a length or direction change only moves the hair tips
+        self.hair_model = None
+        self.roots = None
+        self.root_normals = None
+        self.length_factors = np.zeros(0, 'f')
+
+        # number of hairs the buffers of the hair model hold, more than the hairs of a progressive pool
+        self.buffer_capacity = 0
+
+        # direction shared by all hairs when fur_angle is set, only depending on the seed
+        self.fur_direction = self.new_fur_direction()
+
+        # the fur shader program is compiled once and shared by the successive instanced hair models
+        self.fur_shaders = None
+
+        # worker thread regenerating the hair startpoints, and the (density, future) of the running regeneration
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.job = None
+
+        # generate new vertices for the fur model, unless they were saved before
+        self.loaded_strands = strands is not None and self.load_strands(strands)
+        if not self.loaded_strands:
+            self.create_vertices()
 
 
 
@@ -46,21 +442,402 @@ class FurUtils:
         """
         Calculate coordinates for the hairs on the fur model and then pass to the HairModel to render
         """
-        # calculate starting points for each hair
-        fur_vertices, fur_normals = self.new_startpoints(self.initial_vertices, self.initial_normals, self.fur_density)
+        # fur regeneration is timed on its own, as it happens on key presses rather than every frame
+        with self.scene.profiler.stage('fur.create_vertices', 'fur'):
+            self.replace_hair_model(*self.cached_startpoints(self.fur_density))
+
+    def regenerate(self):
+        """
+        Regenerate the hairs for the current density. In the background, the startpoints are calculated by the
+        worker thread while the current hair model keeps being drawn, and update() replaces the model when done.
+        """
+        if self.executor is None:
+            self.create_vertices()
+
+        elif self.job is None:
+            key = self.cache_key(self.fur_density)
+            if self.sampling != 'progressive' and key in self.cache:
+                # the hairs of this density were generated before, so they replace the current ones at once
+                with self.scene.profiler.stage('fur.replace_hair_model', 'fur'):
+                    self.replace_hair_model(*self.cache.get(key))
+            else:
+                self.job = (self.fur_density, self.executor.submit(self.generate_startpoints, self.fur_density))
+
+        # otherwise a regeneration is already running, update() starts the next one for the latest density once it
+        # is done, so that repeated key presses do not queue up regenerations
+
+    def generate_startpoints(self, density):
+        """
+        Calculate the starting points of each hair in the worker thread
+        """
+        with self.scene.profiler.stage('fur.generate_startpoints', 'fur'):
+            return self.cached_startpoints(density)
+
+    def cache_key(self, density):
+        """
+        :return: the key of the hairs generated for a density in the cache. The length and direction of the hairs
+        are not part of it, as they only move the endpoints calculated from the cached hairs.
+        """
+        return self.mesh_hash, self.sampling, float(density), self.seed, self.culling
+
+    def cached_startpoints(self, density):
+        """
+        Find the starting points of the hairs and their clusters for a density, reusing the ones generated before
+        for the same parameters
+        :return: (roots, root normals, clusters)
+        """
+        if self.sampling == 'progressive':
+            # the pool only grows from the current one, and is never regenerated for a previous density
+            roots, root_normals = self.new_startpoints(self.initial_vertices, self.initial_normals, density)
+            return roots, root_normals, self.new_clusters(roots, root_normals)
+
+        key = self.cache_key(density)
+        cached = self.cache.get(key)
+        if cached is None:
+            roots, root_normals = self.new_startpoints(self.initial_vertices, self.initial_normals, density)
+            cached = (roots, root_normals, self.new_clusters(roots, root_normals))
+            self.cache.put(key, cached)
+        return cached
+
+    def new_clusters(self, roots, root_normals):
+        """
+        Group the hairs into clusters if culling is enabled
+        """
+        if not self.culling:
+            return None
+        return StrandClusters(roots, root_normals)
 
-        # calculate endpoints for each hair
-        all_fur_vertices = self.new_endpoints(fur_vertices, fur_normals, self.fur_length, self.fur_angle)
+    def update(self):
+        """
+        Called by the scene every frame, replace the hair model once the worker thread calculated the new startpoints,
+        and choose the hairs drawn for the current view
+        """
+        self.swap_hair_model()
+
+        if self.lod is not None and self.lod.update(self.scene.P, self.scene.camera.V, self.M, self.scene.window_size[1]):
+            self.hair_model.set_strand_count(self.strands_drawn())
+
+        if self.clusters is not None:
+            with self.scene.profiler.stage('fur.cull', 'fur'):
+                self.cull()
+
+        if self.physics is not None:
+            with self.scene.profiler.stage('fur.simulate', 'fur'):
+                self.simulate()
+
+    def simulate(self):
+        """
+        Advance the simulation of the hairs drawn by one frame, and replace their points following the roots in place.
+        Once the hairs drawn are at rest, nothing is simulated or uploaded until other hairs are drawn.
+        """
+        count = self.strands_drawn()
+        hairs = count
+        first, last = 0, count
+        drawn = count
+        if self.clusters is not None:
+            # only the hairs of the clusters drawn
+            firsts, counts = self.draw_ranges
+            hairs = np.repeat(firsts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            first, last = (firsts[0], firsts[-1] + counts[-1]) if firsts.shape[0] > 0 else (0, 0)
+            drawn = (firsts.tobytes(), counts.tobytes())
+
+        if self.physics.at_rest and drawn == self.simulated_hairs:
+            return
+        self.simulated_hairs = drawn
+
+        self.physics.step(hairs=hairs)
+        if last > first:
+            self.hair_model.write_points(first, self.physics.positions[1:, first:last])
+
+    def swap_hair_model(self):
+        """
+        Replace the hair model once the worker thread calculated the new startpoints
+        """
+        if self.job is None or not self.job[1].done():
+            return
+
+        density, future = self.job
+        self.job = None
+
+        # a grown pool is used whatever the current density, as only the number of hairs drawn depends on it
+        if density != self.fur_density and self.sampling != 'progressive':
+            # the density changed while the worker was running, the result is superseded by the latest density
+            self.regenerate()
+        else:
+            # only the upload of the new hairs happens on the main thread
+            with self.scene.profiler.stage('fur.replace_hair_model', 'fur'):
+                self.replace_hair_model(*future.result())
+
+    def close(self):
+        """
+        Stop the worker thread, without waiting for a running regeneration
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def cull(self):
+        """
+        Only draw the clusters of hairs which may be visible from the current view
+        """
+        # the cones of normals only bound the hairs growing along the normals
+        visible = self.clusters.visible(self.scene.P, self.scene.camera.V, self.M, self.fur_length,
+                                        cones=not self.fur_angle)
+        strands = self.strands_drawn()
+        firsts, counts = self.clusters.ranges(visible, strands)
+        self.hair_model.set_draw_ranges(firsts, counts)
+        self.draw_ranges = (firsts, counts)
+        self.culled_fraction = 1 - counts.sum() / max(strands, 1)
+
+    def buffer_order(self, array):
+        """
+        :param array: per hair array, in the order of the hairs
+        :return: the array in the order of the hair model buffers, sorted by cluster when culling
+        """
+        if self.clusters is None:
+            return array
+        return array[self.clusters.order]
+
+    def replace_hair_model(self, roots, root_normals, clusters=None, length_factors=None, points=None):
+        """
+        Replace the hair model by a new one for the given hair startpoints, this part needs the OpenGL context
+        :param roots: (N, 3) array of hair startpoints
+        :param root_normals: (N, 3) array of normals at the startpoints
+        :param clusters: [optional] the clusters of the hairs, to cull them
+        :param length_factors: [optional] (N,) array of the length factors of the hairs, drawn from the seed if not
+        given
+        :param points: [optional] (segments + 1, N, 3) array of the points of the line hairs in the order of the
+        buffers, uploaded as they are (see new_strand_points)
+        """
+        previous_model = self.hair_model
+        if (previous_model is not None and self.sampling == 'progressive' and clusters is None
+                and self.clusters is None and length_factors is None and points is None
+                and self.roots.shape[0] < roots.shape[0] <= self.buffer_capacity):
+            # the pool grew and its new hairs fit in the buffers of the current hair model
+            self.append_strands(roots, root_normals)
+            return
+
+        self.roots = roots
+        self.root_normals = root_normals
+        self.clusters = clusters
+
+        # draw the random length of each hair, the same for the same hair whatever the number of hairs
+        if length_factors is None:
+            length_factors = self.new_length_factors(self.roots.shape[0])
+        self.length_factors = length_factors
+
+        # the buffers of a pool have room for more hairs, unless they are sorted by cluster, the clusters of the
+        # grown pool mixing the new hairs with the previous ones
+        count = self.roots.shape[0]
+        self.buffer_capacity = POOL_GROWTH * count if self.sampling == 'progressive' and clusters is None else count
+
+        if self.instanced:
+            # the endpoints are calculated by the fur shader program
+            self.hair_model = InstancedHairModel(
+                M=self.M, scene=self.scene, roots=self.padded(self.buffer_order(self.roots)),
+                normals=self.padded(self.buffer_order(self.root_normals)),
+                length_factors=self.padded(self.buffer_order(self.length_factors)),
+                fur_length=self.fur_length, fur_angle=self.fur_angle,
+                fur_direction=self.fur_direction, shaders=self.fur_shaders)
+            self.fur_shaders = self.hair_model.shaders
+        else:
+            self.hair_model = self.new_hair_model(points)
+
+        self.hair_model.bind()
+        self.scene.add_model(self.hair_model)
+
+        # the previous model was drawn until now, it can be removed and its buffers released
+        if previous_model is not None:
+            self.scene.remove_model(previous_model)
+
+        if self.sampling == 'progressive':
+            self.update_strand_count()
+        elif self.lod is not None:
+            self.hair_model.set_strand_count(self.strands_drawn())
+
+    def append_strands(self, roots, root_normals):
+        """
+        Add the hairs appended to the pool to the buffers of the current hair model, only uploading the new hairs
+        :param roots: (N, 3) array of the roots of the pool, starting with the current ones
+        :param root_normals: (N, 3) array of the normals at the roots
+        """
+        first = self.roots.shape[0]
+        self.roots = roots
+        self.root_normals = root_normals
+        self.length_factors = self.new_length_factors(roots.shape[0])
+
+        if self.instanced:
+            self.hair_model.write_strands(first, roots[first:], root_normals[first:], self.length_factors[first:])
+        else:
+            endpoints = self.new_endpoints(roots[first:], root_normals[first:], self.fur_length, self.fur_angle,
+                                           self.length_factors[first:])
+            points = rest_strands(roots[first:], endpoints, self.segments)
+            if self.physics is not None:
+                # the simulated hairs restart from their rest shape, with the new ones
+                self.physics.set_rest(np.concatenate((self.physics.rest, points), axis=1))
+            self.hair_model.write_points(first, points, root_normals[first:])
+
+        self.update_strand_count()
+
+    def padded(self, array):
+        """
+        :param array: per hair array
+        :return: the array with rows of zeros for the hairs which are not in the pool yet, see buffer_capacity
+        """
+        if array.shape[0] == self.buffer_capacity:
+            return array
+        padded = np.zeros((self.buffer_capacity,) + array.shape[1:], dtype='f')
+        padded[:array.shape[0]] = array
+        return padded
+
+    def strands_drawn(self):
+        """
+        :return: the number of hairs of the current hair model drawn for the density and the level of detail
+        """
+        count = self.roots.shape[0]
+        if self.sampling == 'progressive':
+            count = min(count, strand_budget(self.initial_vertices.shape[0], self.indices, self.fur_density))
+
+        # the first hairs of the buffers cover the whole model, so the level of detail only draws fewer of them
+        if self.lod is not None:
+            count = self.lod.strands(count)
+        return count
 
-        # add the same normals from starting points to endpoints
-        all_fur_normals = []
-        for n in fur_normals:
-            all_fur_normals.extend([n, n])
+    def update_strand_count(self):
+        """
+        Draw as many hairs of the pool as the density asks for, the pool being extended when too small
+        """
+        budget = strand_budget(self.initial_vertices.shape[0], self.indices, self.fur_density)
+        self.hair_model.set_strand_count(self.strands_drawn())
+
+        if budget > self.roots.shape[0]:
+            # the whole pool is drawn until the extended one replaces it
+            self.regenerate()
+
+    def new_hair_model(self, points=None):
+        """
+        Create a hair model drawing lines from each startpoint to its endpoint, split into segments when simulated
+        :param points: [optional] the points of the hairs, calculated from the current hairs if not given
+        """
+        if points is None:
+            points = self.new_strand_points()
+        if self.simulated:
+            self.physics = StrandPhysics(points, self.center, gravity=self.gravity)
+
+        # all startpoints are stored first and the following points of all hairs after them, so that they can be
+        # updated in place, and each segment is drawn as a line between a point and the next one of its hair,
+        # the segments of each hair following each other. Each level of points has room for buffer_capacity hairs.
+        count = self.buffer_capacity
+        if count != points.shape[1]:
+            points = np.stack([self.padded(level) for level in points])
+        fur_vertices = points.reshape(-1, 3)
+        fur_normals = np.tile(self.padded(self.buffer_order(self.root_normals)), (self.segments + 1, 1))
+        starts = np.arange(count, dtype=np.uint32)[:, np.newaxis] + np.uint32(count) * np.arange(self.segments, dtype=np.uint32)
+        fur_indices = np.stack((starts, starts + np.uint32(count)), axis=2).reshape(-1, 2)
 
         # generate hair model
-        fur_model = HairModel(M=self.M, scene=self.scene, vertices=np.array(all_fur_vertices), normals=np.array(all_fur_normals))
-        fur_model.bind()
-        self.scene.add_model(fur_model)
+        return HairModel(M=self.M, scene=self.scene, vertices=fur_vertices, normals=fur_normals, indices=fur_indices,
+                         packed=self.packed, segments=self.segments)
+
+    def new_strand_points(self):
+        """
+        :return: (segments + 1, N, 3) array of the points of the straight hairs, in the order of the buffers
+        """
+        endpoints = self.new_endpoints(self.roots, self.root_normals, self.fur_length, self.fur_angle)
+        return rest_strands(self.buffer_order(self.roots), self.buffer_order(endpoints), self.segments)
+
+    def save_strands(self, file_name):
+        """
+        Save the current hairs and the parameters they were generated with, see strandfile.py
+        :param file_name: the file to write
+        """
+        arrays = {'roots': self.roots, 'root_normals': self.root_normals, 'length_factors': self.length_factors}
+        if not self.instanced:
+            # the points are saved in the layout of the position buffer, to be uploaded as they are
+            arrays['points'] = self.new_strand_points()
+
+        parameters = {
+            'mesh_hash': self.mesh_hash,
+            'fur_length': self.fur_length,
+            'fur_density': self.fur_density,
+            'fur_angle': self.fur_angle,
+            'sampling': self.sampling,
+            'seed': self.seed,
+            'culling': self.culling,
+            'segments': self.segments,
+        }
+        strandfile.save_strands(file_name, arrays, parameters)
+
+    def load_strands(self, file_name):
+        """
+        Replace the hairs by the ones saved by save_strands(), their arrays being mapped from the file. The saved
+        parameters replace the current ones, with a warning for each one which differs.
+        :param file_name: the file to read
+        :return: True if the hairs were loaded, False if they were saved for another mesh or the file cannot be
+        read, eg when truncated or written by another version
+        """
+        with self.scene.profiler.stage('fur.load_strands', 'fur'):
+            try:
+                arrays, parameters = strandfile.load_strands(file_name)
+                check_strands(arrays, parameters)
+            except (ValueError, OSError, KeyError) as error:
+                print('(W) Warning: the strands of {} cannot be loaded and will be generated again: {}'.format(file_name, error))
+                return False
+
+            if parameters['mesh_hash'] != self.mesh_hash:
+                print('(W) Warning: the strands of {} were generated for another mesh and will not be loaded'.format(file_name))
+                return False
+
+            for name in ('fur_length', 'fur_density', 'fur_angle', 'sampling', 'seed'):
+                if parameters[name] != getattr(self, name) and not (name == 'seed' and self.random_seed):
+                    print('(W) Warning: the strands of {} were generated with {} {} instead of {}, the saved value is used'.format(
+                        file_name, name, parameters[name], getattr(self, name)))
+
+            # the following regenerations go on from the saved parameters
+            self.fur_length = parameters['fur_length']
+            self.fur_density = parameters['fur_density']
+            self.fur_angle = parameters['fur_angle']
+            self.sampling = parameters['sampling']
+            self.seed = parameters['seed']
+            self.random_seed = False
+            self.fur_direction = self.new_fur_direction()
+
+            # the clusters are found again, in the same order as when saving if culling was enabled then
+            roots = arrays['roots']
+            root_normals = arrays['root_normals']
+            clusters = self.new_clusters(roots, root_normals)
+            points = arrays.get('points')
+            if parameters['culling'] != self.culling or parameters['segments'] != self.segments:
+                points = None
+
+            self.replace_hair_model(roots, root_normals, clusters, arrays['length_factors'], points)
+            if self.sampling != 'progressive':
+                self.cache.put(self.cache_key(self.fur_density), (roots, root_normals, clusters))
+        return True
+
+    def update_endpoints(self):
+        """
+        Move the end of each hair of the current fur model without regenerating it
+        """
+        with self.scene.profiler.stage('fur.update_endpoints', 'fur'):
+            self.move_endpoints()
+
+    def move_endpoints(self):
+        """
+        Update the hair model with the current fur length and direction
+        """
+        if self.instanced:
+            # only the uniforms of the fur shader program change
+            self.hair_model.set_fur(self.fur_length, self.fur_angle, self.fur_direction)
+            return
+
+        if self.physics is not None:
+            # the simulated hairs restart from their new rest shape
+            self.physics.set_rest(self.new_strand_points())
+            self.hair_model.update_endpoints(self.physics.positions[1:].reshape(-1, 3))
+            return
+
+        endpoints = self.new_endpoints(self.roots, self.root_normals, self.fur_length, self.fur_angle)
+        self.hair_model.update_endpoints(self.buffer_order(endpoints))
 
     def new_startpoints(self, vertices, normals, density):
         """
@@ -70,18 +847,38 @@ class FurUtils:
         :param density: desired density
         :return:
         """
-        startpoints = [[],[]]
+        if self.sampling == 'progressive':
+            # extend the pool of the current hair model, which is kept as is
+            count = strand_budget(vertices.shape[0], self.indices, density)
+            roots = self.roots if self.roots is not None else np.zeros((0, 3), 'f')
+            root_normals = self.root_normals if self.root_normals is not None else np.zeros((0, 3), 'f')
+            if count <= roots.shape[0]:
+                return roots, root_normals
+
+            new_roots, new_normals = sample_root_pool(vertices, normals, self.indices, count - roots.shape[0],
+                                                      start=roots.shape[0], seed=self.seed,
+                                                      areas=self.mesh.face_areas())
+            return np.concatenate((roots, new_roots)), np.concatenate((root_normals, new_normals))
+
+        if self.sampling == 'area':
+            # as many hairs as the subdivision would give, spread evenly over the surface instead
+            count = strand_count(vertices.shape[0], self.indices, density)
+            return sample_roots(vertices, normals, self.indices, count=count, seed=self.seed,
+                                areas=self.mesh.face_areas(), interleave=self.lod is not None)
+
+        if self.lod is not None:
+            # the level of detail draws the first hairs, so the hairs of each level are interleaved over the model
+            order = golden_ratio_order(vertices.shape[0])
+            vertices = vertices[order]
+            normals = normals[order]
 
         if density > 0:
-            # find the list of all faces
-            vertex_faces = self.get_face_vertices(vertices, self.indices)
-            normal_faces = self.get_face_vertices(normals, self.indices)
+            # find the list of all faces, gathered once for the mesh
+            vertex_faces = self.mesh.face_positions()
+            normal_faces = self.mesh.face_normals()
 
-            # split each face further based on density
-            for i in range(len(vertex_faces)):
-                new_startpoints = self.densify_fur(vertex_faces[i], normal_faces[i], density)
-                startpoints[0] += new_startpoints[0]
-                startpoints[1] += new_startpoints[1]
+            # split all faces further based on density in one batch
+            startpoints = subdivide_faces(vertex_faces, normal_faces, density, interleave=self.lod is not None)
 
             # Add newly found vertices/normals to list of strand origins
             vertices = np.concatenate((vertices, startpoints[0]))
@@ -89,99 +886,53 @@ class FurUtils:
 
         return vertices, normals
 
-    def get_face_vertices(self, vertices, indices):
+    def new_length_factors(self, count):
         """
-        Using a list of indices and vertex coords, return a list of faces they correspond to
-        :param vertices: vertices (can also be used for normals)
-        :param indices: indices
-        :return:
+        Find the random length factor of each hair, between 0.1 and 1. The factors are drawn in sequence from the
+        seed, so that a hair keeps its length when the number of hairs changes.
+        :param count: number of hairs
+        :return: (count,) array of length factors
+        """
+        generator = np.random.default_rng([self.seed, LENGTH_STREAM])
+        return (generator.integers(1, 11, size=count) / 10).astype('f')
+
+    def new_fur_direction(self):
         """
-        faces = []
-        for index in indices:
-            face = [vertices[i] for i in index]
-            faces.append(face)
-        return np.array(faces)
-
-    def densify_fur(self, vertices, normals, density):
-        """
-        Simulate splitting of each face to generate new coordinates
-            :param vertices: vertices
-            :param normals: quad normals
-            :param density: desired density
-            :return: list of new coordinates
-        """
-
-        # Find strand origins of the face
-        vert_origin = sum(vertices) / len(vertices)
-        norm_origin = sum(normals) / len(normals)
-
-        # Add to list
-        vert_origins = [vert_origin]
-        norm_origins = [norm_origin]
-
-        # For each level of density (integer), create new small triangles/quads with origins
-        if (density - 1) > 0:  # Density not yet reached
-            if len(vertices) == 3:
-                # Triangle: create 3 new small triangles
-                new_vert = [[vertices[0], vertices[1], vert_origin],
-                            [vertices[0], vertices[2], vert_origin],
-                            [vertices[1], vertices[2], vert_origin]]
-                new_norm = [[normals[0], normals[1], norm_origin],
-                            [normals[0], normals[2], norm_origin],
-                            [normals[1], normals[2], norm_origin]]
-            elif len(vertices) == 4:
-                # Quad: create 4 new small quads
-                new_vert = [[vertices[0], vertices[1], vert_origin],
-                            [vertices[1], vertices[2], vert_origin],
-                            [vertices[2], vertices[3], vert_origin],
-                            [vertices[3], vertices[0], vert_origin]]
-                new_norm = [[normals[0], normals[1], norm_origin],
-                            [normals[1], normals[2], norm_origin],
-                            [normals[2], normals[3], norm_origin],
-                            [normals[3], normals[0], norm_origin]]
-
-            # Call function recursively to check if density reached for each new origin
-            for v in range(len(new_vert)):
-                next_level = self.densify_fur(new_vert[v], new_norm[v], density - 1)
-                vert_origins += next_level[0]
-                norm_origins += next_level[1]
-
-        return [vert_origins, norm_origins]
-
-    def new_endpoints(self, vertices, normals, length,angle):
+        Choose a normal of the mesh at random, drawn from the seed only, so that the direction does not change
+        with the number of hairs
+        :return: (3,) float32 array of the direction
+        """
+        generator = np.random.default_rng([self.seed, DIRECTION_STREAM])
+        return np.asarray(self.initial_normals[generator.integers(len(self.initial_normals))], dtype='f')
+
+    def new_endpoints(self, vertices, normals, length, angle, length_factors=None):
         """
         Find the end of each hair on the model
         :param vertices: vertices
         :param normals:normals (used for hair direction)
         :param length: hair length
         :param angle: a flag to denote whether random angle is used
-        :return:
+        :param length_factors: [optional] length factors of the hairs, the ones of the current hairs by default
+        :return: (N, 3) array of endpoints
         """
-        # a list which will record the location of each hair endpoint
-        endpoints = []
-
-        # choose a normal at random to use for all vertices if the random angle flag is true
-        rand_normal_index = random.randint(0, len(normals) - 1)
-
+        if length_factors is None:
+            length_factors = self.length_factors
 
-        # for each vertex, calculate the endpoint location
-        for v_idx in range(len(vertices)):
-            rand_length = length * (random.randint(1, 10) / 10)
-            endpoints.append(vertices[v_idx])
-
-            #check whether to use a random direction to put fur in
-            if angle:
-                # use random normal direction
-                endpoints.append(vertices[v_idx] + normals[rand_normal_index]*rand_length)
-            else:
-                # use regular normal direction
-                endpoints.append(vertices[v_idx] + normals[v_idx] * rand_length)
+        #check whether to use a random direction to put fur in
+        if angle:
+            # use the random direction shared by all hairs
+            directions = self.fur_direction
+        else:
+            # use regular normal direction
+            directions = normals
 
-        return endpoints
+        # one multiply for all hairs, scaling the direction by the random length of each hair
+        rand_lengths = np.float32(length) * length_factors
+        return (vertices + directions * rand_lengths[:, np.newaxis]).astype('f')
 
     def update_fur_length(self, new_len):
         """
-        Generate a new fur model with an updated fur length
+        Update the current fur model with an updated fur length
         :param new_len: length to be added to current value taken from user input
         """
 
@@ -189,13 +940,13 @@ class FurUtils:
         self.fur_length += new_len
 
         # Fur length value must be above 0
-        if self.fur_length > 0:
-            self.create_vertices()
-        else:
+        if self.fur_length <= 0:
             # hair length cannot go into negatives, creates funky results
             print('(W) Warning: fur length at shortest value and will not go under 0')
             self.fur_length = 0
-            self.create_vertices()
+
+        # only the endpoints move, the hairs keep their roots and random lengths
+        self.update_endpoints()
 
     def update_fur_density(self, new_den):
         """
@@ -207,23 +958,26 @@ class FurUtils:
         self.fur_density += new_den
 
         # Density must be above 0
-        if self.fur_density > 0:
-            self.create_vertices()
-        else:
+        if self.fur_density <= 0:
             # Prevent from going into negative density
             print('(W) Warning: fur density at lowest value and will not go under 0')
             self.fur_density = 0
-            self.create_vertices()
+
+        if self.sampling == 'progressive':
+            # only the number of hairs drawn changes, nothing is uploaded unless the pool is extended
+            self.update_strand_count()
+        else:
+            self.regenerate()
 
     def update_fur_direction(self):
         """
-        Generate a new fur model with an updated fur direction by toggling a variable
+        Update the current fur model with an updated fur direction by toggling a variable
         decideing wether to generate directions using a single angle or face normals
         """
 
-        # Update direction boolean to regenerate fur using a random angle
+        # Update direction boolean to move the endpoints using a random angle
         self.fur_angle = not self.fur_angle
-        self.create_vertices()
+        self.update_endpoints()
 
 
 
@@ -1,21 +1,39 @@
+import ctypes
+
 from OpenGL.GL import *
+from OpenGL.extensions import hasGLExtension
 from matutils import *
 from material import Material
 from BaseModel import BaseModel
+from shaders import FurShader
+from vertexformat import pack_vertices
+
+
+def base_instance_supported():
+    """
+    Whether the current context can offset the instances of a draw call, which needs OpenGL 4.2 or the
+    ARB_base_instance extension
+    :return: True if glDrawArraysInstancedBaseInstance can be called
+    """
+    return bool(hasGLExtension('GL_VERSION_GL_4_2') or hasGLExtension('GL_ARB_base_instance'))
 
 class HairModel(BaseModel):
     """
     A simple hair model, which will be fed fur information to draw fur using Line Primitives
     """
 
-    def __init__(self, scene, vertices, normals, M=poseMatrix(), primitive=GL_LINES, material=None):
+    def __init__(self, scene, vertices, normals, indices=None, M=poseMatrix(), primitive=GL_LINES, material=None,
+                 packed=False, segments=1):
         """
         :param scene: reference to the scene the model is instantiated in
         :param vertices: model vertices read from obj file
         :param normals: model normals read from obj file
+        :param indices: [optional] pairs of vertex indices for each line
         :param M:position matrix
         :param material:
         :param primitive:
+        :param packed: whether to store the vertices in the compact interleaved format (see vertexformat.py)
+        :param segments: number of lines of each hair, the indices of each hair following each other
         """
 
         BaseModel.__init__(self, scene=scene, M=M,
@@ -24,7 +42,9 @@ class HairModel(BaseModel):
         # initialize the vertices/normals/indices of the shape
         self.vertices = vertices
         self.normals = normals
-        self.indices = None
+        self.indices = indices
+        self.packed = packed
+        self.segments = segments
 
         # set position and other attributes necessary for drawing
         self.vertex_colors = np.zeros((self.vertices.shape[0], 3), dtype='f')
@@ -37,3 +57,257 @@ class HairModel(BaseModel):
             Ns=10.0
             )
 
+    def set_strand_count(self, count):
+        """
+        Only draw the first hairs
+        :param count: number of hairs drawn
+        """
+        self.draw_count = 2 * self.segments * count
+
+    def set_draw_ranges(self, firsts, counts):
+        """
+        Only draw some ranges of hairs
+        :param firsts: (R,) array of the first hair of each range
+        :param counts: (R,) array of the number of hairs of each range
+        """
+        self.draw_ranges = (2 * self.segments * firsts, 2 * self.segments * counts)
+
+    def strand_capacity(self):
+        """
+        :return: the number of hairs the buffers hold, the points of each level of all hairs following each other
+        """
+        return self.vertices.shape[0] // (self.segments + 1)
+
+    def update_endpoints(self, endpoints):
+        """
+        Replace the hair endpoints, stored after all startpoints, in the existing position buffer
+        :param endpoints: (N, 3) float32 array of new endpoints, or of all the points following the startpoints for
+        hairs of several segments, of the first N hairs of the buffers
+        """
+        self.write_points(0, endpoints.reshape(self.segments, -1, 3))
+
+    def write_points(self, first, points, normals=None):
+        """
+        Replace the last points of some hairs in the existing buffers, eg to move their tips, or to append hairs
+        to the pool of the buffers. Only the rows changed are uploaded, in one call per level of points unless the
+        hairs fill the buffers.
+        :param first: index of the first hair
+        :param points: (L, K, 3) float32 array of the last L points of each of the K hairs, L being the number of
+        segments to move the tips, or the number of segments + 1 to write the whole hairs
+        :param normals: [optional] (K, 3) array of the normals of the hairs, written with their points
+        """
+        capacity = self.strand_capacity()
+        levels, count = points.shape[:2]
+        ranges = []
+        for l, level in enumerate(range(self.segments + 1 - levels, self.segments + 1)):
+            rows = slice(level * capacity + first, level * capacity + first + count)
+            if self.packed:
+                # the points are interleaved with their normals, which only change for new hairs
+                if normals is None:
+                    self.packed_vertices[rows, :3] = np.ascontiguousarray(points[l], dtype='f').view(np.uint32)
+                else:
+                    self.packed_vertices[rows] = pack_vertices(points[l], normals)
+            else:
+                self.vertices[rows] = points[l]
+                if normals is not None:
+                    self.normals[rows] = normals
+            ranges.append((rows.start, rows.stop))
+
+        # the levels follow each other when the hairs fill the buffers
+        merged = [list(ranges[0])]
+        for start, stop in ranges[1:]:
+            if start == merged[-1][1]:
+                merged[-1][1] = stop
+            else:
+                merged.append([start, stop])
+
+        if self.packed:
+            self.upload_rows('vertex', self.packed_vertices, merged)
+        else:
+            self.upload_rows('position', self.vertices, merged)
+            if normals is not None:
+                self.upload_rows('normal', self.normals, merged)
+
+    def upload_rows(self, name, array, ranges):
+        """
+        Upload ranges of rows of an array to its existing buffer
+        :param name: name of the buffer in self.vbos
+        :param array: the array the buffer holds
+        :param ranges: list of (first row, row after the last) to upload
+        """
+        row_bytes = array.strides[0]
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+        for start, stop in ranges:
+            glBufferSubData(GL_ARRAY_BUFFER, start * row_bytes, (stop - start) * row_bytes, array[start:stop])
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+class InstancedHairModel(BaseModel):
+    """
+    A hair model drawing each hair as one instance of a line. Only the root, the direction and the random length
+    factor of each hair are uploaded, the FurShader program expands them into lines using the fur length and
+    angle uniforms, so changing those does not upload anything.
+    """
+
+    def __init__(self, scene, roots, normals, length_factors, fur_length, fur_angle, fur_direction,
+                 M=poseMatrix(), shaders=None):
+        """
+        :param scene: reference to the scene the model is instantiated in
+        :param roots: (N, 3) array of hair roots
+        :param normals: (N, 3) array of normals at the roots, used as hair directions
+        :param length_factors: (N,) array of random length factors
+        :param fur_length: fur length parameter
+        :param fur_angle: whether all hairs use fur_direction instead of their own normal
+        :param fur_direction: the direction shared by all hairs when fur_angle is set
+        :param M: position matrix
+        :param shaders: [optional] the FurShader program, a new one is created if not provided
+        """
+        BaseModel.__init__(self, scene=scene, M=M, primitive=GL_LINES, visible=True)
+
+        # per hair attributes, read once per instance by the vertex shader
+        self.vertices = np.ascontiguousarray(roots, dtype='f')
+        self.normals = np.ascontiguousarray(normals, dtype='f')
+        self.length_factors = np.ascontiguousarray(length_factors, dtype='f').reshape(-1, 1)
+        self.indices = None
+
+        # whether the ranges can be drawn with a base instance, checked once the context is current in bind()
+        self.base_instance = False
+
+        # the compiled program is only needed once the model is bound
+        self.shaders = FurShader() if shaders is None else shaders
+
+        self.set_fur(fur_length, fur_angle, fur_direction)
+
+        # same material as the line hair model
+        self.material = Material(
+            Ka=np.array([0.0, 0.0, 0.0], 'f'),
+            Kd=np.array([0.5, 0.5, 0.5], 'f'),
+            Ks=np.array([1.0, 1.0, 1.0], 'f'),
+            Ns=10.0
+            )
+
+    def instance_attributes(self):
+        """
+        :return: dictionary of the per instance arrays, by attribute name in the fur vertex shader
+        """
+        return {
+            'root': self.vertices,
+            'normal': self.normals,
+            'length_factor': self.length_factors,
+        }
+
+    def buffer_sizes(self):
+        """
+        :return: dictionary of the size in bytes of each buffer uploaded by bind()
+        """
+        return {name: data.nbytes for name, data in self.instance_attributes().items()}
+
+    def write_strands(self, first, roots, normals, length_factors):
+        """
+        Replace some hairs in the existing buffers, eg to append hairs to the pool of the buffers
+        :param first: index of the first hair
+        :param roots: (K, 3) array of hair roots
+        :param normals: (K, 3) array of normals at the roots
+        :param length_factors: (K,) array of random length factors
+        """
+        rows = slice(first, first + roots.shape[0])
+        self.vertices[rows] = roots
+        self.normals[rows] = normals
+        self.length_factors[rows] = np.reshape(length_factors, (-1, 1))
+
+        for name, data in self.instance_attributes().items():
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+            glBufferSubData(GL_ARRAY_BUFFER, first * data.strides[0], data[rows].nbytes, data[rows])
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def set_fur(self, fur_length, fur_angle, fur_direction):
+        """
+        Change the fur parameters, only sent as uniforms when drawing
+        """
+        self.fur_length = fur_length
+        self.fur_angle = fur_angle
+        self.fur_direction = fur_direction
+
+    def set_strand_count(self, count):
+        """
+        Only draw the first hairs
+        :param count: number of hairs drawn
+        """
+        self.draw_count = count
+
+    def set_draw_ranges(self, firsts, counts):
+        """
+        Only draw some ranges of hairs
+        :param firsts: (R,) array of the first hair of each range
+        :param counts: (R,) array of the number of hairs of each range
+        """
+        self.draw_ranges = (firsts, counts)
+
+    def bind(self):
+        """
+        Upload the per hair attributes once, each advancing once per instance instead of once per vertex
+        """
+        if not hasattr(self.shaders, 'program'):
+            self.shaders.compile()
+
+        self.base_instance = base_instance_supported()
+
+        self.vao = self.scene.buffers.create_vertex_array(self)
+
+        for name, data in self.instance_attributes().items():
+            # the locations are read from the linked program, as they cannot be bound after linking it
+            self.attributes[name] = glGetAttribLocation(self.shaders.program, name)
+            self.vbos[name] = self.scene.buffers.create_buffer(self, data, GL_ARRAY_BUFFER)
+            glEnableVertexAttribArray(self.attributes[name])
+            glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
+                                  stride=0, pointer=None)
+            glVertexAttribDivisor(self.attributes[name], 1)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def point_attributes(self, first):
+        """
+        Point the per hair attributes of the bound vertex array at a hair, so that the first instance drawn reads it.
+        Used instead of a base instance when the context does not support them.
+        :param first: index of the hair read by the first instance
+        """
+        for name, data in self.instance_attributes().items():
+            glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+            glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
+                                  stride=0, pointer=ctypes.c_void_p(first * data.strides[0]))
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def draw(self, Mp, shaders):
+        """
+        Draw two vertices per instance, using the fur program instead of the scene shaders
+        """
+        if self.visible:
+            glUseProgram(self.shaders.program)
+
+            self.shaders.set_fur_uniforms(self.fur_length, self.fur_angle, self.fur_direction)
+            self.shaders.bind(
+                P=self.scene.P,
+                V=self.scene.camera.V,
+                M=np.matmul(Mp, self.M),
+                mode=self.scene.mode,
+                material=self.material,
+                light=self.scene.light
+            )
+
+            glBindVertexArray(self.vao)
+            if self.draw_ranges is not None:
+                # one draw per range, the per hair attributes starting at the first hair of the range
+                if self.base_instance:
+                    for first, count in zip(*self.draw_ranges):
+                        glDrawArraysInstancedBaseInstance(self.primitive, 0, 2, int(count), int(first))
+                else:
+                    for first, count in zip(*self.draw_ranges):
+                        self.point_attributes(int(first))
+                        glDrawArraysInstanced(self.primitive, 0, 2, int(count))
+                    # the pointers are stored in the vertex array, so they are reset for the next draws
+                    self.point_attributes(0)
+            else:
+                count = self.vertices.shape[0] if self.draw_count is None else self.draw_count
+                glDrawArraysInstanced(self.primitive, 0, 2, count)
+            glBindVertexArray(0)
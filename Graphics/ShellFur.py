@@ -0,0 +1,291 @@
+from OpenGL.GL import *
+from BaseModel import BaseModel
+from matutils import poseMatrix
+from FurUtil import strand_count, DIRECTION_STREAM, TEXTURE_STREAM
+from lod import FurLOD, bounding_sphere
+from mesh import triangulate_faces, triangle_areas
+from shaders import ShellShader
+import numpy as np
+
+
+def density_texture(size=64, coverage=0.4, seed=None):
+    """
+    Procedurally generate the density texture of the shell fur. Each cell holds a strand with the given
+    probability, its value being the random length factor of the strand (between 0.1 and 1, as for the line
+    strands), or 0 when there is no strand.
+    :param size: number of cells along each side of the (size, size, size) texture
+    :param coverage: fraction of the cells holding a strand
+    :param seed: [optional] seed of the random generator, or sequence of seeds
+    :return: (size, size, size) uint8 array
+    """
+    generator = np.random.default_rng(seed)
+    length_factors = generator.integers(1, 11, size=(size, size, size)) / 10
+    strands = generator.random((size, size, size)) < coverage
+    return np.where(strands, 255 * length_factors, 0).astype(np.uint8)
+
+
+def surface_area(vertices, faces):
+    """
+    :param vertices: (V, 3) array of vertices
+    :param faces: (F, 3 or 4) array of vertex indices
+    :return: the total area of the faces
+    """
+    return triangle_areas(vertices[triangulate_faces(faces)]).sum()
+
+
+def fur_scale(strands, area, coverage):
+    """
+    Find the scale of the density texture giving the same number of strands per unit area as the line fur.
+    The surface crosses about scale^2 texture cells per unit area, of which a fraction holds a strand.
+    :param strands: number of strands of the line fur
+    :param area: area of the mesh
+    :param coverage: fraction of the texture cells holding a strand
+    :return: number of texture cells per unit length
+    """
+    return np.sqrt(strands / (area * coverage))
+
+
+class ShellModel(BaseModel):
+    """
+    A model drawing the base mesh once per shell with instancing, the ShellShader program offsetting each
+    instance along the normals and discarding the fragments which are not on a strand. Drawing costs the
+    number of shells times the number of mesh vertices, whatever the number of strands.
+    """
+
+    def __init__(self, scene, vertices, normals, faces, texture, shell_count, fur_length, fur_angle, fur_direction,
+                 scale, M=poseMatrix(), shaders=None):
+        """
+        :param scene: reference to the scene the model is instantiated in
+        :param vertices: (V, 3) array of vertices of the base mesh
+        :param normals: (V, 3) array of normals of the base mesh
+        :param faces: (F, 3 or 4) array of faces of the base mesh, drawn as triangles
+        :param texture: (S, S, S) uint8 array of strand length factors, see density_texture()
+        :param shell_count: number of shells drawn, the quality knob of the shell fur
+        :param fur_length: fur length parameter
+        :param fur_angle: whether all shells are offset along fur_direction instead of the normals
+        :param fur_direction: the direction shared by all strands when fur_angle is set
+        :param scale: number of texture cells per unit length, see fur_scale()
+        :param M: position matrix
+        :param shaders: [optional] the ShellShader program, a new one is created if not provided
+        """
+        BaseModel.__init__(self, scene=scene, M=M, primitive=GL_TRIANGLES, visible=True)
+
+        self.vertices = np.ascontiguousarray(vertices, dtype='f')
+        self.normals = np.ascontiguousarray(normals, dtype='f')
+        self.indices = triangulate_faces(faces).astype(np.uint32)
+        self.texture = texture
+
+        # the compiled program is only needed once the model is bound
+        self.shaders = ShellShader() if shaders is None else shaders
+
+        self.shell_count = shell_count
+        self.scale = scale
+        self.set_fur(fur_length, fur_angle, fur_direction)
+
+    def set_fur(self, fur_length, fur_angle, fur_direction):
+        """
+        Change the fur parameters, only sent as uniforms when drawing
+        """
+        self.fur_length = fur_length
+        self.fur_angle = fur_angle
+        self.fur_direction = fur_direction
+
+    def vertices_per_frame(self):
+        """
+        :return: the number of vertices processed to draw the shells (indexed, so at most this many)
+        """
+        return self.shell_count * self.indices.size
+
+    def bind(self):
+        """
+        Upload the base mesh and the density texture once, the shells only differ by their instance number
+        """
+        if not hasattr(self.shaders, 'program'):
+            self.shaders.compile()
+
+        self.vao = self.scene.buffers.create_vertex_array(self)
+
+        for name, data in (('position', self.vertices), ('normal', self.normals)):
+            # the locations are read from the linked program, as they cannot be bound after linking it
+            self.attributes[name] = glGetAttribLocation(self.shaders.program, name)
+            self.vbos[name] = self.scene.buffers.create_buffer(self, data, GL_ARRAY_BUFFER)
+            glEnableVertexAttribArray(self.attributes[name])
+            glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
+                                  stride=0, pointer=None)
+
+        self.index_buffer = self.scene.buffers.create_buffer(self, self.indices, GL_ELEMENT_ARRAY_BUFFER)
+
+        glBindVertexArray(0)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        # the strands repeat over the mesh, each one being a single cell so they keep sharp edges
+        self.texture_id = self.scene.buffers.create_texture(self, GL_TEXTURE_3D)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        size = self.texture.shape[0]
+        glTexImage3D(GL_TEXTURE_3D, 0, GL_R8, size, size, size, 0, GL_RED, GL_UNSIGNED_BYTE, self.texture)
+        for wrap in (GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_TEXTURE_WRAP_R):
+            glTexParameteri(GL_TEXTURE_3D, wrap, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glBindTexture(GL_TEXTURE_3D, 0)
+
+    def draw(self, Mp, shaders):
+        """
+        Draw one instance of the mesh per shell, using the shell program instead of the scene shaders
+        """
+        if self.visible:
+            glUseProgram(self.shaders.program)
+
+            # the texture coordinates span the whole texture, ie its size in cells, per unit
+            self.shaders.set_shell_uniforms(self.fur_length, self.fur_angle, self.fur_direction, self.shell_count,
+                                            self.scale / self.texture.shape[0])
+            self.shaders.bind(
+                P=self.scene.P,
+                V=self.scene.camera.V,
+                M=np.matmul(Mp, self.M),
+                mode=self.scene.mode,
+                material=self.material,
+                light=self.scene.light
+            )
+
+            glActiveTexture(GL_TEXTURE0)
+            glBindTexture(GL_TEXTURE_3D, self.texture_id)
+
+            glBindVertexArray(self.vao)
+            glDrawElementsInstanced(self.primitive, self.indices.size, GL_UNSIGNED_INT, None, self.shell_count)
+            glBindVertexArray(0)
+
+            glBindTexture(GL_TEXTURE_3D, 0)
+
+
+class ShellFurUtils:
+    """
+    Shell fur alternative to FurUtils, with the same update methods so that the scene keys work the same way.
+    The strands come from a procedural density texture instead of subdividing the faces, so changing the density
+    only changes the scale of the texture, and the cost depends on the number of shells rather than of strands.
+    """
+
+    def __init__(self, M, scene, vertices, normals, indices, fur_length, fur_density, fur_angle, shell_count=16,
+                 texture_size=64, coverage=0.4, lod=False, seed=None):
+        """
+        :param M: position matrix
+        :param scene: The scene reference
+        :param vertices: vertices of the mesh the fur grows on
+        :param normals: normals of the mesh the fur grows on
+        :param indices: faces of the mesh the fur grows on
+        :param fur_length: fur length parameter
+        :param fur_density: fur density parameter, matching the number of strands of the line fur
+        :param fur_angle: fur angle parameter
+        :param shell_count: number of shells, more shells give smoother strands at a higher cost
+        :param texture_size: number of cells along each side of the density texture
+        :param coverage: fraction of the texture cells holding a strand
+        :param lod: whether to draw fewer shells as the model gets smaller on screen (see FurLOD)
+        :param seed: [optional] seed of the density texture and of the shared direction, drawn when not given
+        """
+        # create a two way relationship with the scene
+        self.scene = scene
+        self.scene.fur_model = self
+        self.M = M
+
+        self.vertices = vertices
+        self.normals = normals
+        self.indices = indices
+        self.area = surface_area(vertices, indices)
+
+        # initialize fur parameters
+        self.fur_length = fur_length
+        self.fur_density = fur_density
+        self.fur_angle = fur_angle
+        self.shell_count = shell_count
+        self.coverage = coverage
+        self.seed = np.random.SeedSequence().entropy if seed is None else seed
+
+        # the level of detail follows the bounding sphere of the mesh on screen
+        self.lod = FurLOD(*bounding_sphere(vertices)) if lod else None
+
+        # choose a normal at random to use for all shells if the random angle flag is true, as the line fur does
+        generator = np.random.default_rng([self.seed, DIRECTION_STREAM])
+        self.fur_direction = np.asarray(normals[generator.integers(len(normals))], dtype='f')
+
+        self.shell_model = ShellModel(
+            M=self.M, scene=self.scene, vertices=vertices, normals=normals, faces=indices,
+            texture=density_texture(texture_size, coverage, [self.seed, TEXTURE_STREAM]), shell_count=shell_count, fur_length=fur_length,
+            fur_angle=fur_angle, fur_direction=self.fur_direction, scale=self.scale())
+        self.shell_model.bind()
+        self.scene.add_model(self.shell_model)
+
+    def scale(self):
+        """
+        :return: the texture scale giving as many strands as the line fur at the current density
+        """
+        strands = strand_count(self.vertices.shape[0], self.indices, self.fur_density)
+        return fur_scale(strands, self.area, self.coverage)
+
+    def update(self):
+        """
+        Called by the scene every frame, nothing is regenerated in the background for the shell fur, only the
+        number of shells follows the level of detail
+        """
+        if self.lod is not None and self.lod.update(self.scene.P, self.scene.camera.V, self.M, self.scene.window_size[1]):
+            self.update_shells()
+
+    def close(self):
+        pass
+
+    def update_shells(self):
+        """
+        Send the current parameters to the shell model, nothing is uploaded until it is drawn
+        """
+        self.shell_model.set_fur(self.fur_length, self.fur_angle, self.fur_direction)
+        self.shell_model.shell_count = self.shell_count if self.lod is None else self.lod.shells(self.shell_count)
+        self.shell_model.scale = self.scale()
+
+    def update_fur_length(self, new_len):
+        """
+        Update the fur length
+        :param new_len: length to be added to current value taken from user input
+        """
+        self.fur_length += new_len
+
+        # Fur length value must be above 0
+        if self.fur_length <= 0:
+            print('(W) Warning: fur length at shortest value and will not go under 0')
+            self.fur_length = 0
+
+        self.update_shells()
+
+    def update_fur_density(self, new_den):
+        """
+        Update the fur density, which scales the density texture
+        :param new_den: desity to be added to current value taken from user input
+        """
+        self.fur_density += new_den
+
+        # Density must be above 0
+        if self.fur_density <= 0:
+            print('(W) Warning: fur density at lowest value and will not go under 0')
+            self.fur_density = 0
+
+        self.update_shells()
+
+    def update_fur_direction(self):
+        """
+        Toggle between offsetting the shells along the normals and along a single random direction
+        """
+        self.fur_angle = not self.fur_angle
+        self.update_shells()
+
+    def update_fur_quality(self, new_shells):
+        """
+        Update the number of shells, trading the smoothness of the strands for speed
+        :param new_shells: number of shells to be added to the current value taken from user input
+        """
+        self.shell_count += new_shells
+
+        # At least one shell is drawn
+        if self.shell_count < 1:
+            print('(W) Warning: shell count at lowest value and will not go under 1')
+            self.shell_count = 1
+
+        print('Drawing {} shell(s)'.format(self.shell_count))
+        self.update_shells()
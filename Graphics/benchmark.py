@@ -0,0 +1,416 @@
+# Benchmarks for the CPU side of the fur project, run from this directory with: python benchmark.py
+
+import copy
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from blender import load_obj_file, load_obj_file_fast, parse_obj_file, parse_obj_file_parallel
+from FurUtil import subdivide_faces, strand_count, strand_budget, sample_roots, sample_root_pool, StrandCache
+from HairModel import HairModel, InstancedHairModel
+from mesh import Mesh, triangulate_faces, triangle_areas, acmr
+from material import Material
+from BatchedModel import batch_meshes
+from ShellFur import surface_area, fur_scale
+from camera import Camera
+from lod import FurLOD, bounding_sphere
+from culling import StrandClusters
+from FurPhysics import StrandPhysics, rest_strands
+from vertexformat import pack_vertices, unpack_vertices
+from strandfile import save_strands, load_strands
+from matutils import frustumMatrix, poseMatrix
+from glstub import load_bunny, quiet, BUNNY_POSE
+
+
+def best_time(function, repeat=3):
+    '''
+    Return the best wall clock time over a few runs of a function.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_obj_loading(file_name='models/bunny_world.obj'):
+    '''
+    Time the startup loading of an object file: the line by line parser, the bulk parser without cache (cold)
+    and the bulk loader reading its binary cache (warm).
+    '''
+    cache_name = file_name + '.cache.npz'
+    if os.path.exists(cache_name):
+        os.remove(cache_name)
+
+    current = best_time(quiet(lambda: load_obj_file(file_name)))
+    cold = best_time(quiet(lambda: load_obj_file_fast(file_name, use_cache=False)))
+    tokenize = best_time(lambda: parse_obj_file(file_name))
+    quiet(lambda: load_obj_file_fast(file_name))()
+    warm = best_time(quiet(lambda: load_obj_file_fast(file_name)))
+
+    print('Loading {} (ms)'.format(file_name))
+    print('{:>16}{:>12.2f}'.format('current parser', 1000 * current))
+    print('{:>16}{:>12.2f}'.format('cold parse', 1000 * cold))
+    print('{:>16}{:>12.2f}'.format('(tokenize only)', 1000 * tokenize))
+    print('{:>16}{:>12.2f}'.format('warm cache', 1000 * warm))
+
+
+def write_tiled_obj(file_name, mesh, copies, materials=4):
+    '''
+    Write an object file made of copies of a mesh side by side, switching material before each copy, to stand
+    for a large scanned mesh.
+    '''
+    with open(file_name, 'w') as objfile:
+        for c in range(copies):
+            np.savetxt(objfile, mesh.vertices + [c, 0, 0], fmt='v %.6f %.6f %.6f')
+            objfile.write('usemtl material_{}\n'.format(c % materials))
+            np.savetxt(objfile, mesh.faces + 1 + c * mesh.vertices.shape[0], fmt='f %d %d %d')
+
+
+def bench_parallel_loading(mesh, workers=(1, 2, 4, 8), copies=64):
+    '''
+    Time the bulk parsing of a large object file in a single process and with a pool of worker processes, each
+    parsing a range of lines. The pool only pays off with several CPUs, so run it on a multi-core machine before
+    using the parallel parser.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'tiled.obj')
+        write_tiled_obj(file_name, mesh, copies)
+
+        print('Parsing {:.1f} MB, {} faces on {} CPU(s) (ms)'.format(
+            os.path.getsize(file_name) / 1e6, copies * mesh.faces.shape[0], os.cpu_count()))
+        print('{:>8}{:>12}{:>10}'.format('workers', 'time', 'speedup'))
+
+        serial = best_time(lambda: parse_obj_file(file_name))
+        print('{:>8}{:>12.1f}{:>10.2f}'.format('serial', 1000 * serial, 1.0))
+        for count in workers:
+            seconds = best_time(lambda: parse_obj_file_parallel(file_name, count))
+            print('{:>8}{:>12.1f}{:>10.2f}'.format(count, 1000 * seconds, serial / seconds))
+
+
+def bench_mesh_optimization(mesh, cache_sizes=(8, 16, 32)):
+    '''
+    Show the average cache miss ratio of the faces of the mesh as loaded and once optimised for a few post-transform
+    cache sizes, and time the optimisation.
+    '''
+    print('Mesh optimisation, vertices transformed per triangle (ACMR)')
+    print('{:>8}{:>10}{:>12}{:>12}'.format('cache', 'loaded', 'optimised', 'time (ms)'))
+    for cache_size in cache_sizes:
+        optimised = copy.deepcopy(mesh)
+        start = time.perf_counter()
+        quiet(lambda: optimised.optimize(cache_size=cache_size))()
+        seconds = time.perf_counter() - start
+        print('{:>8}{:>10.3f}{:>12.3f}{:>12.2f}'.format(cache_size, acmr(mesh.faces, cache_size),
+                                                      acmr(optimised.faces, cache_size), 1000 * seconds))
+
+
+def bench_batching(mesh, material_counts=(1, 10, 100, 500), meshes_per_material=4):
+    '''
+    Split the mesh into parts cycling through a number of materials, as in an object file switching materials
+    many times, and compare the draw state changes of each frame with one model per part and with a single
+    batched model, as well as the time to batch the parts. The state changes are counted, not timed, as the frame
+    times depend on the GPU and driver.
+    '''
+    print('Draw state changes per frame, one model per mesh / batched model')
+    print('{:>10}{:>8}{:>14}{:>14}{:>14}{:>12}'.format('materials', 'meshes', 'VAO binds', 'draws', 'switches',
+                                                       'batch (ms)'))
+
+    for count in material_counts:
+        materials = [Material(name=str(m), Kd=[m / count] * 3) for m in range(count)]
+        parts = []
+        for p, faces in enumerate(np.array_split(mesh.faces, count * meshes_per_material)):
+            used, faces = np.unique(faces, return_inverse=True)
+            parts.append(quiet(lambda: Mesh(mesh.vertices[used], faces.reshape(-1, 3).astype(np.uint32),
+                                            mesh.normals[used], materials[p % count]))())
+
+        # the material uniforms are sent again whenever two consecutive draws use different materials
+        switches = sum(1 for a, b in zip(parts[:-1], parts[1:]) if a.material is not b.material)
+        seconds = best_time(lambda: batch_meshes(parts))
+        batches = batch_meshes(parts)[3]
+        print('{:>10}{:>8}{:>14}{:>14}{:>14}{:>12.2f}'.format(
+            count, len(parts), '{} / 1'.format(len(parts)), '{} / {}'.format(len(parts), len(batches)),
+            '{} / {}'.format(switches, len(batches) - 1), 1000 * seconds))
+
+
+def bench_face_gathering(mesh):
+    '''
+    Time gathering the corners and corner normals of every face, as done at each regeneration of the fur: one
+    face at a time as before, in bulk with fancy indexing, and from the per face data cached by the mesh.
+    '''
+    def per_face():
+        return (np.array([[mesh.vertices[i] for i in face] for face in mesh.faces]),
+                np.array([[mesh.normals[i] for i in face] for face in mesh.faces]))
+
+    def bulk():
+        return mesh.vertices[mesh.faces], mesh.normals[mesh.faces]
+
+    cached = quiet(lambda: Mesh(mesh.vertices, mesh.faces, mesh.normals))()
+    cached.face_positions()
+    cached.face_normals()
+
+    print('Face gathering for {} faces (ms)'.format(mesh.faces.shape[0]))
+    print('{:>12}{:>12.3f}'.format('per face', 1000 * best_time(per_face)))
+    print('{:>12}{:>12.3f}'.format('bulk', 1000 * best_time(bulk)))
+    print('{:>12}{:>12.3f}'.format('cached', 1000 * best_time(lambda: (cached.face_positions(), cached.face_normals()))))
+
+
+def bench_fur_roots(mesh, face_counts=(512, 1024, 2048, 4096, 8192), densities=(1, 2, 3, 4, 5, 6)):
+    '''
+    Time the generation of the fur roots against the number of faces and the fur density.
+    '''
+    print('Fur root generation (ms)')
+    print('{:>8}'.format('faces') + ''.join('{:>12}'.format('density {}'.format(d)) for d in densities))
+
+    for count in face_counts:
+        faces = mesh.faces[:count]
+        vertex_faces = mesh.vertices[faces]
+        normal_faces = mesh.normals[faces]
+
+        row = '{:>8}'.format(faces.shape[0])
+        for density in densities:
+            seconds = best_time(lambda: subdivide_faces(vertex_faces, normal_faces, density))
+            row += '{:>12.2f}'.format(1000 * seconds)
+        print(row)
+
+    roots = subdivide_faces(mesh.vertices[mesh.faces], mesh.normals[mesh.faces], densities[-1])[0]
+    print('{} roots at density {} on the full mesh'.format(roots.shape[0], densities[-1]))
+
+
+def bench_root_sampling(mesh, densities=(1, 2, 3, 4, 5)):
+    '''
+    Time the area weighted root sampler against the subdivision for the same number of roots. The subdivision
+    gives every face the same number of roots, so the roots per unit area vary as much as the face areas.
+    '''
+    areas = triangle_areas(mesh.vertices[triangulate_faces(mesh.faces)])
+    print('Root sampling (ms), face areas spread over a factor of {:.0f}'.format(areas.max() / areas[areas > 0].min()))
+    print('{:>8}{:>10}{:>12}{:>12}'.format('density', 'roots', 'subdivide', 'area'))
+
+    vertex_faces = mesh.vertices[mesh.faces]
+    normal_faces = mesh.normals[mesh.faces]
+    for density in densities:
+        count = strand_count(mesh.vertices.shape[0], mesh.faces, density)
+        subdivide = best_time(lambda: subdivide_faces(vertex_faces, normal_faces, density))
+        area = best_time(lambda: sample_roots(mesh.vertices, mesh.normals, mesh.faces, count=count, seed=0))
+        print('{:>8}{:>10}{:>12.2f}{:>12.2f}'.format(density, count, 1000 * subdivide, 1000 * area))
+
+
+def bench_density_steps(mesh, densities=np.arange(0, 3.01, 0.25)):
+    '''
+    Compare the strands of the subdivision and of the progressive pool for each step of the density keys, and
+    the time to sample a pool large enough for the highest density.
+    '''
+    print('Strands against density')
+    print('{:>8}{:>12}{:>12}'.format('density', 'subdivide', 'progressive'))
+    for density in densities:
+        print('{:>8.2f}{:>12}{:>12}'.format(density, strand_count(mesh.vertices.shape[0], mesh.faces, density),
+                                            strand_budget(mesh.vertices.shape[0], mesh.faces, density)))
+
+    count = strand_budget(mesh.vertices.shape[0], mesh.faces, densities[-1])
+    seconds = best_time(lambda: sample_root_pool(mesh.vertices, mesh.normals, mesh.faces, count, seed=0))
+    print('{} pool roots sampled in {:.2f} ms'.format(count, 1000 * seconds))
+
+
+def bench_strand_cache(mesh, densities=(1, 2, 3, 4, 5), max_bytes=64 * 1024 * 1024):
+    '''
+    Compare generating the hairs and their clusters for each density with finding them in the strand cache, as
+    when going back to a previous density, and show the memory each density takes in the cache.
+    '''
+    vertex_faces = mesh.vertices[mesh.faces]
+    normal_faces = mesh.normals[mesh.faces]
+
+    def generate(density):
+        roots, normals = subdivide_faces(vertex_faces, normal_faces, density)
+        roots = np.concatenate((mesh.vertices, roots))
+        normals = np.concatenate((mesh.normals, normals))
+        return roots, normals, StrandClusters(roots, normals)
+
+    cache = StrandCache(max_bytes)
+    print('Strand cache, {} MB bound'.format(max_bytes // (1024 * 1024)))
+    print('{:>8}{:>10}{:>16}{:>14}{:>10}{:>10}'.format('density', 'hairs', 'generate (ms)', 'cached (ms)', 'MB',
+                                                       'entries'))
+    for density in densities:
+        generated = generate(density)
+        seconds = best_time(lambda: generate(density))
+        cache.put(density, generated)
+        lookup = best_time(lambda: cache.get(density))
+        print('{:>8}{:>10}{:>16.1f}{:>14.4f}{:>10.1f}{:>10}'.format(
+            density, generated[0].shape[0], 1000 * seconds, 1000 * lookup, cache.sizes.get(density, 0) / 1e6,
+            len(cache.entries)))
+
+
+def bench_strand_file(mesh, densities=(2, 3, 4, 5), length=0.1):
+    '''
+    Compare generating the hairs with loading them from a strand file: mapping the arrays, and reading the whole
+    position buffer as its upload would.
+    '''
+    vertex_faces = mesh.vertices[mesh.faces]
+    normal_faces = mesh.normals[mesh.faces]
+
+    def generate(density):
+        roots, normals = subdivide_faces(vertex_faces, normal_faces, density)
+        roots = np.concatenate((mesh.vertices, roots)).astype('f')
+        normals = np.concatenate((mesh.normals, normals)).astype('f')
+        factors = np.random.default_rng(0).integers(1, 11, size=roots.shape[0]) / 10
+        return roots, normals, rest_strands(roots, roots + length * factors[:, np.newaxis] * normals, 1)
+
+    print('Strand file (ms)')
+    print('{:>8}{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}'.format('density', 'hairs', 'MB', 'generate', 'save', 'map',
+                                                            'read'))
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, 'fur.strands')
+        for density in densities:
+            roots, normals, points = generate(density)
+            generating = best_time(lambda: generate(density))
+            arrays = {'roots': roots, 'root_normals': normals, 'points': points}
+            saving = best_time(lambda: save_strands(file_name, arrays, {'density': density}))
+            mapping = best_time(lambda: load_strands(file_name))
+            reading = best_time(lambda: np.sum(load_strands(file_name)[0]['points']))
+            print('{:>8}{:>10}{:>8.1f}{:>12.1f}{:>10.1f}{:>10.2f}{:>10.2f}'.format(
+                density, roots.shape[0], os.path.getsize(file_name) / 1e6, 1000 * generating, 1000 * saving,
+                1000 * mapping, 1000 * reading))
+
+
+def bench_fur_lod(mesh, distances=(5, 6, 8, 10, 12, 15, 20, 15, 10, 6, 5), density=3):
+    '''
+    Show the hairs drawn by the level of detail as the camera zooms out of the bunny and back, with the
+    projection and window height of the scene.
+    '''
+    P = frustumMatrix(-1.0, 1.0, -1.0, 1.0, 1.5, 20)
+    camera = Camera((1250, 800))
+    lod = FurLOD(*bounding_sphere(mesh.vertices))
+    strands = strand_count(mesh.vertices.shape[0], mesh.faces, density)
+
+    print('Fur level of detail for {} hairs'.format(strands))
+    print('{:>8}{:>8}{:>8}{:>10}'.format('distance', 'pixels', 'level', 'hairs'))
+    for distance in distances:
+        camera.distance = distance
+        camera.update()
+        lod.update(P, camera.V, poseMatrix(), 800)
+        print('{:>8}{:>8.0f}{:>8}{:>10}'.format(distance, lod.projected_size(P, camera.V, poseMatrix(), 800),
+                                                lod.level, lod.strands(strands)))
+
+
+def bench_fur_culling(mesh, density=3, cells=(4, 8, 16), views=8):
+    '''
+    Time the clustering of the hairs and the culling of the clusters, and show the fraction of the hairs culled
+    while turning around the bunny, for a few grid sizes.
+    '''
+    roots, normals = sample_root_pool(mesh.vertices, mesh.normals, mesh.faces,
+                                      strand_count(mesh.vertices.shape[0], mesh.faces, density), seed=0)
+    P = frustumMatrix(-1.0, 1.0, -1.0, 1.0, 1.5, 20)
+    M = BUNNY_POSE
+    camera = Camera((1250, 800))
+
+    print('Fur culling of {} hairs'.format(roots.shape[0]))
+    print('{:>8}{:>10}{:>12}{:>12}{:>10}{:>10}'.format('cells', 'clusters', 'build (ms)', 'cull (ms)', 'culled', 'ranges'))
+    for count in cells:
+        clusters = StrandClusters(roots, normals, cells=count)
+        build = best_time(lambda: StrandClusters(roots, normals, cells=count))
+
+        culled = []
+        ranges = []
+        for view in range(views):
+            camera.phi = 2 * np.pi * view / views
+            camera.update()
+            visible = clusters.visible(P, camera.V, M, 0.1)
+            firsts, counts = clusters.ranges(visible, roots.shape[0])
+            culled.append(1 - counts.sum() / roots.shape[0])
+            ranges.append(firsts.shape[0])
+        cull = best_time(lambda: clusters.ranges(clusters.visible(P, camera.V, M, 0.1), roots.shape[0]))
+
+        print('{:>8}{:>10}{:>12.2f}{:>12.3f}{:>10.1%}{:>10.0f}'.format(
+            count, clusters.sizes.shape[0], 1000 * build, 1000 * cull, np.mean(culled), np.mean(ranges)))
+
+
+def bench_fur_upload(mesh, densities=(1, 2, 3, 4)):
+    '''
+    Compare the bytes uploaded for the fur by the line hair model, the line hair model in the packed vertex format
+    and the instanced hair model, and the precision of the packed normals.
+    '''
+    print('Fur upload size (MB)')
+    print('{:>8}{:>10}{:>12}{:>12}{:>12}{:>12}'.format('density', 'hairs', 'lines', 'packed', 'instanced', 'max error'))
+
+    for density in densities:
+        roots, normals = subdivide_faces(mesh.vertices[mesh.faces], mesh.normals[mesh.faces], density)
+        roots = roots.astype('f')
+        normals = normals.astype('f')
+        strands = np.arange(roots.shape[0], dtype=np.uint32)
+
+        lines = HairModel(None, np.concatenate((roots, roots)), np.concatenate((normals, normals)),
+                          indices=np.stack((strands, strands + roots.shape[0]), axis=1))
+        line_bytes = lines.vertices.nbytes + lines.normals.nbytes + lines.vertex_colors.nbytes + lines.indices.nbytes
+
+        # the constant colour of the hairs is not uploaded in the packed format
+        packed = pack_vertices(lines.vertices, lines.normals)
+        packed_bytes = packed.nbytes + lines.indices.nbytes
+        positions, decoded = unpack_vertices(packed)
+        error = max(np.abs(positions - lines.vertices).max(), np.abs(decoded - lines.normals).max())
+
+        instanced = quiet(lambda: InstancedHairModel(None, roots, normals, np.ones(roots.shape[0]), 0.1, False, normals[0]))()
+        instanced_bytes = sum(instanced.buffer_sizes().values())
+
+        print('{:>8}{:>10}{:>12.2f}{:>12.2f}{:>12.2f}{:>12.5f}'.format(
+            density, roots.shape[0], line_bytes / 1e6, packed_bytes / 1e6, instanced_bytes / 1e6, error))
+
+
+def bench_fur_physics(mesh, counts=(1000, 10000, 30000, 100000), segment_counts=(2, 4, 8), length=0.1):
+    '''
+    Time one simulation step of the hairs, ie the cost added to each frame, by number of hairs and of segments.
+    '''
+    center = bounding_sphere(mesh.vertices)[0]
+
+    print('Hair physics step (ms)')
+    print('{:>8}'.format('hairs') + ''.join('{:>14}'.format('{} segments'.format(count)) for count in segment_counts))
+
+    for count in counts:
+        roots, normals = sample_roots(mesh.vertices, mesh.normals, mesh.faces, count=count, seed=0)
+        tips = roots + length * normals
+        row = '{:>8}'.format(count)
+        for segments in segment_counts:
+            physics = StrandPhysics(rest_strands(roots, tips, segments), center)
+            row += '{:>14.2f}'.format(1000 * best_time(physics.step))
+        print(row)
+
+
+def count_shell_fur_vertices(mesh, densities=(1, 2, 3, 4, 5), shell_counts=(8, 16, 32), coverage=0.4):
+    '''
+    Count, without timing anything, the vertices processed each frame by the line strands (two per strand) and by
+    the shell fur (the triangulated mesh once per shell) at the same number of strands per unit area, the shell
+    fur texture cells being scaled by fur_scale(). The frame times depend on the GPU.
+    '''
+    triangle_vertices = triangulate_faces(mesh.faces).size
+    area = surface_area(mesh.vertices, mesh.faces)
+
+    print('Fur vertices per frame (thousands, counted), shell fur at the same strand density as the lines')
+    print('{:>8}{:>10}{:>10}{:>8}'.format('density', 'strands', 'lines', 'cells/u')
+          + ''.join('{:>12}'.format('{} shells'.format(count)) for count in shell_counts))
+
+    for density in densities:
+        strands = strand_count(mesh.vertices.shape[0], mesh.faces, density)
+        row = '{:>8}{:>10}{:>10.0f}{:>8.1f}'.format(density, strands, 2 * strands / 1e3,
+                                                  fur_scale(strands, area, coverage))
+        for count in shell_counts:
+            row += '{:>12.0f}'.format(count * triangle_vertices / 1e3)
+        print(row)
+
+
+if __name__ == '__main__':
+    bunny = load_bunny()
+    bench_mesh_optimization(bunny)
+    bench_batching(bunny)
+    bench_face_gathering(bunny)
+    bench_fur_roots(bunny)
+    bench_root_sampling(bunny)
+    bench_density_steps(bunny)
+    bench_strand_cache(bunny)
+    bench_strand_file(bunny)
+    bench_fur_lod(bunny)
+    bench_fur_culling(bunny)
+    bench_fur_upload(bunny)
+    bench_fur_physics(bunny)
+    count_shell_fur_vertices(bunny)
+    bench_obj_loading()
+    bench_parallel_loading(bunny)
@@ -0,0 +1,396 @@
+# Benchmark suite of parameterized cases, saved as JSON to compare commits, run from this directory with:
+#     python benchsuite.py --output before.json
+#     python benchsuite.py --output after.json --compare before.json --threshold 0.1
+
+import argparse
+import importlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from blender import load_obj_file, parse_obj_file
+from mesh import Mesh, subdivide_mesh
+from material import Material
+from glstub import RecordingGL, StubScene, linked_shaders, load_bunny, quiet, GL_MODULES, BUNNY_POSE
+from matutils import poseMatrix
+
+# increase when the format of the results changes
+RESULTS_VERSION = 1
+
+# seed of the fur, so that every run generates the same hairs
+SEED = 1
+
+def write_obj(file_name, mesh):
+    '''
+    Write a mesh as an object file with the material of the bunny, the material library being found in models/
+    by the loaders
+    '''
+    with open(file_name, 'w') as objfile:
+        objfile.write('mtllib bunny_world.mtl\n')
+        np.savetxt(objfile, mesh.vertices, fmt='v %.6f %.6f %.6f')
+        objfile.write('usemtl initialShadingGroup_wood_texture.jpg\n')
+        np.savetxt(objfile, mesh.faces + 1, fmt='f %d %d %d')
+
+
+def gl_counters(gl):
+    '''
+    :return: the number of OpenGL calls recorded, in total, uploading uniforms and drawing
+    '''
+    names = [name for name, args in gl.calls]
+    return {
+        'gl_calls': len(names),
+        'uniform_calls': sum(1 for name in names if name.startswith('glUniform')),
+        'draw_calls': sum(1 for name in names if name.startswith(('glDraw', 'glMultiDraw'))),
+    }
+
+
+class Context:
+    '''
+    Data shared by the cases: the bunny mesh subdivided to each level, its object files, and the recording stub.
+    '''
+
+    def __init__(self, directory):
+        '''
+        :param directory: directory the object files are written to
+        '''
+        self.directory = directory
+        self.bunny = load_bunny()
+        self.gl = RecordingGL()
+        self.meshes = {}
+
+    def mesh(self, subdivision):
+        '''
+        :return: the bunny mesh with each triangle split into 4 ** subdivision triangles
+        '''
+        if subdivision not in self.meshes:
+            vertices, faces, normals = subdivide_mesh(self.bunny.vertices, self.bunny.faces, self.bunny.normals,
+                                                      subdivision)
+            self.meshes[subdivision] = Mesh(vertices, faces, normals, verbose=False)
+        return self.meshes[subdivision]
+
+    def obj_file(self, subdivision):
+        '''
+        :return: an object file of the subdivided bunny mesh, written once
+        '''
+        file_name = os.path.join(self.directory, 'bunny_{}.obj'.format(subdivision))
+        if not os.path.exists(file_name):
+            write_obj(file_name, self.mesh(subdivision))
+        return file_name
+
+    def scene(self):
+        return StubScene(self.gl, linked_shaders(self.gl))
+
+    def fur(self, scene, density, subdivision=0, length=0.1, angle=False, culling=False, physics=False):
+        '''
+        :return: the fur of the subdivided bunny, generated on the calling thread and never cached
+        '''
+        mesh = self.mesh(subdivision)
+        FurUtils = importlib.import_module('FurUtil').FurUtils
+        return quiet(lambda: FurUtils(BUNNY_POSE, scene, mesh.vertices, mesh.normals, mesh.faces, length, density, angle,
+                                      background=False, seed=SEED, culling=culling, physics=physics,
+                                      cache_bytes=0))()
+
+
+def case_load_obj_file(context, subdivision):
+    '''
+    The line by line object file parser
+    '''
+    file_name = context.obj_file(subdivision)
+
+    def run():
+        meshes = quiet(lambda: load_obj_file(file_name))()
+        return {'faces': sum(mesh.faces.shape[0] for mesh in meshes)}
+    return run
+
+
+def case_parse_obj_file(context, subdivision):
+    '''
+    The bulk object file parser, without the cache of load_obj_file_fast()
+    '''
+    file_name = context.obj_file(subdivision)
+
+    def run():
+        vertices, groups, library_name = parse_obj_file(file_name)
+        return {'faces': sum(faces.shape[0] for material, faces in groups)}
+    return run
+
+
+def case_calculate_normals(context, subdivision, weighting):
+    '''
+    The vertex normals of the mesh, weighted by face area or corner angle
+    '''
+    source = context.mesh(subdivision)
+    mesh = Mesh(source.vertices, source.faces, source.normals, verbose=False)
+
+    def run():
+        mesh.calculate_normals(weighting)
+        return {'vertices': mesh.vertices.shape[0]}
+    return run
+
+
+def case_fur_generate(context, density, subdivision=0):
+    '''
+    Everything done for a new density: the hair roots and endpoints, the clusters and the upload of the hair model
+    '''
+    shaders = linked_shaders(context.gl)
+
+    def run():
+        context.gl.reset()
+        scene = StubScene(context.gl, shaders)
+        fur = context.fur(scene, density, subdivision)
+        counters = dict(strands=int(fur.roots.shape[0]), uploaded_bytes=scene.buffers.stats()['bytes'],
+                        **gl_counters(context.gl))
+        scene.buffers.clear()
+        return counters
+    return run
+
+
+def case_fur_endpoints(context, density, length, angle):
+    '''
+    A change of the fur length or direction, which only moves the hair tips
+    '''
+    scene = context.scene()
+    fur = context.fur(scene, density, length=length, angle=angle)
+
+    def run():
+        context.gl.reset()
+        fur.update_endpoints()
+        return gl_counters(context.gl)
+    return run
+
+
+def case_shaders_bind(context, models, materials):
+    '''
+    The uniforms of a frame of models of different poses and materials, only the ones which changed being sent
+    '''
+    scene = context.scene()
+    poses = [np.matmul(poseMatrix(position=[m, 0, 0]), BUNNY_POSE) for m in range(models)]
+    palette = [Material(name=str(m), Kd=[m / materials] * 3) for m in range(materials)]
+
+    def run():
+        context.gl.reset()
+        scene.begin_frame()
+        for m, M in enumerate(poses):
+            scene.shaders.bind(scene.P, scene.camera.V, M, scene.mode, scene.light, palette[m % materials])
+        return gl_counters(context.gl)
+    return run
+
+
+def case_frame_meshes(context, materials, batched, meshes_per_material=4):
+    '''
+    The draw calls of a frame of the bunny split into parts cycling through materials, drawn with one model per
+    part or with a single batched model
+    '''
+    BatchedModel = importlib.import_module('BatchedModel').BatchedModel
+    mesh = context.mesh(0)
+    palette = [Material(name=str(m), Kd=[m / materials] * 3) for m in range(materials)]
+    parts = []
+    for p, faces in enumerate(np.array_split(mesh.faces, materials * meshes_per_material)):
+        used, faces = np.unique(faces, return_inverse=True)
+        parts.append(Mesh(mesh.vertices[used], faces.reshape(-1, 3).astype(np.uint32), mesh.normals[used],
+                          palette[p % materials], verbose=False))
+
+    scene = context.scene()
+    models = [BatchedModel(scene, parts, M=BUNNY_POSE)] if batched else [BatchedModel(scene, [part], M=BUNNY_POSE) for part in parts]
+    for model in models:
+        model.bind()
+
+    def run():
+        context.gl.reset()
+        scene.begin_frame()
+        for model in models:
+            model.draw(Mp=poseMatrix(), shaders=scene.shaders)
+        return gl_counters(context.gl)
+    return run
+
+
+def case_frame_fur(context, density, culling, physics):
+    '''
+    A frame of the fur: its per frame update (culling, simulation) and its draw calls
+    '''
+    scene = context.scene()
+    fur = context.fur(scene, density, culling=culling, physics=physics)
+
+    def run():
+        context.gl.reset()
+        scene.begin_frame()
+        fur.update()
+        fur.hair_model.draw(Mp=poseMatrix(), shaders=scene.shaders)
+        return dict(culled_fraction=round(float(fur.culled_fraction), 4), **gl_counters(context.gl))
+    return run
+
+
+# name, function and parameters of each case
+CASES = [
+    ('load_obj_file', case_load_obj_file, [{'subdivision': s} for s in (0, 1, 2)]),
+    ('parse_obj_file', case_parse_obj_file, [{'subdivision': s} for s in (0, 1, 2)]),
+    ('calculate_normals', case_calculate_normals,
+     [{'subdivision': s, 'weighting': w} for s in (0, 1, 2) for w in ('area', 'angle')]),
+    ('fur.generate', case_fur_generate,
+     [{'density': d} for d in (1, 2, 3, 4, 5, 6)] + [{'density': 2, 'subdivision': s} for s in (1, 2)]),
+    ('fur.endpoints', case_fur_endpoints,
+     [{'density': 3, 'length': l, 'angle': a} for l in (0.05, 0.2) for a in (False, True)]),
+    ('shaders.bind', case_shaders_bind, [{'models': m, 'materials': 1} for m in (1, 10, 100)] + [{'models': 100, 'materials': 10}]),
+    ('frame.meshes', case_frame_meshes, [{'materials': m, 'batched': b} for m in (1, 10, 100) for b in (False, True)]),
+    ('frame.fur', case_frame_fur, [{'density': 3, 'culling': c, 'physics': False} for c in (False, True)]
+     + [{'density': 3, 'culling': False, 'physics': True}]),
+]
+
+
+def case_id(name, parameters):
+    '''
+    :return: the identifier of a case in the results, eg fur.generate[density=3]
+    '''
+    return '{}[{}]'.format(name, ','.join('{}={}'.format(key, value) for key, value in parameters.items()))
+
+
+def measure(function, repeat=3, min_time=0.05):
+    '''
+    Time a function, the first calls warming it up and giving its counters
+    :param function: the function timed, returning a dictionary of counters
+    :param repeat: number of measurements, the best one being kept
+    :param min_time: the function is called as many times as needed in each measurement to take this long
+    :return: the best time of one call, in seconds, and the counters of one call
+    '''
+    function()
+    start = time.perf_counter()
+    counters = function() or {}
+    number = max(1, math.ceil(min_time / max(time.perf_counter() - start, 1e-9)))
+
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best, counters
+
+
+def git_commit():
+    '''
+    :return: the current commit of the repository, or None outside of a git repository
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_cases(selection=None, repeat=3, min_time=0.05):
+    '''
+    Run the cases, printing each result
+    :param selection: [optional] only run the cases whose identifier contains this text
+    :param repeat: number of measurements of each case
+    :param min_time: minimum duration of each measurement
+    :return: the results, as saved in the JSON file
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        context = Context(directory)
+        modules = [importlib.import_module(name) for name in GL_MODULES]
+        with context.gl.patch(*modules):
+            for name, function, parameter_list in CASES:
+                for parameters in parameter_list:
+                    identifier = case_id(name, parameters)
+                    if selection is not None and selection not in identifier:
+                        continue
+
+                    seconds, counters = measure(function(context, **parameters), repeat, min_time)
+                    results[identifier] = {'name': name, 'parameters': parameters, 'seconds': seconds,
+                                           'counters': counters}
+                    print('{:<60}{:>12.3f} ms  {}'.format(identifier, 1000 * seconds, ' '.join(
+                        '{}={}'.format(key, value) for key, value in counters.items())))
+
+    return {
+        'version': RESULTS_VERSION,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def load_results(file_name):
+    with open(file_name) as results_file:
+        results = json.load(results_file)
+    if results.get('version') != RESULTS_VERSION:
+        raise ValueError('(E) Error: {} holds version {} results, version {} expected'.format(
+            file_name, results.get('version'), RESULTS_VERSION))
+    return results
+
+
+def compare_results(baseline, current, threshold=0.1):
+    '''
+    Compare results with the results of a baseline, printing the change of each case
+    :param baseline: results of the baseline, see run_cases()
+    :param current: results compared to the baseline
+    :param threshold: relative slowdown above which a case regressed, eg 0.1 for 10% slower
+    :return: the list of the identifiers of the cases which regressed: slower than the threshold, or making more
+    OpenGL calls
+    '''
+    print('Comparison with {} ({:.0%} threshold)'.format(baseline.get('commit') or 'the baseline', threshold))
+    print('{:<60}{:>12}{:>12}{:>10}'.format('case', 'base (ms)', 'now (ms)', 'change'))
+
+    regressions = []
+    for identifier, result in current['results'].items():
+        base = baseline['results'].get(identifier)
+        if base is None:
+            print('{:<60}{:>12}{:>12.3f}{:>10}'.format(identifier, '-', 1000 * result['seconds'], 'new'))
+            continue
+
+        change = result['seconds'] / base['seconds'] - 1
+        notes = []
+        if change > threshold:
+            notes.append('slower')
+        for key, value in result['counters'].items():
+            if key.endswith('_calls') and value > base['counters'].get(key, value):
+                notes.append('{} {} -> {}'.format(key, base['counters'][key], value))
+        if notes:
+            regressions.append(identifier)
+
+        print('{:<60}{:>12.3f}{:>12.3f}{:>+10.1%}  {}'.format(
+            identifier, 1000 * base['seconds'], 1000 * result['seconds'], change,
+            'REGRESSION: ' + ', '.join(notes) if notes else ''))
+
+    missing = [identifier for identifier in baseline['results'] if identifier not in current['results']]
+    if missing:
+        print('{} case(s) of the baseline not run'.format(len(missing)))
+
+    print('{} regression(s) in {} case(s)'.format(len(regressions), len(current['results'])))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fur generation, mesh loading and frame submission')
+    parser.add_argument('--output', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with the JSON results of a baseline, '
+                        'exiting with status 1 if any case regressed')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown counted as a regression (default: 0.1)')
+    parser.add_argument('--results', metavar='FILE', help='compare saved results instead of running the cases')
+    parser.add_argument('--filter', metavar='TEXT', help='only run the cases whose identifier contains the text')
+    parser.add_argument('--repeat', type=int, default=3, help='number of measurements of each case (default: 3)')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='minimum duration of each measurement in seconds (default: 0.05)')
+    args = parser.parse_args()
+
+    if args.results is not None:
+        results = load_results(args.results)
+    else:
+        results = run_cases(args.filter, args.repeat, args.min_time)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare is not None and compare_results(load_results(args.compare), results, args.threshold):
+        sys.exit(1)
@@ -1,7 +1,14 @@
+import concurrent.futures
+import mmap
+import os
+import re
+import zipfile
+from multiprocessing import resource_tracker, shared_memory
+
 import numpy as np
 
 from material import Material,MaterialLibrary
-from mesh import Mesh
+from mesh import Mesh, triangulate_polygons
 
 '''
 Functions for reading models from blender. 
@@ -58,8 +65,8 @@ def process_line(line):
 
 	elif fields[0] == 'f':
 		label = 'face'
-		if len(fields) != 4 and len(fields) != 5:
-			print('(E) Error, 3 or 4 entries expected for faces\n{}'.format(line))
+		if len(fields) < 4:
+			print('(E) Error, at least 3 entries expected for faces\n{}'.format(line))
 			return None
 
 
@@ -182,7 +189,7 @@ def load_obj_file(file_name):
 def create_meshes_from_blender( vlist, flist, mlist, library ):
 	fstart = 0
 	material = None
-	meshes = []
+	groups = []
 
 	# we start by putting all vertices in one array
 	varray = np.array(vlist, dtype='f')
@@ -192,34 +199,389 @@ def create_meshes_from_blender( vlist, flist, mlist, library ):
 			material = mlist[f]
 
 		elif material != mlist[f]:  # new mesh is denoted by change in material
-			farray = np.array(flist[fstart:f], dtype=np.uint32)[:, :, 0]
-			vmax = np.max(farray.flatten())
-			vmin = np.min(farray.flatten())-1
-
-			#print('+++ vertices ID in range [{},{}] and vstart={} / vmax={}'.format(np.min(farray.flatten()), np.max(farray.flatten()), vstart, vmax))
-
-			meshes.append(
-				Mesh(
-					vertices=varray[vmin:vmax,:],
-					faces=farray - vmin - 1,
-					material=library.materials[material]
-				)
-			)
+			groups.append((material, triangulate_face_list(flist[fstart:f], varray)))
 
 			# start the next mesh
+			material = mlist[f]
 			fstart = f
 
-	farray = np.array(flist[fstart:], dtype=np.uint32)[:, :, 0]
-	vmax = np.max(farray.flatten())
-	vmin = np.min(farray.flatten())-1
+	groups.append((material, triangulate_face_list(flist[fstart:], varray)))
+
+	return create_meshes(varray, groups, library)
+
+
+def triangulate_face_list(faces, varray):
+	'''
+	Split the faces read by process_line, which may have any number of vertices, into triangles.
+	:param faces: list of faces, each a list of [vertex index, texture index...] entries
+	:param varray: (V, 3) array of all vertices in the file, to split the concave faces (see triangulate_polygons)
+	:return: (T, 3) array of 1-based vertex indices
+	'''
+	sizes = [len(face) for face in faces]
+	indices = np.array([entry[0] for face in faces for entry in face], dtype=np.uint32)
+	return triangulate_polygons(indices - 1, sizes, varray) + 1
 
-	meshes.append(
-		Mesh(
-			vertices=varray[vmin:vmax,:],
-			faces=farray - vmin - 1,
-			material=library.materials[material]
+
+def create_meshes(varray, groups, library, normals=None):
+	'''
+	Create one mesh per group of faces sharing a material.
+	:param varray: (V, 3) array of all vertices in the file
+	:param groups: list of (material index, face array) where the face array holds 1-based vertex indices
+	:param library: the material library
+	:param normals: [optional] list of per-mesh normal arrays, calculated from the faces if not provided
+	:return: the list of meshes
+	'''
+	meshes = []
+
+	for g, (material, farray) in enumerate(groups):
+		# only keep the vertices used by the faces of the mesh, wherever they are in the file
+		used, faces = np.unique(farray, return_inverse=True)
+
+		meshes.append(
+			Mesh(
+				vertices=varray[used - 1],
+				faces=faces.reshape(farray.shape).astype(np.uint32),
+				normals=None if normals is None else normals[g],
+				material=library.materials[material]
+			)
 		)
-	)
 
 	print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
-	return meshes
\ No newline at end of file
+	return meshes
+
+
+# increase when the layout of the mesh cache changes, so that older caches are parsed again
+CACHE_VERSION = 4
+
+# name of the material of the faces without a usemtl line, which cannot be the name of a material in a library
+DEFAULT_MATERIAL = ''
+
+# patterns used to tokenize a whole file at once
+VERTEX_LINE = re.compile(r'^v[ \t]+(.*)$', re.MULTILINE)
+FACE_LINE = re.compile(r'^f[ \t]+(.*)$', re.MULTILINE)
+FACE_ENTRY_SUFFIX = re.compile(r'/\S*')
+MATERIAL_LINE = re.compile(r'^usemtl[ \t]+(\S+).*$', re.MULTILINE)
+LIBRARY_LINE = re.compile(r'^mtllib[ \t]+(\S+)', re.MULTILINE)
+
+
+def parse_obj_chunk(text):
+	'''
+	Tokenize a part of a Blender3D object file in bulk, without going through the lines one by one.
+	Only vertices and faces are read, the faces being split into triangles once the vertices of the whole file
+	are known (see merge_obj_segments).
+	:param text: the text to parse
+	:return: (V, 3) array of vertices, (N,) array of the 1-based vertex indices of all faces, one face after the
+	other, and (F,) array of the number of vertices of each face
+	'''
+	vertices = np.fromstring(' '.join(VERTEX_LINE.findall(text)), dtype='f', sep=' ').reshape(-1, 3)
+
+	face_lines = FACE_LINE.findall(text)
+	if len(face_lines) == 0:
+		return vertices, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+	# only keep the vertex index of each face entry, eg 586/1 -> 586
+	tokens = FACE_ENTRY_SUFFIX.sub('', ' '.join(face_lines))
+	indices = np.fromstring(tokens, dtype=np.int64, sep=' ')
+	sizes = np.array([len(line.split()) for line in face_lines], dtype=np.int64)
+	return vertices, indices, sizes
+
+
+def parse_obj_segments(text):
+	'''
+	Split a part of a Blender3D object file on the material changes and tokenize each segment.
+	:param text: the text to parse
+	:return: list of (material name, vertices, face indices, face sizes) of each segment, see parse_obj_chunk().
+	The material of the first segment is None, as it continues the material of the text before.
+	'''
+	# re.split alternates the text between two materials and the name of the next material
+	chunks = MATERIAL_LINE.split(text)
+	return [(chunks[c - 1] if c > 0 else None,) + parse_obj_chunk(chunks[c]) for c in range(0, len(chunks), 2)]
+
+
+def merge_obj_segments(segments):
+	'''
+	Gather the segments of a whole file, in file order, into the vertices and faces of each mesh, the faces being
+	split into triangles.
+	:param segments: list of (material name, vertices, face indices, face sizes), a material of None continuing
+	the previous one
+	:return: (V, 3) array of vertices and list of (material name, face array)
+	'''
+	vertices = []
+	groups = []
+	material = None
+	for segment_material, segment_vertices, segment_indices, segment_sizes in segments:
+		vertices.append(segment_vertices)
+		if segment_material is not None:
+			material = segment_material
+
+		if segment_sizes.shape[0] == 0:
+			continue
+
+		if len(groups) > 0 and groups[-1][0] == material:
+			# the material did not change, so the faces belong to the same mesh
+			groups[-1][1].append(segment_indices)
+			groups[-1][2].append(segment_sizes)
+		else:
+			groups.append((material, [segment_indices], [segment_sizes]))
+
+	# the concave faces are found from the vertices they use, which may be anywhere before them in the file
+	vertices = np.concatenate(vertices)
+	groups = [(material, triangulate_polygons(np.concatenate(indices) - 1, np.concatenate(sizes), vertices) + 1)
+			  for material, indices, sizes in groups]
+	return vertices, [(material, faces.astype(np.uint32)) for material, faces in groups]
+
+
+def parse_obj_file(file_name):
+	'''
+	Read a whole Blender3D object file at once, splitting it on the material changes.
+	:param file_name: the file to read
+	:return: (V, 3) array of vertices, list of (material name, face array) and the material library file name
+	'''
+	with open(file_name) as objfile:
+		text = objfile.read()
+
+	library = LIBRARY_LINE.search(text)
+	vertices, groups = merge_obj_segments(parse_obj_segments(text))
+	return vertices, groups, None if library is None else library.group(1)
+
+
+def split_on_lines(file_name, parts):
+	'''
+	Split a file into byte ranges of about the same size, each ending at the end of a line.
+	:param file_name: the file to split
+	:param parts: number of ranges
+	:return: list of (start, end) byte offsets, fewer than parts if the file has fewer lines
+	'''
+	size = os.path.getsize(file_name)
+	if size == 0:
+		return []
+
+	bounds = [0]
+	with open(file_name, 'rb') as objfile, mmap.mmap(objfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+		for p in range(1, parts):
+			end = mapped.find(b'\n', max(bounds[-1], p * size // parts))
+			if end == -1 or end + 1 >= size:
+				break
+			bounds.append(end + 1)
+	bounds.append(size)
+
+	return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_obj_range(file_name, start, end):
+	'''
+	Parse a byte range of a Blender3D object file in a worker process. The file is mapped rather than sent to the
+	worker, and the arrays are returned in a shared memory block rather than pickled.
+	:param file_name: the file to parse
+	:param start: offset of the first byte of the range, at the start of a line
+	:param end: offset of the end of the range, at the end of a line
+	:return: the name of the shared memory block holding the vertices, then the face indices, then the face sizes of
+	all segments, the list of (material name, number of vertices, number of face indices, number of faces) of the
+	segments, and the material library file name if found in the range
+	'''
+	with open(file_name, 'rb') as objfile, mmap.mmap(objfile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+		text = mapped[start:end].decode()
+
+	library = LIBRARY_LINE.search(text)
+	segments = parse_obj_segments(text)
+	vertices = np.concatenate([segment[1] for segment in segments]).astype('f')
+	indices = np.concatenate([segment[2] for segment in segments]).astype(np.int64)
+	sizes = np.concatenate([segment[3] for segment in segments]).astype(np.int64)
+
+	block = shared_memory.SharedMemory(create=True, size=max(vertices.nbytes + indices.nbytes + sizes.nbytes, 1))
+	np.ndarray(vertices.shape, dtype='f', buffer=block.buf)[:] = vertices
+	np.ndarray(indices.shape, dtype=np.int64, buffer=block.buf, offset=vertices.nbytes)[:] = indices
+	np.ndarray(sizes.shape, dtype=np.int64, buffer=block.buf, offset=vertices.nbytes + indices.nbytes)[:] = sizes
+	block.close()
+
+	layout = [(material, v.shape[0], i.shape[0], s.shape[0]) for material, v, i, s in segments]
+	return block.name, layout, None if library is None else library.group(1)
+
+
+def receive_obj_range(name, layout):
+	'''
+	Copy the segments returned by parse_obj_range() out of their shared memory block, and free it.
+	:return: list of (material name, vertices, face indices, face sizes) of the segments
+	'''
+	block = shared_memory.SharedMemory(name=name)
+	try:
+		vertex_count = sum(v for m, v, i, f in layout)
+		index_count = sum(i for m, v, i, f in layout)
+		face_count = sum(f for m, v, i, f in layout)
+		vertices = np.ndarray((vertex_count, 3), dtype='f', buffer=block.buf).copy()
+		indices = np.ndarray(index_count, dtype=np.int64, buffer=block.buf, offset=vertices.nbytes).copy()
+		sizes = np.ndarray(face_count, dtype=np.int64, buffer=block.buf, offset=vertices.nbytes + indices.nbytes).copy()
+	finally:
+		block.close()
+		block.unlink()
+
+	vertex_ends = np.cumsum([v for m, v, i, f in layout])
+	index_ends = np.cumsum([i for m, v, i, f in layout])
+	face_ends = np.cumsum([f for m, v, i, f in layout])
+	return [(material, vertices[vertex_end - v:vertex_end], indices[index_end - i:index_end], sizes[face_end - f:face_end])
+			for (material, v, i, f), vertex_end, index_end, face_end in zip(layout, vertex_ends, index_ends, face_ends)]
+
+
+def parse_obj_file_parallel(file_name, workers=None):
+	'''
+	Read a whole Blender3D object file like parse_obj_file(), parsing ranges of lines in a pool of processes.
+	The face indices of the file are global, so the ranges are parsed independently, the faces at the start of
+	a range continuing the material of the range before.
+	Experimental: it has only been checked to give the same result as parse_obj_file(), on a single CPU where the
+	pool only adds overhead. It is not used by main.py until bench_parallel_loading shows a speedup on several cores.
+	:param file_name: the file to read
+	:param workers: number of processes, the number of CPUs by default
+	:return: (V, 3) array of vertices, list of (material name, face array) and the material library file name
+	'''
+	workers = os.cpu_count() if workers is None else workers
+	ranges = split_on_lines(file_name, workers)
+	if len(ranges) < 2:
+		return parse_obj_file(file_name)
+
+	# the workers share the resource tracker of this process, which would otherwise free their blocks on exit
+	resource_tracker.ensure_running()
+
+	with concurrent.futures.ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+		futures = [pool.submit(parse_obj_range, file_name, start, end) for start, end in ranges]
+
+		# all blocks are received, even when a range failed, so that none of them is left allocated
+		segments = []
+		libraries = []
+		errors = []
+		for future in futures:
+			try:
+				name, layout, library = future.result()
+			except Exception as error:
+				errors.append(error)
+				continue
+			segments.extend(receive_obj_range(name, layout))
+			libraries.append(library)
+
+	if len(errors) > 0:
+		raise errors[0]
+
+	vertices, groups = merge_obj_segments(segments)
+	library = next((library for library in libraries if library is not None), None)
+	return vertices, groups, library
+
+
+def load_obj_file_fast(file_name, use_cache=True, optimize=False, workers=1):
+	'''
+	Load a Blender3D object file like load_obj_file, but tokenizing the whole file in bulk. The meshes are
+	saved to a binary cache next to the file (<file>.cache.npz), which is loaded instead of parsing the file
+	as long as the file modification time and size do not change.
+	:param file_name: the file to load
+	:param use_cache: whether to read and write the cache
+	:param optimize: whether to weld the vertices and reorder the faces of the meshes (see Mesh.optimize), the
+	optimised meshes being cached separately (<file>.optimized.cache.npz)
+	:param workers: number of processes parsing the file, None for the number of CPUs. Experimental, see
+	parse_obj_file_parallel; the default parses the file in this process
+	:return: the list of meshes
+	'''
+	cache_name = file_name + ('.optimized' if optimize else '') + '.cache.npz'
+	stat = os.stat(file_name)
+	key = np.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+	if use_cache and os.path.exists(cache_name):
+		meshes = load_mesh_cache(file_name, cache_name, key)
+		if meshes is not None:
+			return meshes
+
+	print('Loading mesh(es) from Blender file: {}'.format(file_name))
+	if workers == 1:
+		varray, groups, library_name = parse_obj_file(file_name)
+	else:
+		varray, groups, library_name = parse_obj_file_parallel(file_name, workers)
+	library = open_material_library(file_name, library_name)
+
+	groups = [(library.names[DEFAULT_MATERIAL if material is None else material], farray) for material, farray in groups]
+	print('File read. Found {} vertices and {} faces.'.format(varray.shape[0], sum(f.shape[0] for m, f in groups)))
+
+	meshes = create_meshes(varray, groups, library)
+
+	if optimize:
+		for mesh in meshes:
+			mesh.optimize()
+
+	if use_cache:
+		save_mesh_cache(cache_name, key, library_name, meshes)
+
+	return meshes
+
+
+def open_material_library(file_name, library_name):
+	'''
+	Load the material library of an object file, with a default material for the faces before any usemtl line.
+	:param file_name: the object file
+	:param library_name: the library file name given by its mtllib line, None if it has none
+	:return: the material library
+	'''
+	if library_name is None:
+		library = MaterialLibrary()
+	else:
+		library = load_material_library(os.path.join(os.path.dirname(file_name), library_name))
+	if DEFAULT_MATERIAL not in library.names:
+		library.add_material(Material(DEFAULT_MATERIAL))
+	return library
+
+
+def save_mesh_cache(cache_name, key, library_name, meshes):
+	'''
+	Save the vertices, faces and normals of the meshes, and the name of their materials, to a binary cache.
+	'''
+	arrays = {
+		'key': key,
+		'library': np.array('' if library_name is None else library_name),
+		'materials': np.array([mesh.material.name for mesh in meshes]),
+	}
+	for m, mesh in enumerate(meshes):
+		arrays['vertices_{}'.format(m)] = mesh.vertices
+		arrays['faces_{}'.format(m)] = mesh.faces
+		arrays['normals_{}'.format(m)] = mesh.normals
+
+	# write to a temporary file first, so that an interrupted save never leaves a broken cache
+	try:
+		with open(cache_name + '.tmp', 'wb') as cachefile:
+			np.savez(cachefile, **arrays)
+		os.replace(cache_name + '.tmp', cache_name)
+	except OSError as error:
+		print('(W) Warning: could not write mesh cache {}: {}'.format(cache_name, error))
+
+
+def load_mesh_cache(file_name, cache_name, key):
+	'''
+	Load the meshes saved by save_mesh_cache.
+	:return: the list of meshes, or None if the cache does not match the key of the file or cannot be read
+	'''
+	try:
+		return read_mesh_cache(file_name, cache_name, key)
+	except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as error:
+		# eg a truncated or corrupted file, parsed again and overwritten
+		print('(W) Warning: could not read mesh cache {}: {}'.format(cache_name, error))
+		return None
+
+
+def read_mesh_cache(file_name, cache_name, key):
+	'''
+	Read the meshes saved by save_mesh_cache, see load_mesh_cache.
+	'''
+	with np.load(cache_name) as cache:
+		if not np.array_equal(cache['key'], key):
+			return None
+
+		print('Loading mesh(es) from cache: {}'.format(cache_name))
+		library_name = str(cache['library'])
+		library = open_material_library(file_name, library_name if library_name != '' else None)
+
+		meshes = []
+		for m, material in enumerate(cache['materials']):
+			meshes.append(
+				Mesh(
+					vertices=cache['vertices_{}'.format(m)],
+					faces=cache['faces_{}'.format(m)],
+					normals=cache['normals_{}'.format(m)],
+					material=library.materials[library.names[str(material)]]
+				)
+			)
+
+	return meshes
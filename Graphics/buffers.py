@@ -0,0 +1,145 @@
+import OpenGL.GL as GL
+from OpenGL.GL import GL_ARRAY_BUFFER, GL_STATIC_DRAW
+
+
+class BufferManager:
+    '''
+    Owns every Vertex Array Object and buffer object created by the models of a scene, so that they can be
+    released as soon as a model is removed instead of leaking on the GPU. Released buffers are kept in a small
+    pool and reused by the next model whose data fits in them.
+    '''
+
+    def __init__(self, gl=GL, max_free=16, max_free_bytes=64 * 1024 * 1024):
+        '''
+        :param gl: the module (or a stub with the same functions) used to issue the OpenGL calls
+        :param max_free: maximum number of released buffers kept for reuse
+        :param max_free_bytes: maximum total size of the released buffers kept for reuse
+        '''
+        self.gl = gl
+        self.max_free = max_free
+        self.max_free_bytes = max_free_bytes
+
+        # objects owned by each model
+        self.vertex_arrays = {}
+        self.buffers = {}
+        self.textures = {}
+
+        # allocated size of every live buffer, and (target, buffer) of the released ones, oldest first
+        self.capacity = {}
+        self.free = []
+
+    def create_vertex_array(self, owner):
+        '''
+        Create a Vertex Array Object owned by a model and bind it.
+        :param owner: the model the VAO belongs to
+        :return: the VAO name
+        '''
+        vao = self.gl.glGenVertexArrays(1)
+        self.vertex_arrays.setdefault(owner, []).append(vao)
+        self.gl.glBindVertexArray(vao)
+        return vao
+
+    def create_buffer(self, owner, data, target=GL_ARRAY_BUFFER, usage=GL_STATIC_DRAW):
+        '''
+        Create a buffer owned by a model, bind it to the target and fill it with the data. A released buffer
+        is reused instead when the data fits in it.
+        :param owner: the model the buffer belongs to
+        :param data: numpy array uploaded to the buffer
+        :param target: the target to bind the buffer to
+        :param usage: the usage hint for a newly allocated buffer
+        :return: the buffer name
+        '''
+        buffer = self.find_free_buffer(target, data.nbytes)
+
+        if buffer is None:
+            buffer = self.gl.glGenBuffers(1)
+            self.gl.glBindBuffer(target, buffer)
+            self.gl.glBufferData(target, data, usage)
+            self.capacity[buffer] = data.nbytes
+        else:
+            # the buffer is large enough, so only its content is replaced
+            self.gl.glBindBuffer(target, buffer)
+            self.gl.glBufferSubData(target, 0, data.nbytes, data)
+
+        self.buffers.setdefault(owner, []).append((target, buffer))
+        return buffer
+
+    def create_texture(self, owner, target):
+        '''
+        Create a texture owned by a model and bind it, its content is uploaded by the model.
+        :param owner: the model the texture belongs to
+        :param target: the target to bind the texture to, eg GL_TEXTURE_3D
+        :return: the texture name
+        '''
+        texture = self.gl.glGenTextures(1)
+        self.textures.setdefault(owner, []).append(texture)
+        self.gl.glBindTexture(target, texture)
+        return texture
+
+    def find_free_buffer(self, target, nbytes):
+        '''
+        Take the smallest released buffer which fits the data out of the pool, unless it would waste more
+        than half of its size.
+        :return: the buffer name, or None if no released buffer fits
+        '''
+        best = None
+        for i, (free_target, buffer) in enumerate(self.free):
+            if free_target == target and nbytes <= self.capacity[buffer] <= 2 * nbytes:
+                if best is None or self.capacity[buffer] < self.capacity[self.free[best][1]]:
+                    best = i
+
+        if best is None:
+            return None
+        return self.free.pop(best)[1]
+
+    def release(self, owner):
+        '''
+        Release all objects owned by a model. The VAOs and textures are deleted and the buffers go back to the pool.
+        :param owner: the model to release
+        '''
+        for vao in self.vertex_arrays.pop(owner, []):
+            self.gl.glDeleteVertexArrays(1, [vao])
+
+        for texture in self.textures.pop(owner, []):
+            self.gl.glDeleteTextures(1, [texture])
+
+        self.free.extend(self.buffers.pop(owner, []))
+        self.trim(self.max_free, self.max_free_bytes)
+
+    def trim(self, max_free=0, max_free_bytes=0):
+        '''
+        Delete the oldest released buffers until the pool is within the given bounds.
+        '''
+        while len(self.free) > max_free or self.free_bytes() > max_free_bytes:
+            target, buffer = self.free.pop(0)
+            self.gl.glDeleteBuffers(1, [buffer])
+            del self.capacity[buffer]
+
+    def clear(self):
+        '''
+        Delete every object created through this manager.
+        '''
+        for owner in list(self.vertex_arrays) + list(self.buffers) + list(self.textures):
+            self.release(owner)
+        self.trim()
+
+    def free_bytes(self):
+        return sum(self.capacity[buffer] for target, buffer in self.free)
+
+    def stats(self):
+        '''
+        :return: a dictionary with the number and size of the live and pooled objects
+        '''
+        live = [buffer for owned in self.buffers.values() for target, buffer in owned]
+        return {
+            'vertex_arrays': sum(len(owned) for owned in self.vertex_arrays.values()),
+            'textures': sum(len(owned) for owned in self.textures.values()),
+            'buffers': len(live),
+            'bytes': sum(self.capacity[buffer] for buffer in live),
+            'free_buffers': len(self.free),
+            'free_bytes': self.free_bytes(),
+        }
+
+    def report(self):
+        print('GPU buffers: {vertex_arrays} VAO(s), {textures} texture(s), {buffers} buffer(s) using {bytes} bytes, '
+              '{free_buffers} pooled buffer(s) using {free_bytes} bytes'.format(**self.stats()))
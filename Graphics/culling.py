@@ -0,0 +1,105 @@
+import numpy as np
+
+
+class StrandClusters:
+    '''
+    Groups the hairs into clusters of nearby hairs growing in similar directions, each bounded by a sphere (holding
+    the roots and the tips) and a cone of root normals, so that the clusters out of the view frustum or on the far
+    side of the model can be skipped each frame. The hair buffers are sorted by cluster, so that the visible clusters
+    are drawn as ranges with a single multi-draw call. Within a cluster, the hairs keep their original order, so
+    that drawing only the first hairs (density or level of detail) still works.
+    '''
+
+    def __init__(self, roots, normals, cells=16):
+        '''
+        :param roots: (N, 3) array of hair roots, in their original order
+        :param normals: (N, 3) array of normals at the roots
+        :param cells: number of grid cells along each axis of the bounding box of the roots
+        '''
+        # grid cell of each root and dominant axis of its normal (+x, -x, +y, -y, +z, -z)
+        low = roots.min(axis=0)
+        size = np.maximum(roots.max(axis=0) - low, 1e-9)
+        cell = np.minimum(((roots - low) / size * cells).astype(int), cells - 1)
+        dominant = np.abs(normals).argmax(axis=1)
+        negative = normals[np.arange(normals.shape[0]), dominant] < 0
+        keys = ((cell[:, 0] * cells + cell[:, 1]) * cells + cell[:, 2]) * 6 + 2 * dominant + negative
+
+        # position of each hair in the sorted buffers, by cluster then by original order
+        self.order = np.lexsort((np.arange(roots.shape[0]), keys))
+        sorted_keys, self.starts, self.sizes = np.unique(keys[self.order], return_index=True, return_counts=True)
+        self.cluster = np.repeat(np.arange(self.sizes.shape[0]), self.sizes)
+
+        sorted_roots = roots[self.order]
+        sorted_normals = normals[self.order]
+        sizes = self.sizes[:, np.newaxis]
+
+        # bounding sphere of the roots, the fur length being added when testing
+        self.centers = np.add.reduceat(sorted_roots, self.starts, axis=0) / sizes
+        distances = np.linalg.norm(sorted_roots - self.centers[self.cluster], axis=1)
+        self.radii = np.maximum.reduceat(distances, self.starts)
+
+        # cone of the normals: mean direction, and sine of the widest angle to it (infinite past 90 degrees)
+        axes = np.add.reduceat(sorted_normals, self.starts, axis=0) / sizes
+        self.axes = axes / np.maximum(np.linalg.norm(axes, axis=1, keepdims=True), 1e-9)
+        lengths = np.maximum(np.linalg.norm(sorted_normals, axis=1), 1e-9)
+        cosines = np.minimum.reduceat(np.sum(sorted_normals * self.axes[self.cluster], axis=1) / lengths, self.starts)
+        self.cutoffs = np.where(cosines > 0, np.sqrt(np.maximum(1 - cosines ** 2, 0)), np.inf)
+
+        # number of hairs of each cluster among the first hairs, by number of first hairs
+        self.prefix_counts = {}
+
+    def visible(self, P, V, M, fur_length, cones=True):
+        '''
+        :param P: projection matrix
+        :param V: view matrix
+        :param M: model matrix
+        :param fur_length: length of the longest hairs, added to the bounding spheres
+        :param cones: whether to cull the clusters facing away from the camera, only valid when the hairs grow along
+        their root normals
+        :return: (C,) boolean array of the clusters which may be visible
+        '''
+        radii = self.radii + fur_length
+        centers = np.hstack((self.centers, np.ones((self.centers.shape[0], 1))))
+
+        # frustum planes, pointing inwards, from the rows of the projection-view-model matrix
+        PVM = np.matmul(P, np.matmul(V, M))
+        planes = np.array([PVM[3] + PVM[0], PVM[3] - PVM[0], PVM[3] + PVM[1], PVM[3] - PVM[1], PVM[3] + PVM[2], PVM[3] - PVM[2]])
+        planes /= np.linalg.norm(planes[:, :3], axis=1, keepdims=True)
+        visible = np.all(np.matmul(centers, planes.T) >= -radii[:, np.newaxis], axis=1)
+
+        if cones:
+            # the whole sphere is behind the surface the normals of the cluster describe
+            camera = np.matmul(np.linalg.inv(np.matmul(V, M)), [0., 0., 0., 1.])[:3]
+            to_center = self.centers - camera
+            distances = np.linalg.norm(to_center, axis=1)
+            back_facing = np.sum(to_center * self.axes, axis=1) >= self.cutoffs * distances + radii
+            visible &= ~back_facing
+
+        return visible
+
+    def counts(self, strands):
+        '''
+        :param strands: number of hairs drawn, the first ones in the original order
+        :return: (C,) array of the number of these hairs in each cluster
+        '''
+        if strands not in self.prefix_counts:
+            self.prefix_counts[strands] = np.bincount(self.cluster[self.order < strands], minlength=self.sizes.shape[0])
+        return self.prefix_counts[strands]
+
+    def ranges(self, visible, strands):
+        '''
+        :param visible: (C,) boolean array of the clusters to draw
+        :param strands: number of hairs drawn, the first ones in the original order
+        :return: (firsts, counts) arrays of the ranges of the sorted buffers to draw, consecutive ranges being merged
+        '''
+        counts = self.counts(strands)
+        drawn = visible & (counts > 0)
+        firsts = self.starts[drawn]
+        counts = counts[drawn]
+
+        # a range continues the previous one when the previous cluster is drawn entirely
+        continued = np.zeros(firsts.shape[0], dtype=bool)
+        continued[1:] = firsts[:-1] + counts[:-1] == firsts[1:]
+        merged = np.zeros(np.count_nonzero(~continued), dtype=np.int32)
+        np.add.at(merged, np.cumsum(~continued) - 1, counts)
+        return firsts[~continued], merged
@@ -0,0 +1,155 @@
+import contextlib
+import importlib
+import io
+
+import numpy as np
+
+from blender import load_obj_file
+from camera import Camera
+from lightSource import LightSource
+from buffers import BufferManager
+from profiler import NullProfiler
+from matutils import frustumMatrix, poseMatrix, rotationMatrixY
+
+# modules importing the OpenGL functions whose calls are recorded instead of issued
+GL_MODULES = ('BaseModel', 'BatchedModel', 'HairModel', 'shaders', 'FurUtil')
+
+# pose of the bunny in main.py
+BUNNY_POSE = np.matmul(rotationMatrixY(90), poseMatrix())
+
+
+class RecordingGL:
+    '''
+    Stand-in for the OpenGL module which records every call instead of issuing it, so that the code managing
+    GPU objects can be run and checked without a window or a GPU. Object names are handed out in sequence.
+    '''
+
+    def __init__(self):
+        # list of (function name, arguments) in call order
+        self.calls = []
+        self.last_name = 0
+
+    def __getattr__(self, name):
+        if not name.startswith('gl'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args + tuple(kwargs.values())))
+            if name.startswith('glGen') or name.startswith('glCreate'):
+                self.last_name += 1
+                return self.last_name
+            return None
+
+        return record
+
+    def count(self, name=None):
+        '''
+        :param name: [optional] the function to count the calls of
+        :return: the number of recorded calls
+        '''
+        if name is None:
+            return len(self.calls)
+        return sum(1 for call in self.calls if call[0] == name)
+
+    def reset(self):
+        self.calls = []
+
+    @contextlib.contextmanager
+    def patch(self, *modules):
+        '''
+        Record the OpenGL calls of modules importing the functions with 'from OpenGL.GL import *', by replacing
+        their functions with recording ones until the end of the with block.
+        :param modules: the modules whose OpenGL functions are replaced
+        :return: this stub, as the value of the with statement
+        '''
+        replaced = []
+        for module in modules:
+            for name, function in list(vars(module).items()):
+                if name.startswith('gl') and callable(function):
+                    replaced.append((module, name, function))
+                    setattr(module, name, getattr(self, name))
+        try:
+            yield self
+        finally:
+            for module, name, function in replaced:
+                setattr(module, name, function)
+
+
+def link_program(program, gl):
+    '''
+    Link the uniforms of a program to a program name from the stub instead of compiling it
+    :param program: the shaders to link
+    :param gl: the recording stub, patched into the shaders module
+    :return: the program
+    '''
+    program.program = gl.glCreateProgram()
+    for uniform in program.uniforms.values():
+        uniform.link(program.program)
+    return program
+
+
+def linked_shaders(gl):
+    '''
+    :param gl: the recording stub, patched into the shaders module
+    :return: shaders whose uniforms are linked to a program name from the stub, without compiling them
+    '''
+    return link_program(importlib.import_module('shaders').Shaders(), gl)
+
+
+class StubScene:
+    '''
+    The parts of the scene used by the models and the fur, without a window: the buffers are created through the
+    recording stub and the program of the shaders is never compiled.
+    '''
+
+    def __init__(self, gl, shaders, width=1250, height=800):
+        '''
+        :param gl: the recording stub issuing the OpenGL calls of the buffer manager
+        :param shaders: the shaders drawing the models, see linked_shaders()
+        '''
+        self.window_size = (width, height)
+        self.P = frustumMatrix(-1.0, 1.0, -1.0, 1.0, 1.5, 20)
+        self.camera = Camera(self.window_size)
+        self.light = LightSource(self, position=[-2.5, 5., 0.])
+        self.mode = 6
+        self.models = []
+        self.buffers = BufferManager(gl=gl)
+        self.shaders = shaders
+        self.fur_model = None
+        self.profiler = NullProfiler()
+
+        # number of frames drawn, the camera alternating between two views
+        self.frame = 0
+
+    def add_model(self, model):
+        self.models.append(model)
+
+    def remove_model(self, model):
+        self.models.remove(model)
+        model.release()
+
+    def begin_frame(self):
+        '''
+        Move the camera to the next view and calculate the view dependent uniforms, as Scene.draw() does
+        '''
+        self.frame += 1
+        self.camera.phi = 0.5 * (self.frame % 2)
+        self.camera.update()
+        self.shaders.begin_frame(self.P, self.camera.V, self.light)
+
+
+def quiet(function):
+    '''
+    Wrap a function so that it runs without printing its output.
+    '''
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function()
+    return run
+
+
+def load_bunny():
+    '''
+    Load the bunny mesh used by main.py, without the loader output.
+    '''
+    return quiet(lambda: load_obj_file('models/bunny_world.obj')[0])()
@@ -0,0 +1,151 @@
+'''
+Offscreen OpenGL rendering, used by the scene to render without a window (on machines without a display or GPU).
+
+PyOpenGL picks the platform it loads the OpenGL functions from when it is first imported, so the offscreen
+platform must be selected before any module imports OpenGL, by setting the environment variable
+PYOPENGL_PLATFORM to 'egl' (EGL pbuffer, hardware or Mesa llvmpipe) or 'osmesa' (Mesa software rendering).
+main.py does it for the --headless option.
+'''
+import ctypes
+import os
+
+import numpy as np
+
+from OpenGL.GL import *
+
+
+BACKENDS = ('egl', 'osmesa')
+
+
+def selected_backend():
+    '''
+    :return: the offscreen platform selected for PyOpenGL
+    '''
+    backend = os.environ.get('PYOPENGL_PLATFORM', '').lower()
+    if backend not in BACKENDS:
+        raise RuntimeError('(E) Error: headless rendering needs PYOPENGL_PLATFORM to be set to one of {} before '
+                           'OpenGL is imported, found "{}"'.format(', '.join(BACKENDS), backend))
+    return backend
+
+
+def create_context(width, height):
+    '''
+    Create an offscreen OpenGL context using the selected platform and make it current.
+    '''
+    if selected_backend() == 'egl':
+        return EGLContext(width, height)
+    return OSMesaContext(width, height)
+
+
+class EGLContext:
+    '''
+    OpenGL context rendering to an EGL pbuffer surface.
+    '''
+
+    def __init__(self, width, height):
+        from OpenGL import EGL
+
+        self.EGL = EGL
+
+        # without a display server, ask Mesa for its surfaceless platform, the scene draws into a framebuffer object
+        if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+            os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError('(E) Error: could not initialise the EGL display')
+
+        config_attributes = np.array([
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_GREEN_SIZE, 8,
+            EGL.EGL_BLUE_SIZE, 8,
+            EGL.EGL_DEPTH_SIZE, 24,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE,
+        ], dtype=np.int32)
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        EGL.eglChooseConfig(self.display, config_attributes, ctypes.pointer(config), 1, ctypes.pointer(count))
+        if count.value == 0:
+            raise RuntimeError('(E) Error: no EGL configuration supports offscreen OpenGL rendering')
+
+        surface_attributes = np.array([EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE], dtype=np.int32)
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config, surface_attributes)
+
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise RuntimeError('(E) Error: could not make the EGL context current')
+
+    def release(self):
+        EGL = self.EGL
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglTerminate(self.display)
+
+
+class OSMesaContext:
+    '''
+    OpenGL context rendered in software by Mesa into a memory buffer.
+    '''
+
+    def __init__(self, width, height):
+        from OpenGL import osmesa
+
+        self.osmesa = osmesa
+        self.context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self.context:
+            raise RuntimeError('(E) Error: could not create the OSMesa context')
+
+        self.buffer = np.zeros((height, width, 4), dtype=np.uint8)
+        if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, GL_UNSIGNED_BYTE, width, height):
+            raise RuntimeError('(E) Error: could not make the OSMesa context current')
+
+    def release(self):
+        self.osmesa.OSMesaDestroyContext(self.context)
+
+
+class Framebuffer:
+    '''
+    Framebuffer object with colour and depth renderbuffers, the scene is drawn into it instead of a window.
+    '''
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+
+        self.fbo = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+
+        self.color = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.color)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.color)
+
+        self.depth = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_ATTACHMENT, GL_RENDERBUFFER, self.depth)
+
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError('(E) Error: incomplete offscreen framebuffer (status {})'.format(status))
+
+    def read_pixels(self):
+        '''
+        :return: (height, width, 3) uint8 array of the rendered image, first row at the top
+        '''
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, self.width, self.height, GL_RGB, GL_UNSIGNED_BYTE)
+        image = np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 3)
+
+        # OpenGL stores the bottom row first
+        return image[::-1].copy()
+
+    def release(self):
+        glDeleteRenderbuffers(2, [self.color, self.depth])
+        glDeleteFramebuffers(1, [self.fbo])
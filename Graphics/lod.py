@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class FurLOD:
+    '''
+    Level of detail of the fur, chosen from the size of the model on screen. Each level halves the number of hairs
+    drawn, the hair buffers being ordered so that their first hairs cover the whole model. The level only changes
+    once the model size moved past the middle of two levels by a margin, so that it does not switch back and forth
+    while zooming around that size.
+    '''
+
+    def __init__(self, center, radius, hysteresis=0.25, min_fraction=1 / 64, reference_size=None):
+        '''
+        :param center: centre of the bounding sphere of the model, in model coordinates
+        :param radius: radius of the bounding sphere of the model
+        :param hysteresis: margin, in levels, past the middle of two levels before switching
+        :param min_fraction: smallest fraction of the hairs drawn
+        :param reference_size: [optional] projected radius in pixels at which every hair is drawn, the size of the
+        model in the first view by default
+        '''
+        self.center = np.append(np.asarray(center, dtype=float), 1.0)
+        self.radius = radius
+        self.hysteresis = hysteresis
+        self.max_level = int(round(-np.log2(min_fraction)))
+        self.reference_size = reference_size
+
+        self.level = 0
+        self.fraction = 1.0
+
+    def projected_size(self, P, V, M, height):
+        '''
+        :param P: projection matrix
+        :param V: view matrix
+        :param M: model matrix
+        :param height: height of the viewport in pixels
+        :return: the radius of the bounding sphere on screen, in pixels
+        '''
+        center = np.matmul(np.matmul(V, M), self.center)
+        depth = -center[2]
+
+        # scale the radius by the largest scaling of the model matrix
+        radius = self.radius * np.linalg.norm(M[:3, :3], axis=0).max()
+        if depth <= radius:
+            # the camera is within the model
+            return np.inf
+        return abs(P[1, 1]) * radius / depth * height / 2
+
+    def update(self, P, V, M, height):
+        '''
+        Choose the level for the current view
+        :return: True if the level changed
+        '''
+        size = self.projected_size(P, V, M, height)
+        if self.reference_size is None:
+            self.reference_size = size
+
+        # the hairs cover the projected area of the model, so their number follows the square of its size
+        target = np.clip(2 * np.log2(self.reference_size / size), 0, self.max_level)
+        if abs(target - self.level) <= 0.5 + self.hysteresis:
+            return False
+
+        self.level = int(round(target))
+        self.fraction = 0.5 ** self.level
+        return True
+
+    def strands(self, count):
+        '''
+        :param count: number of hairs at full detail
+        :return: number of hairs drawn at the current level
+        '''
+        return max(1, int(round(count * self.fraction)))
+
+    def shells(self, count):
+        '''
+        :param count: number of shells at full detail
+        :return: number of shells drawn at the current level, following the size of the model on screen
+        '''
+        return max(1, int(round(count * np.sqrt(self.fraction))))
+
+
+def bounding_sphere(vertices):
+    '''
+    :param vertices: (V, 3) array of vertices
+    :return: centre and radius of a sphere containing all vertices, centred on their bounding box
+    '''
+    center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+    return center, np.linalg.norm(vertices - center, axis=1).max()
@@ -1,86 +1,96 @@
 # Main program file used to run the scene
 
 # Import needed modules
+import argparse
+import os
+import sys
+
+# PyOpenGL chooses its platform when first imported, so headless rendering selects an offscreen one before the
+# scene is imported (set PYOPENGL_PLATFORM=osmesa to use Mesa software rendering instead of EGL)
+if __name__ == '__main__' and any(arg.startswith('--headless') for arg in sys.argv):
+	os.environ.setdefault('PYOPENGL_PLATFORM', 'egl')
+
 from scene import Scene
-from blender import load_obj_file, Mesh
+from blender import load_obj_file_fast, Mesh
 from BaseModel import *
+from BatchedModel import BatchedModel
 from FurUtil import FurUtils
+from ShellFur import ShellFurUtils
 
 
-class DrawModelFromMesh(BaseModel):
-	'''
-	Base class for all models, inherit from this to create new models
-	'''
-
-	def __init__(self, scene, M, mesh):
-		'''
-		Initialises the model data
-			:param scene: scene to which model will be viewed
-		'''
-
-		BaseModel.__init__(self, scene=scene, M=M),
-
-
-		# initialises the vertices of the shape
-		self.vertices = mesh.vertices
-		self.indices = mesh.faces
-
-		if self.indices.shape[1] == 3:
-			self.primitive = GL_TRIANGLES
-
-		elif self.indices.shape[1] == 4:
-			self.primitive = GL_QUADS
-
-		else:
-			print('(E) Error: Mesh should have 3 or 4 vertices per face!')
-
-		# initialise the normals per vertex
-		self.normals = mesh.normals
-
-		# and save the material information
-		self.material = mesh.material
-
-		# we force a bit of specularity to make it more visible
-		self.material.Ns = 15.0
-
-		# and we check which primitives we need to use for drawing
-		if self.indices.shape[1] == 3:
-			self.primitive = GL_TRIANGLES
-
-		elif self.indices.shape[1] == 4:
-			self.primitive = GL_QUADS
-
-		else:
-			print('(E) Error in DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found {}!'.format(self.indices.shape[1]))
-			raise
-
-		# default vertex colors to one (white)
-		self.vertex_colors = np.ones((self.vertices.shape[0], 3), dtype='f')
-
-		if self.normals is None:
-			print('(W) No normal array was provided.')
-			print('--> setting to zero.')
-			self.normals = np.zeros(self.vertices.shape, dtype='f')
-
-		# and bind the data to a vertex array
-		self.bind()
-				
-		
 if __name__ == '__main__':
 
+	# Command line options
+	parser = argparse.ArgumentParser(description='Fur rendering on the bunny model')
+	parser.add_argument('--profile', nargs='?', const='', default=None, metavar='TRACE_FILE',
+		help='record frame timings, report them on exit and optionally export them (.csv or Chrome trace .json)')
+	parser.add_argument('--headless', type=int, default=None, metavar='FRAMES',
+		help='render a number of frames offscreen, turning around the model, instead of opening a window')
+	parser.add_argument('--output', default='frames.npy',
+		help='file the headless frames are saved to, as a (frames, height, width, 3) array')
+	parser.add_argument('--sampling', choices=('subdivide', 'area', 'progressive'), default='subdivide',
+		help='grow the hairs on the subdivided faces, spread them over the surface in proportion to the face areas, or draw more or fewer hairs of an area sampled pool as the density changes')
+	parser.add_argument('--seed', type=int, default=None,
+		help='seed of the random hairs (or of the shell fur texture), to get the same hairs on every run')
+	parser.add_argument('--lod', action='store_true',
+		help='draw fewer hairs (or shells) as the bunny gets smaller on screen')
+	parser.add_argument('--culling', action='store_true',
+		help='skip drawing the clusters of hairs out of view or on the far side of the bunny')
+	parser.add_argument('--packed', action='store_true',
+		help='store the vertices of the bunny and of the hairs in a compact interleaved format')
+	parser.add_argument('--instanced', action='store_true',
+		help='upload only the hair roots and expand them into lines on the GPU, so that changing the fur length or direction uploads nothing')
+	parser.add_argument('--physics', type=int, nargs='?', const=4, default=None, metavar='SEGMENTS',
+		help='simulate the hairs as strands of a number of segments (4 by default) falling under gravity')
+	parser.add_argument('--groom', default=None, metavar='STRAND_FILE',
+		help='load the hairs from a strand file if it exists, otherwise save the generated hairs to it')
+	parser.add_argument('--shells', type=int, default=None, metavar='COUNT',
+		help='draw the fur as a number of textured shells instead of one line per strand')
+	parser.add_argument('--optimize', action='store_true',
+		help='weld the vertices of the bunny and reorder its faces for the vertex cache, the first load being slower')
+	args = parser.parse_args()
+
 	# Create the scene object
-	scene = Scene()
+	scene = Scene(profile=args.profile is not None, trace_file=args.profile or None, headless=args.headless is not None)
 
 	# Load in the model
-	meshes = load_obj_file('models/bunny_world.obj')
+	meshes = load_obj_file_fast('models/bunny_world.obj', optimize=args.optimize)
 	
-    # Add the main bunny model to be displayed
-	scene.add_models_list(
-			[DrawModelFromMesh(scene=scene, M=np.matmul(rotationMatrixY(90), poseMatrix()), mesh=mesh) for mesh in meshes]
-        )
+	# Add the main bunny model to be displayed, all its meshes sharing the same buffers
+	for mesh in meshes:
+		# we force a bit of specularity to make it more visible
+		mesh.material.Ns = 15.0
+	bunny = BatchedModel(scene=scene, meshes=meshes, M=np.matmul(rotationMatrixY(90), poseMatrix()), packed=args.packed)
+	bunny.bind()
+	scene.add_model(bunny)
 
 	# Create the fur model for the object
-	fur_model = FurUtils(np.matmul(rotationMatrixY(90), poseMatrix()), scene, meshes[0].vertices, meshes[0].normals, meshes[0].faces, 0.1, 3, False)
-
-	# starts drawing the scene
-	scene.run()
+	if args.shells is not None:
+		fur_model = ShellFurUtils(np.matmul(rotationMatrixY(90), poseMatrix()), scene, meshes[0].vertices, meshes[0].normals, meshes[0].faces, 0.1, 3, False, shell_count=args.shells, lod=args.lod, seed=args.seed)
+	else:
+		# a saved groom is loaded instead of generating the hairs
+		groom = args.groom if args.groom is not None and os.path.exists(args.groom) else None
+		fur_model = FurUtils(np.matmul(rotationMatrixY(90), poseMatrix()), scene, meshes[0].vertices, meshes[0].normals, meshes[0].faces, 0.1, 3, False, sampling=args.sampling, seed=args.seed, lod=args.lod, culling=args.culling, packed=args.packed, instanced=args.instanced, physics=args.physics is not None, segments=args.physics or 4, strands=groom)
+		if args.groom is not None and not fur_model.loaded_strands:
+			# the file is written again when it could not be loaded, eg when truncated or saved for another mesh
+			fur_model.save_strands(args.groom)
+			print('Saved the hairs to {}'.format(args.groom))
+
+	if args.headless is not None:
+		# draw the frames offscreen and save them
+		def turn_camera(scene, frame):
+			scene.camera.phi = 2 * np.pi * frame / args.headless
+
+		frames = scene.render_frames(args.headless, update=turn_camera)
+		np.save(args.output, np.array(frames))
+		print('Saved {} frame(s) to {}'.format(len(frames), args.output))
+
+		if args.profile is not None:
+			scene.profiler.report()
+			if args.profile:
+				scene.profiler.export(args.profile)
+		scene.close()
+	else:
+		# starts drawing the scene, then releases the hairs and the GPU buffers once the window is closed
+		scene.run()
+		scene.close()
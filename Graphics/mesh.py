@@ -1,3 +1,5 @@
+import collections
+
 from material import Material
 import numpy as np
 
@@ -6,22 +8,34 @@ class Mesh:
     Simple class to hold a mesh data. For now we will only focus on vertices, faces (indices of vertices for each face)
     and normals.
     '''
-    def __init__(self, vertices, faces=None, normals=None, material=Material()):
+    def __init__(self, vertices, faces=None, normals=None, material=Material(), verbose=True, triangulate=True):
         '''
         Initialises a mesh object.
         :param vertices: A numpy array containing all vertices
-        :param faces: [optional] An int array containing the vertex indices for all faces.
+        :param faces: [optional] An int array containing the vertex indices for all faces, split into triangles if
+        they have more than 3 vertices.
         :param normals: [optional] An array of normal vectors, calculated from the faces if not provided.
         :param material: [optional] An object containing the material information for this object
+        :param verbose: [optional] whether to print a summary of the mesh
+        :param triangulate: [optional] whether to split the faces into triangles, False to keep the faces as given, eg
+        for the fur which grows on the original quads
         '''
         self.vertices = vertices
-        self.faces = faces
         self.material = material
 
-        print('Creating mesh')
-        print('- {} vertices, {} faces'.format(self.vertices.shape[0], self.faces.shape[0]))
-        print('- {} vertices per face'.format(self.faces.shape[1]))
-        print('- vertices ID in range [{},{}]'.format(np.min(self.faces.flatten()), np.max(self.faces.flatten())))
+        # per face data, by name, with the arrays it was calculated from (see cached_face_data)
+        self.face_cache = {}
+
+        # quads and other polygons are split into triangles once, so that all meshes are drawn as indexed triangles
+        if triangulate and faces is not None and faces.shape[1] > 3:
+            faces = triangulate_faces(faces, vertices)
+        self.faces = faces
+
+        if verbose:
+            print('Creating mesh')
+            print('- {} vertices, {} faces'.format(self.vertices.shape[0], self.faces.shape[0]))
+            print('- {} vertices per face'.format(self.faces.shape[1]))
+            print('- vertices ID in range [{},{}]'.format(np.min(self.faces.flatten()), np.max(self.faces.flatten())))
 
         if normals is None:
             if faces is None:
@@ -31,26 +45,466 @@ class Mesh:
         else:
             self.normals = normals
 
-    def calculate_normals(self):
+    def cached_face_data(self, name, sources, calculate):
+        '''
+        Calculate per face data once, and again only when the arrays it comes from are replaced, as done by
+        optimize() or calculate_normals(). Call invalidate() after changing these arrays in place.
+        :param name: name of the data
+        :param sources: tuple of the arrays the data is calculated from
+        :param calculate: function calculating the data
+        :return: the data
+        '''
+        entry = self.face_cache.get(name)
+        if entry is None or any(cached is not source for cached, source in zip(entry[0], sources)):
+            entry = (sources, calculate())
+            self.face_cache[name] = entry
+        return entry[1]
+
+    def invalidate(self):
+        '''
+        Forget the per face data, after the vertices, faces or normals were changed in place.
+        '''
+        self.face_cache = {}
+
+    def face_positions(self):
+        '''
+        :return: (F, K, 3) array of the position of each corner of each face
+        '''
+        return self.cached_face_data('positions', (self.vertices, self.faces), lambda: self.vertices[self.faces])
+
+    def face_normals(self):
+        '''
+        :return: (F, K, 3) array of the vertex normal at each corner of each face
+        '''
+        return self.cached_face_data('normals', (self.normals, self.faces), lambda: self.normals[self.faces])
+
+    def face_areas(self):
+        '''
+        :return: (F,) array of the area of each face, the sum of its triangles for polygons
+        '''
+        def calculate():
+            areas = triangle_areas(self.vertices[triangulate_faces(self.faces)])
+            return areas.reshape(self.faces.shape[0], -1).sum(axis=1)
+
+        return self.cached_face_data('areas', (self.vertices, self.faces), calculate)
+
+    def optimize(self, tolerance=1e-6, cache_size=16):
+        '''
+        Prepare the mesh for indexed drawing: weld the duplicate vertices, drop the unreferenced ones and reorder the
+        faces for the post-transform vertex cache. The normals are calculated again from the welded faces.
+        :param tolerance: distance under which vertices are merged
+        :param cache_size: number of vertices in the post-transform cache the faces are ordered for
+        :return: the average cache miss ratio before and after
+        '''
+        before = acmr(self.faces, cache_size)
+        vertex_count = self.vertices.shape[0]
+
+        self.vertices, self.faces = weld_vertices(self.vertices, self.faces, tolerance)
+        self.faces = tipsify(self.faces, self.vertices.shape[0], cache_size)
+        self.vertices, self.faces = remove_unreferenced(self.vertices, self.faces)
+        self.faces = self.faces.astype(np.uint32)
+        self.calculate_normals()
+
+        after = acmr(self.faces, cache_size)
+        print('Optimised mesh: {} -> {} vertices, ACMR {:.3f} -> {:.3f}'.format(vertex_count, self.vertices.shape[0], before, after))
+        return before, after
+
+    def calculate_normals(self, weighting='area'):
         '''
         method to calculate normals from the mesh faces.
         Use the approach discussed in class:
         1. calculate normal for each face using cross product
         2. set each vertex normal as the average of the normals over all faces it belongs to.
+        All faces are processed at once, quads being split in two triangles.
+        :param weighting: 'area' to weight each face normal by the face area, 'angle' to weight it by the
+        angle of the face at the vertex
         '''
 
+        triangles = triangulate_faces(self.faces)
+        corners = self.face_positions() if self.faces.shape[1] == 3 else self.vertices[triangles]
+
+        # first calculate the normal of every triangle using the cross product of its sides,
+        # its length is twice the area of the triangle
+        face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+
+        if weighting == 'area':
+            weights = np.ones(triangles.shape, dtype='f')
+        elif weighting == 'angle':
+            face_normals = normalize(face_normals)
+            weights = corner_angles(corners)
+        else:
+            raise ValueError('(E) Error in Mesh.calculate_normals(): unknown weighting {}'.format(weighting))
+
+        # blend the normal of each face on its 3 vertices
         self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
+        np.add.at(self.normals, triangles.flatten(), (face_normals[:, np.newaxis, :] * weights[:, :, np.newaxis]).reshape(-1, 3))
+
+        # finally we need to normalise the vectors, leaving the normals of degenerate faces to zero
+        self.normals = normalize(self.normals).astype('f')
+
+
+# offsets of the cells around a cell of a 3D grid
+NEIGHBOUR_CELLS = np.array([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1) if (x, y, z) != (0, 0, 0)])
+
+
+def weld_vertices(vertices, faces, tolerance=1e-6):
+    '''
+    Merge the vertices closer than the tolerance, and drop the faces which become degenerate (with the same vertex
+    twice). The vertices are gathered into the cells of a grid of the tolerance size, the vertices of a cell being
+    merged, and the cells are merged with the neighbouring cells holding a vertex closer than the tolerance, so that
+    close vertices on both sides of a cell boundary are merged too.
+    :param vertices: (V, 3) array of vertices
+    :param faces: (F, K) array of vertex indices
+    :param tolerance: distance under which vertices are merged
+    :return: (W, 3) array of vertices and (F', K) array of faces
+    '''
+    keys = np.floor(vertices / tolerance).astype(np.int64)
+
+    # each coordinate of a cell is replaced by its rank among the ones of the vertices, and the first two by the
+    # rank of the pair, so that the code of a cell does not overflow whatever the extent of the grid
+    values = [np.unique(keys[:, axis]) for axis in range(3)]
+    ranks = [np.searchsorted(values[axis], keys[:, axis]) for axis in range(3)]
+    pairs, pair = np.unique(ranks[0] * values[1].shape[0] + ranks[1], return_inverse=True)
+    codes = pair.reshape(-1) * values[2].shape[0] + ranks[2]
+
+    # the vertices are sorted by cell, so that the codes of their neighbouring cells are sorted too, which keeps the
+    # searches below fast
+    order = np.argsort(codes, kind='stable')
+    keys, codes = keys[order], codes[order]
+    ranks = [rank[order] for rank in ranks]
+    cells, first, cell = np.unique(codes, return_index=True, return_inverse=True)
+    cell = cell.reshape(-1)
+
+    # link each vertex to the neighbouring cells whose first vertex is within the tolerance
+    linked = []
+    for offset in NEIGHBOUR_CELLS:
+        valid = np.ones(keys.shape[0], dtype=bool)
+        neighbour_ranks = []
+        for axis in range(3):
+            rank = np.clip(ranks[axis] + offset[axis], 0, values[axis].shape[0] - 1)
+            valid &= values[axis][rank] == keys[:, axis] + offset[axis]
+            neighbour_ranks.append(rank)
+
+        neighbour_pairs = neighbour_ranks[0] * values[1].shape[0] + neighbour_ranks[1]
+        neighbour_pair = np.minimum(np.searchsorted(pairs, neighbour_pairs), pairs.shape[0] - 1)
+        valid &= pairs[neighbour_pair] == neighbour_pairs
+
+        neighbour_codes = neighbour_pair * values[2].shape[0] + neighbour_ranks[2]
+        found = np.minimum(np.searchsorted(cells, neighbour_codes), cells.shape[0] - 1)
+        close = valid & (cells[found] == neighbour_codes)
+        close[close] = np.linalg.norm(vertices[order[first[found[close]]]] - vertices[order[close]], axis=1) < tolerance
+        linked.append(np.stack((cell[close], found[close]), axis=1))
+    linked = np.concatenate(linked)
+
+    # linked cells share the smallest label of their group, propagated until no label changes
+    labels = np.arange(cells.shape[0])
+    while linked.shape[0] > 0:
+        smallest = np.minimum(labels[linked[:, 0]], labels[linked[:, 1]])
+        previous = labels.copy()
+        np.minimum.at(labels, linked[:, 0], smallest)
+        np.minimum.at(labels, linked[:, 1], smallest)
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            break
+
+    vertex_labels = np.empty(vertices.shape[0], dtype=np.int64)
+    vertex_labels[order] = labels[cell]
+    _, first, inverse = np.unique(vertex_labels, return_index=True, return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+
+    sorted_faces = np.sort(faces, axis=1)
+    degenerate = np.any(sorted_faces[:, 1:] == sorted_faces[:, :-1], axis=1)
+    return vertices[first], faces[~degenerate]
+
+
+def remove_unreferenced(vertices, faces):
+    '''
+    Drop the vertices which are not used by any face, the others being numbered in the order of their first use,
+    so that the vertex fetches follow the face order.
+    :return: (W, 3) array of vertices and (F, K) array of faces
+    '''
+    used, first_use = np.unique(faces.flatten(), return_index=True)
+    order = used[np.argsort(first_use)]
+
+    remap = np.zeros(vertices.shape[0], dtype=faces.dtype)
+    remap[order] = np.arange(order.shape[0])
+    return vertices[order], remap[faces]
+
+
+def tipsify(faces, vertex_count, cache_size=16):
+    '''
+    Reorder the faces so that their vertices are still in the post-transform vertex cache when used again, using the
+    Tipsify algorithm (Sander, Nehab and Barczak, 2007): the faces around a vertex are drawn as a fan, then the next
+    fanning vertex is picked among the vertices of that fan still in the cache and used by the most faces left.
+    :param faces: (F, K) array of vertex indices
+    :param vertex_count: number of vertices
+    :param cache_size: number of vertices in the cache
+    :return: (F, K) array of the faces in the new order
+    '''
+    # faces around each vertex, as a compressed list
+    corners = faces.flatten()
+    adjacency = np.argsort(corners, kind='stable') // faces.shape[1]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(corners, minlength=vertex_count))))
+
+    live = np.bincount(corners, minlength=vertex_count).tolist()
+    cache_time = [0] * vertex_count
+    emitted = [False] * faces.shape[0]
+    face_list = faces.tolist()
+    adjacency = adjacency.tolist()
+    offsets = offsets.tolist()
+
+    order = []
+    dead_end = []
+    time = cache_size + 1
+    fanning = 0
+    cursor = 1
+
+    while fanning >= 0:
+        candidates = []
+        for f in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[f]:
+                continue
+            emitted[f] = True
+            order.append(f)
+            for v in face_list[f]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
 
-        # seen in WS4
-        for f in range(self.faces.shape[0]):
-            # first calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
+        # the candidate still in the cache after its remaining faces are drawn, and the oldest one, is fanned next
+        fanning = -1
+        best = -1
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - cache_time[v] + 2 * live[v] <= cache_size:
+                    priority = time - cache_time[v]
+                if priority > best:
+                    best = priority
+                    fanning = v
 
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
+        if fanning == -1:
+            # go back to a vertex of a recent fan with faces left, or to the next vertex with faces left
+            while len(dead_end) > 0 and fanning == -1:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+            while fanning == -1 and cursor < vertex_count:
+                if live[cursor] > 0:
+                    fanning = cursor
+                cursor += 1
 
-        # finally we need to normalise the vectors
-        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
\ No newline at end of file
+    return faces[order]
+
+
+def acmr(faces, cache_size=16):
+    '''
+    Average cache miss ratio: number of vertices transformed per triangle when drawing the faces, with a FIFO
+    post-transform cache. 3 means no reuse at all, around 0.6 is close to the best possible on a closed mesh.
+    :param faces: (F, K) array of vertex indices
+    :param cache_size: number of vertices in the cache
+    '''
+    cache = collections.deque(maxlen=cache_size)
+    cached = set()
+    misses = 0
+    for v in faces.flatten().tolist():
+        if v not in cached:
+            misses += 1
+            if len(cache) == cache_size:
+                cached.discard(cache[0])
+            cache.append(v)
+            cached.add(v)
+    return misses / (faces.shape[0] * (faces.shape[1] - 2))
+
+
+def triangulate_faces(faces, vertices=None):
+    '''
+    Split polygonal faces into triangles, as a fan around their first vertex.
+    :param faces: (F, K) array of vertex indices
+    :param vertices: [optional] (V, 3) array of vertices, to split the concave faces by ear clipping instead
+    :return: (F * (K - 2), 3) array of vertex indices, the triangles of each face following each other
+    '''
+    if vertices is not None and faces.shape[1] > 3:
+        return triangulate_polygons(faces.ravel(), np.full(faces.shape[0], faces.shape[1]), vertices)
+
+    fan = np.arange(1, faces.shape[1] - 1)
+    triangles = np.stack((np.broadcast_to(faces[:, :1], (faces.shape[0], fan.shape[0])), faces[:, fan], faces[:, fan + 1]), axis=2)
+    return triangles.reshape(-1, 3)
+
+
+def triangulate_polygons(indices, sizes, vertices=None):
+    '''
+    Split polygons with any number of vertices into triangles, as a fan around their first vertex, keeping the
+    order of the polygons. A fan only covers convex polygons, so when the vertices are given, the concave polygons
+    are split by ear clipping instead, into as many triangles.
+    :param indices: (N,) array of the vertex indices of all polygons, one polygon after the other
+    :param sizes: (F,) array of the number of vertices of each polygon
+    :param vertices: [optional] (V, 3) array of vertices, to find the concave polygons
+    :return: (sum(sizes - 2), 3) array of vertex indices
+    '''
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if np.any(sizes < 3):
+        raise ValueError('(E) Error, faces need at least 3 vertices, found {}'.format(sizes.min()))
+    if np.all(sizes == 3):
+        return indices.reshape(-1, 3)
+
+    starts = np.cumsum(sizes) - sizes
+    counts = sizes - 2
+
+    # polygon of each triangle, and position of the triangle in its fan (1 for the first one)
+    polygon = np.repeat(np.arange(sizes.shape[0]), counts)
+    fan = np.arange(polygon.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+
+    first = starts[polygon]
+    triangles = np.stack((indices[first], indices[first + fan], indices[first + fan + 1]), axis=1)
+
+    if vertices is not None and np.any(sizes > 3):
+        # each polygon gives sizes - 2 triangles either way, so the ear clipped ones replace their fan in place
+        firsts = np.cumsum(counts) - counts
+        for f in np.flatnonzero(concave_polygons(indices, sizes, vertices)):
+            polygon_indices = indices[starts[f]:starts[f] + sizes[f]]
+            triangles[firsts[f]:firsts[f] + counts[f]] = polygon_indices[ear_clip(vertices[polygon_indices])]
+    return triangles
+
+
+def polygon_normals(indices, sizes, vertices):
+    '''
+    Normals of polygons with any number of vertices, even concave or not quite planar ones (Newell's method)
+    :param indices: (N,) array of the vertex indices of all polygons, one polygon after the other
+    :param sizes: (F,) array of the number of vertices of each polygon
+    :param vertices: (V, 3) array of vertices
+    :return: (F, 3) array of normals, their length being twice the area of the polygons
+    '''
+    starts = np.cumsum(sizes) - sizes
+    corners = vertices[indices].astype(np.float64)
+
+    # the corner following each corner, the first one following the last one of its polygon
+    following = np.arange(indices.shape[0]) + 1
+    following[starts + sizes - 1] = starts
+    return np.add.reduceat(np.cross(corners, corners[following]), starts, axis=0)
+
+
+def concave_polygons(indices, sizes, vertices):
+    '''
+    :param indices: (N,) array of the vertex indices of all polygons, one polygon after the other
+    :param sizes: (F,) array of the number of vertices of each polygon
+    :param vertices: (V, 3) array of vertices
+    :return: (F,) boolean array of the polygons with a reflex corner, turning the other way around the normal
+    '''
+    sizes = np.asarray(sizes, dtype=np.int64)
+    starts = np.cumsum(sizes) - sizes
+    polygon = np.repeat(np.arange(sizes.shape[0]), sizes)
+    corners = vertices[indices].astype(np.float64)
+
+    following = np.arange(indices.shape[0]) + 1
+    following[starts + sizes - 1] = starts
+    preceding = np.arange(indices.shape[0]) - 1
+    preceding[starts] = starts + sizes - 1
+
+    turns = np.cross(corners - corners[preceding], corners[following] - corners)
+    normals = polygon_normals(indices, sizes, vertices)
+    reflex = np.einsum('ij,ij->i', turns, normals[polygon]) < 0
+    return np.logical_or.reduceat(reflex, starts)
+
+
+def ear_clip(corners):
+    '''
+    Split a simple polygon, convex or not, into triangles by cutting off its ears one after the other: an ear is a
+    convex corner whose triangle with its two neighbours holds no other corner.
+    :param corners: (K, 3) array of the corners of the polygon, in order
+    :return: (K - 2, 3) array of corner indices, in the winding of the polygon
+    '''
+    corners = np.asarray(corners, dtype=np.float64)
+    normal = polygon_normals(np.arange(corners.shape[0]), [corners.shape[0]], corners)[0]
+
+    # the corners in the plane of the polygon, turning counterclockwise around its normal
+    axis = np.zeros(3)
+    axis[np.argmin(np.abs(normal))] = 1
+    u = np.cross(axis, normal)
+    v = np.cross(normal, u)
+    points = np.stack((corners @ u, corners @ v), axis=1)
+
+    def cross(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+    remaining = list(range(corners.shape[0]))
+    triangles = []
+    while len(remaining) > 3:
+        for r in range(len(remaining)):
+            a, b, c = remaining[r - 1], remaining[r], remaining[(r + 1) % len(remaining)]
+            if cross(points[a], points[b], points[c]) <= 0:
+                continue
+            if any(cross(points[a], points[b], points[p]) >= 0 and cross(points[b], points[c], points[p]) >= 0
+                   and cross(points[c], points[a], points[p]) >= 0 for p in remaining if p not in (a, b, c)):
+                continue
+            triangles.append((a, b, c))
+            remaining.pop(r)
+            break
+        else:
+            # no ear left, the polygon intersects itself: the rest is split as a fan
+            break
+
+    triangles.extend((remaining[0], remaining[r], remaining[r + 1]) for r in range(1, len(remaining) - 1))
+    return np.array(triangles, dtype=np.int64)
+
+
+def subdivide_mesh(vertices, faces, normals, levels=1):
+    '''
+    Split each triangle into 4 at the middle of its edges, as many times as the levels, to get a denser mesh of
+    the same shape. The vertex in the middle of an edge is shared by the triangles on both sides of the edge.
+    :param vertices: (V, 3) array of vertices
+    :param faces: (F, 3) array of vertex indices
+    :param normals: (V, 3) array of vertex normals, the normals of the new vertices being interpolated
+    :param levels: number of times the triangles are split
+    :return: the vertices, faces and normals of the subdivided mesh, with 4 ** levels times as many faces
+    '''
+    for _ in range(levels):
+        # each edge once, whatever the order of its vertices
+        edges = np.sort(np.stack((faces, np.roll(faces, -1, axis=1)), axis=2).reshape(-1, 2), axis=1)
+        edges, middle = np.unique(edges, axis=0, return_inverse=True)
+
+        # new vertex in the middle of each edge, numbered after the existing ones
+        middle = middle.reshape(faces.shape) + vertices.shape[0]
+        vertices = np.concatenate((vertices, (vertices[edges[:, 0]] + vertices[edges[:, 1]]) / 2)).astype(vertices.dtype)
+        normals = np.concatenate((normals, normalize(normals[edges[:, 0]] + normals[edges[:, 1]]))).astype(normals.dtype)
+
+        # the corner triangles, then the middle one
+        a, b, c = faces.T
+        ab, bc, ca = middle.T
+        faces = np.concatenate((
+            np.stack((a, ab, ca), axis=1),
+            np.stack((ab, b, bc), axis=1),
+            np.stack((ca, bc, c), axis=1),
+            np.stack((ab, bc, ca), axis=1),
+        )).astype(faces.dtype)
+
+    return vertices, faces, normals
+
+
+def triangle_areas(corners):
+    '''
+    :param corners: (T, 3, 3) array of the corners of each triangle
+    :return: (T,) array of the area of each triangle
+    '''
+    return 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+
+
+def corner_angles(corners):
+    '''
+    :param corners: (T, 3, 3) array of the corners of each triangle
+    :return: (T, 3) array of the angle of each triangle at each corner
+    '''
+    following = normalize(np.roll(corners, -1, axis=1) - corners)
+    preceding = normalize(np.roll(corners, 1, axis=1) - corners)
+    return np.arccos(np.clip(np.sum(following * preceding, axis=2), -1.0, 1.0))
+
+
+def normalize(vectors):
+    '''
+    Normalise vectors along the last axis. Zero length vectors are left to zero instead of becoming NaN.
+    '''
+    lengths = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, lengths, out=np.zeros_like(vectors), where=lengths > 0)
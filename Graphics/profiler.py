@@ -0,0 +1,155 @@
+import collections
+import contextlib
+import json
+import time
+
+import numpy as np
+
+
+class FrameProfiler:
+    '''
+    Opt-in profiler for the scene loop. The duration of the last frames and of the stages within them (event
+    handling, camera update, drawing of each model, buffer flip, fur regeneration...) are kept in ring buffers,
+    so that rolling statistics can be reported at any time and exported as a trace.
+    '''
+
+    def __init__(self, capacity=600):
+        '''
+        :param capacity: number of frames kept for the rolling statistics
+        '''
+        self.capacity = capacity
+
+        # ring buffer of frame durations (in seconds), and number of frames recorded so far
+        self.frame_times = np.zeros(capacity)
+        self.frames = 0
+
+        # (name, category, start, duration) of the frames and stages, in seconds since the profiler creation
+        self.events = collections.deque(maxlen=32 * capacity)
+
+        self.origin = time.perf_counter()
+        self.frame_start = None
+
+    def now(self):
+        return time.perf_counter() - self.origin
+
+    def begin_frame(self):
+        self.frame_start = self.now()
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+
+        duration = self.now() - self.frame_start
+        self.frame_times[self.frames % self.capacity] = duration
+        self.frames += 1
+        self.events.append(('frame', 'frame', self.frame_start, duration))
+        self.frame_start = None
+
+    @contextlib.contextmanager
+    def stage(self, name, category='stage'):
+        '''
+        Time the code run within a with statement as one stage of the current frame.
+        :param name: the name of the stage
+        :param category: the category of the stage, eg 'stage', 'model' or 'fur'
+        '''
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.events.append((name, category, start, self.now() - start))
+
+    def recent_frame_times(self):
+        '''
+        :return: the durations of the frames kept in the ring buffer, in seconds
+        '''
+        return self.frame_times[:min(self.frames, self.capacity)]
+
+    def percentiles(self, percentiles=(50, 95, 99)):
+        '''
+        :return: dictionary of the rolling frame time percentiles, in milliseconds
+        '''
+        times = self.recent_frame_times()
+        if times.shape[0] == 0:
+            return {p: 0.0 for p in percentiles}
+        return {p: 1000 * np.percentile(times, p) for p in percentiles}
+
+    def stage_summary(self):
+        '''
+        :return: dictionary of (category, count, mean, p95, max) of each stage kept, times in milliseconds
+        '''
+        durations = collections.OrderedDict()
+        for name, category, start, duration in self.events:
+            if category != 'frame':
+                durations.setdefault((name, category), []).append(duration)
+
+        summary = collections.OrderedDict()
+        for (name, category), times in durations.items():
+            times = 1000 * np.array(times)
+            summary[name] = (category, times.shape[0], times.mean(), np.percentile(times, 95), times.max())
+        return summary
+
+    def report(self):
+        percentiles = self.percentiles()
+        print('Frame time over the last {} frame(s): p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms'.format(
+            self.recent_frame_times().shape[0], percentiles[50], percentiles[95], percentiles[99]))
+
+        for name, (category, count, mean, p95, longest) in self.stage_summary().items():
+            print('  {:<28}{:<8}{:>6} x  mean {:8.3f} ms  p95 {:8.3f} ms  max {:8.3f} ms'.format(
+                name, category, count, mean, p95, longest))
+
+    def export(self, file_name):
+        '''
+        Export the recorded events, as CSV if the file name ends with .csv and as a Chrome trace otherwise.
+        '''
+        if file_name.endswith('.csv'):
+            self.export_csv(file_name)
+        else:
+            self.export_chrome_trace(file_name)
+        print('Profile written to {}'.format(file_name))
+
+    def export_chrome_trace(self, file_name):
+        '''
+        Write the recorded events in the Chrome trace event format, which can be opened in chrome://tracing
+        or https://ui.perfetto.dev
+        '''
+        events = [
+            {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': 1e6 * start,
+                'dur': 1e6 * duration,
+                'pid': 1,
+                'tid': 1,
+            }
+            for name, category, start, duration in self.events
+        ]
+        with open(file_name, 'w') as tracefile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, tracefile)
+
+    def export_csv(self, file_name):
+        with open(file_name, 'w') as csvfile:
+            csvfile.write('name,category,start_ms,duration_ms\n')
+            for name, category, start, duration in self.events:
+                csvfile.write('{},{},{:.4f},{:.4f}\n'.format(name, category, 1000 * start, 1000 * duration))
+
+
+class NullProfiler:
+    '''
+    Profiler used when profiling is disabled, doing nothing.
+    '''
+
+    def begin_frame(self):
+        pass
+
+    def end_frame(self):
+        pass
+
+    def stage(self, name, category='stage'):
+        return contextlib.nullcontext()
+
+    def report(self):
+        print('(W) Warning: profiling is disabled, create the scene with profile=True')
+
+    def export(self, file_name):
+        pass
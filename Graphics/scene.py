@@ -7,7 +7,10 @@ from OpenGL.GL import *
 from matutils import *
 from camera import Camera
 from lightSource import LightSource
-from shaders import Shaders
+from shaders import Shaders, Uniform
+from buffers import BufferManager
+from profiler import FrameProfiler, NullProfiler
+from headless import create_context, Framebuffer
 # from FurUtil import *
 
 
@@ -16,12 +19,15 @@ class Scene:
 	This is the main class for drawing an OpenGL scene using the PyGame library
 	'''
 	
-	def __init__(self, width=1250, height=800, shaders=None):
+	def __init__(self, width=1250, height=800, shaders=None, profile=False, trace_file=None, headless=False):
 		'''
 		Initialises the scene
 			:param width: width of window displaying the scene
 			:param height: height of window displaying the scene
 			:param shaders: shaders being used in the scene
+			:param profile: whether to record the time spent in each stage of each frame
+			:param trace_file: [optional] file the profile is exported to when quitting (.csv or Chrome trace .json)
+			:param headless: whether to render offscreen instead of opening a window (see headless.py)
 		'''
 
 		# Define display window size
@@ -30,9 +36,16 @@ class Scene:
 		# By default, wireframe mode is off
 		self.wireframe = False
 
-		# Initialise the window (pygame aspect)
-		pygame.init()
-		screen = pygame.display.set_mode(self.window_size, pygame.OPENGL | pygame.DOUBLEBUF, 24)
+		if headless:
+			# Create an offscreen context and draw into a framebuffer object instead of a window
+			self.context = create_context(width, height)
+			self.framebuffer = Framebuffer(width, height)
+		else:
+			# Initialise the window (pygame aspect)
+			pygame.init()
+			screen = pygame.display.set_mode(self.window_size, pygame.OPENGL | pygame.DOUBLEBUF, 24)
+			self.context = None
+			self.framebuffer = None
 
 		# Initialise the window (OpenGL aspect)
 		glViewport(0, 0, self.window_size[0], self.window_size[1])
@@ -77,8 +90,18 @@ class Scene:
 
 		# Maintain a list of models to draw in the scene,
 		self.models = []
+
+		# All GPU buffers of the models are owned by the buffer manager, which frees them when a model is removed
+		self.buffers = BufferManager()
 		
 		self.fur_model = None
+
+		# Number of glUniform calls skipped during the last frame
+		self.uniform_calls_saved = 0
+
+		# Records frame timings when profiling is enabled
+		self.profiler = FrameProfiler() if profile else NullProfiler()
+		self.trace_file = trace_file
 				
 	def add_model(self,model):
 		'''
@@ -96,11 +119,16 @@ class Scene:
 		self.models.extend(models_list)
 
 		
-	def remove_model(self):
+	def remove_model(self, model=None):
 		'''
-		This method just removes a model to the scene. Used to re-render the fur model
+		This method removes a model from the scene and releases its GPU buffers. Used to re-render the fur model
+			:param model: [optional] The model object to remove, the last model added by default
 		'''
-		self.models.pop(-1) # Used to remove previous model which should always be fur texture due to it being appended after the main model
+		if model is None:
+			model = self.models.pop(-1) # Used to remove previous model which should always be fur texture due to it being appended after the main model
+		else:
+			self.models.remove(model)
+		model.release()
 		
 		
 	def draw(self):
@@ -109,17 +137,33 @@ class Scene:
 		'''
 
 		# Clear the scene as well as the depth buffer to handle occlusions
-		glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+		with self.profiler.stage('clear'):
+			glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+		with self.profiler.stage('camera.update'):
+			self.camera.update()
 
-		self.camera.update()
+			# Calculate the view dependent uniforms once for all models
+			self.shaders.begin_frame(self.P, self.camera.V, self.light)
+			Uniform.calls_saved = 0
+
+		# Swap in the fur regenerated in the background, if ready, and pick its level of detail for the new view
+		if self.fur_model is not None:
+			self.fur_model.update()
 
 		# Loop over list and draw all models
-		for model in self.models:
-			model.draw(Mp=poseMatrix(), shaders=self.shaders)
+		for index, model in enumerate(self.models):
+			with self.profiler.stage('{}[{}].draw'.format(model.__class__.__name__, index), 'model'):
+				model.draw(Mp=poseMatrix(), shaders=self.shaders)
+
+		# Number of glUniform calls skipped during this frame
+		self.uniform_calls_saved = Uniform.calls_saved
 		
 		# Flip double buffer (draw on separate buffer to one displayed to avoid
 		# artifacts) once models are drawn
-		pygame.display.flip()
+		if self.framebuffer is None:
+			with self.profiler.stage('display.flip'):
+				pygame.display.flip()
 	
 
 	def keyboard(self, event):
@@ -141,23 +185,19 @@ class Scene:
 		# 'k' and 'l' to decrease/incerease fur length
 		elif event.key == pygame.K_k:
 			print('\n--> Decreasing fur length')
-			self.remove_model()
 			self.fur_model.update_fur_length(-0.1)
 			
 		elif event.key == pygame.K_l:
 			print('\n--> Increasing fur length')
-			self.remove_model()
 			self.fur_model.update_fur_length(0.1)
 		
 		# 'n' and 'm' to decrease/incerease fur density
 		elif event.key == pygame.K_n:
 			print('\n--> Decreasing fur density')
-			self.remove_model()
 			self.fur_model.update_fur_density(-0.25)
 			
 		elif event.key == pygame.K_m:
 			print('\n--> Increasing fur density')
-			self.remove_model()
 			self.fur_model.update_fur_density(0.25)
 			
 		# 'b' to toggle fur in random direction/use normals to determine direction
@@ -166,9 +206,32 @@ class Scene:
 				print('\n--> Rendering fur using normals for direction')
 			else:
 				print('\n--> Rendering fur in same direction using a randomly generated angle')
-			self.remove_model()
 			self.fur_model.update_fur_direction()
 
+		# ',' and '.' to decrease/increase the fur quality (number of shells of the shell fur)
+		elif event.key in (pygame.K_COMMA, pygame.K_PERIOD):
+			if hasattr(self.fur_model, 'update_fur_quality'):
+				print('\n--> {} fur quality'.format('Decreasing' if event.key == pygame.K_COMMA else 'Increasing'))
+				self.fur_model.update_fur_quality(-4 if event.key == pygame.K_COMMA else 4)
+			else:
+				print('(W) Warning: the fur quality can only be changed for the shell fur (main.py --shells)')
+
+		# 'c' to print the fraction of the hairs culled in the last frame
+		elif event.key == pygame.K_c:
+			print('Culling: {:.1%} of the hairs culled in the last frame'.format(getattr(self.fur_model, 'culled_fraction', 0.0)))
+
+		# 'g' to print the GPU buffers currently in use
+		elif event.key == pygame.K_g:
+			self.buffers.report()
+
+		# 'u' to print the number of uniform uploads skipped during the last frame
+		elif event.key == pygame.K_u:
+			print('Uniforms: {} glUniform call(s) saved in the last frame'.format(self.uniform_calls_saved))
+
+		# 'p' to print the rolling frame time statistics
+		elif event.key == pygame.K_p:
+			self.profiler.report()
+
 
 	def pygameEvents(self):
 		# Check whether the window has been closed
@@ -209,8 +272,55 @@ class Scene:
 		'''		
 		self.running = True
 		while self.running:
+			self.profiler.begin_frame()
+
 			# Check for keyboard or mouse actions
-			self.pygameEvents()
+			with self.profiler.stage('events'):
+				self.pygameEvents()
 			
 			# Then continue drawing the scene
 			self.draw()
+
+			self.profiler.end_frame()
+
+		# Summarise the profile, if enabled
+		if isinstance(self.profiler, FrameProfiler):
+			self.profiler.report()
+			if self.trace_file is not None:
+				self.profiler.export(self.trace_file)
+
+
+	def render_frames(self, frames, update=None):
+		'''
+		Draws a number of frames offscreen and returns them, for scenes created with headless=True.
+			:param frames: number of frames to render
+			:param update: [optional] function called with the scene and the frame number before drawing each frame
+			:return: list of (height, width, 3) uint8 arrays
+		'''
+		if self.framebuffer is None:
+			raise RuntimeError('(E) Error: render_frames() needs a scene created with headless=True')
+
+		images = []
+		for frame in range(frames):
+			self.profiler.begin_frame()
+			if update is not None:
+				update(self, frame)
+			self.draw()
+			with self.profiler.stage('read_pixels'):
+				images.append(self.framebuffer.read_pixels())
+			self.profiler.end_frame()
+		return images
+
+
+	def close(self):
+		'''
+		Releases the GPU buffers, and the offscreen context of a headless scene.
+		'''
+		if self.fur_model is not None:
+			self.fur_model.close()
+		self.buffers.clear()
+		if self.framebuffer is not None:
+			self.framebuffer.release()
+			self.context.release()
+			self.framebuffer = None
+			self.context = None
@@ -11,6 +11,10 @@ class Uniform:
     We create a simple class to handle uniforms, this is not necessary,
     but allow to put all relevant code in one place
     '''
+
+    # number of glUniform calls skipped because the program already had the value, reset by the scene every frame
+    calls_saved = 0
+
     def __init__(self, name, value=None):
         '''
         Initialise the uniform parameter
@@ -20,6 +24,9 @@ class Uniform:
         self.value = value
         self.location = -1
 
+        # last value sent to the program, the uniform is only bound again when its value changes
+        self.uploaded = None
+
     def link(self, program):
         '''
         This function needs to be called after compiling the GLSL program to fetch the location of the uniform
@@ -30,6 +37,9 @@ class Uniform:
         if self.location == -1:
             print('(E) Warning, no uniform {}'.format(self.name))
 
+        # a newly linked program does not hold any value yet
+        self.uploaded = None
+
     def bind_matrix(self, M=None, number=1, transpose=True):
         '''
         Call this before rendering to bind the Python matrix to the GLSL uniform mat4.
@@ -54,6 +64,13 @@ class Uniform:
         if self.value is None:
             print('(E) Error in Uniform.bind(): Invalid value: None')
 
+        if self.is_uploaded():
+            Uniform.calls_saved += 1
+            return
+
+        # keep a copy, the value may be an array modified in place later
+        self.uploaded = np.copy(self.value) if isinstance(self.value, np.ndarray) else self.value
+
         if isinstance(self.value, int):
             self.bind_int()
 
@@ -69,6 +86,16 @@ class Uniform:
             print('(E) Error in Uniform.bind() (Uniform: {}): Invalid value type {}'.format(self.name, type(value)))
             raise
 
+    def is_uploaded(self):
+        '''
+        :return: whether the program already holds the current value of the uniform
+        '''
+        if self.uploaded is None or type(self.uploaded) is not type(self.value):
+            return False
+        if isinstance(self.value, np.ndarray):
+            return np.array_equal(self.uploaded, self.value)
+        return self.uploaded == self.value
+
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
@@ -134,6 +161,12 @@ class Shaders:
             'Is': Uniform('Is'),
         }
 
+        # products of the view dependent matrices, calculated once per frame by begin_frame()
+        self.frame_P = None
+        self.frame_V = None
+        self.PV = None
+        self.model_matrices = {}
+
         self.name = name
         if name is not None:
             vertex_shader = 'shaders/{}/vertex_shader.glsl'.format(name)
@@ -221,22 +254,55 @@ class Shaders:
         for uniform in self.uniforms:
             self.uniforms[uniform].link(self.program)
 
+    def begin_frame(self, P, V, light):
+        '''
+        Call this function once per frame, before binding the program for each model, to calculate the
+        uniforms which only depend on the view
+        '''
+        self.frame_P = P
+        self.frame_V = V
+        self.PV = np.matmul(P, V)
+        self.model_matrices = {}
+
+        # set the light properties
+        self.set_light_uniforms(light, V)
+
+    def model_view_matrices(self, M):
+        '''
+        Calculate the PVM, VM and VMiT matrices of a model, only once per frame for models sharing the same pose
+        '''
+        key = M.tobytes()
+        if key not in self.model_matrices:
+            VM = np.matmul(self.frame_V, M)
+
+            # for an affine transform, the inverse of the upper 3x3 block is the upper 3x3 block of the inverse
+            self.model_matrices[key] = (np.matmul(self.PV, M), VM, np.linalg.inv(VM[:3, :3]).transpose())
+
+        return self.model_matrices[key]
+
     def bind(self, P, V, M, mode, light, material):
         '''
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
+        Only the uniforms whose value changed since the last call are sent to the program.
         '''
 
         # tell OpenGL to use this shader program for rendering
         glUseProgram(self.program)
 
+        # the view changed without begin_frame() being called for this program
+        if P is not self.frame_P or V is not self.frame_V:
+            self.begin_frame(P, V, light)
+
+        PVM, VM, VMiT = self.model_view_matrices(M)
+
         # set the PVM matrix uniform
-        self.uniforms['PVM'].set(np.matmul(P,np.matmul(V,M)))
+        self.uniforms['PVM'].set(PVM)
 
         # set the VM matrix uniform
-        self.uniforms['VM'].set(np.matmul(V,M))
+        self.uniforms['VM'].set(VM)
 
         # set the VMiT matrix uniform
-        self.uniforms['VMiT'].set(np.linalg.inv(np.matmul(V,M))[:3,:3].transpose())
+        self.uniforms['VMiT'].set(VMiT)
 
         # set the mode to the program
         self.uniforms['mode'].set(mode)
@@ -244,14 +310,20 @@ class Shaders:
         # set material properties
         self.set_material_uniforms(material)
 
-        # set the light properties
-        self.set_light_uniforms(light,V)
-
-        # bind everything
+        # bind everything that changed
         for uniform in self.uniforms.values():
             uniform.bind()
 
 
+    def bind_material(self, material):
+        '''
+        Call this function between draws of the same model with different materials, once the program is bound
+        with bind(), to only send the material uniforms which changed.
+        '''
+        self.set_material_uniforms(material)
+        for name in ('Ka', 'Kd', 'Ks', 'Ns'):
+            self.uniforms[name].bind()
+
     def set_light_uniforms(self, light, V):
         self.uniforms['light'].set(unhomog(np.dot(V, homog(light.position))))
         self.uniforms['Ia'].set(np.array(light.Ia, 'f'))
@@ -274,6 +346,45 @@ class FlatShader(Shaders):
     def __init__(self):
         Shaders.__init__(self, name='flat')
 
+class FurShader(Shaders):
+    '''
+    Program expanding each instance of a line into a hair, from its root, direction and length factor. The hairs
+    are coloured like the other models, so the fragment shader of the flat program is reused.
+    '''
+    def __init__(self):
+        Shaders.__init__(self, vertex_shader='shaders/fur/vertex_shader.glsl',
+                         fragment_shader='shaders/flat/fragment_shader.glsl')
+        self.name = 'fur'
+        self.uniforms['fur_length'] = Uniform('fur_length', 0.0)
+        self.uniforms['fur_angle'] = Uniform('fur_angle', 0)
+        self.uniforms['fur_direction'] = Uniform('fur_direction', np.array([0., 0., 0.], 'f'))
+
+    def set_fur_uniforms(self, length, angle, direction):
+        self.uniforms['fur_length'].set(float(length))
+        self.uniforms['fur_angle'].set(int(angle))
+        self.uniforms['fur_direction'].set(np.array(direction, 'f'))
+
+class ShellShader(Shaders):
+    '''
+    Program drawing each instance of a mesh as one shell of fur, offset along the normals, keeping only the
+    fragments of the strands of a 3D density texture which reach the height of the shell.
+    '''
+    def __init__(self):
+        Shaders.__init__(self, name='shell')
+        self.uniforms['fur_length'] = Uniform('fur_length', 0.0)
+        self.uniforms['fur_angle'] = Uniform('fur_angle', 0)
+        self.uniforms['fur_direction'] = Uniform('fur_direction', np.array([0., 0., 0.], 'f'))
+        self.uniforms['shell_count'] = Uniform('shell_count', 1)
+        self.uniforms['fur_scale'] = Uniform('fur_scale', 1.0)
+        self.uniforms['density_texture'] = Uniform('density_texture', 0)
+
+    def set_shell_uniforms(self, length, angle, direction, shell_count, scale):
+        self.uniforms['fur_length'].set(float(length))
+        self.uniforms['fur_angle'].set(int(angle))
+        self.uniforms['fur_direction'].set(np.array(direction, 'f'))
+        self.uniforms['shell_count'].set(int(shell_count))
+        self.uniforms['fur_scale'].set(float(scale))
+
 class GouraudShader(Shaders):
     def __init__(self):
         Shaders.__init__(self, name='gouraud')
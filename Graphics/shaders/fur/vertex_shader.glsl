@@ -0,0 +1,35 @@
+#version 130		// required to use OpenGL core standard
+
+//=== in attributes are read once per hair (one instance of the line), and shared by both ends of the line
+in vec3 root;           // the position of the hair root
+in vec3 normal;         // the normal at the root, used as hair direction
+in float length_factor; // the random length of the hair, between 0.1 and 1 of the fur length
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 fragment_color;        // the output of the shader will be the colour of the vertex
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+
+//=== uniforms
+uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
+uniform int mode;	// the rendering mode (better to code different shaders!)
+
+// fur uniforms, changing them does not require to upload the hairs again
+uniform float fur_length;   // the length of the longest hairs
+uniform int fur_angle;      // whether all hairs use the fur direction instead of their own normal
+uniform vec3 fur_direction; // the direction shared by all hairs when fur_angle is set
+
+void main(){
+    // 1. expand each hair into a line: vertex 0 is the root, vertex 1 the end of the hair
+    vec3 direction = fur_angle != 0 ? fur_direction : normal;
+    vec3 position = root + direction * (fur_length * length_factor * float(gl_VertexID));
+
+    // 2. then, we transform the position using PVM matrix.
+    gl_Position = PVM * vec4(position, 1.0f);
+
+    // 3. calculate vectors used for shading calculations
+    position_view_space = vec3(VM*vec4(position, 1.0f));
+
+    // 4. hairs are drawn with a black vertex colour, like the line hair model
+    fragment_color = vec3(0.0f, 0.0f, 0.0f);
+}
@@ -0,0 +1,24 @@
+# version 140 // same version as the shell vertex shader
+
+//=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
+in vec3 texture_position;
+in float shell_height;
+in vec3 position_view_space;
+
+//=== 'out' attributes are the output image, usually only one for the colour of each pixel
+out vec3 final_color;
+
+// === uniform here the texture object to sample from
+uniform sampler3D density_texture;  // random length factor of the strand in each cell, 0 where there is no strand
+
+///=== main shader code
+void main() {
+      // 1. only keep the fragments of the strands reaching the height of the shell
+      float strand_length = texture(density_texture, texture_position).r;
+      if (strand_length < shell_height) {
+          discard;
+      }
+
+      // 2. strands are dark, getting lighter towards their tip
+      final_color = vec3(0.3f, 0.3f, 0.3f) * shell_height;
+}
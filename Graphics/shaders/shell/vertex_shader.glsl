@@ -0,0 +1,37 @@
+#version 140		// required for gl_InstanceID
+
+//=== in attributes are read from the vertex array of the base mesh, each shell is one instance of the mesh
+in vec3 position;	// the position attribute contains the vertex position
+in vec3 normal;		// store the vertex normal
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 texture_position;      // the position on the base mesh, so that a strand stays at the same place on all shells
+out float shell_height;         // the height of the shell, between 0 (base mesh) and 1 (fur length)
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+
+//=== uniforms
+uniform mat4 PVM; 	// the Perspective-View-Model matrix is received as a Uniform
+uniform mat4 VM; 	// the View-Model matrix is received as a Uniform
+
+// fur uniforms
+uniform float fur_length;   // the length of the longest strands
+uniform int fur_angle;      // whether all shells are offset along the fur direction instead of the normals
+uniform vec3 fur_direction; // the direction shared by all strands when fur_angle is set
+uniform int shell_count;    // the number of shells drawn
+uniform float fur_scale;    // the number of density texture repeats per unit length, more repeats give more strands
+
+void main(){
+    // 1. offset the instance of the mesh along the normals, the first shell is just above the base mesh
+    shell_height = float(gl_InstanceID + 1) / float(shell_count);
+    vec3 direction = fur_angle != 0 ? fur_direction : normal;
+    vec3 shell_position = position + direction * (fur_length * shell_height);
+
+    // 2. then, we transform the position using PVM matrix.
+    gl_Position = PVM * vec4(shell_position, 1.0f);
+
+    // 3. calculate vectors used for shading calculations
+    position_view_space = vec3(VM*vec4(shell_position, 1.0f));
+
+    // 4. the density texture is sampled at the base position of the vertex
+    texture_position = position * fur_scale;
+}
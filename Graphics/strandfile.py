@@ -0,0 +1,104 @@
+'''
+Binary file format of a set of generated hairs, so that a groom can be saved once and loaded at startup instead
+of being generated again. The layout is:
+- the magic bytes STRAND_FILE_MAGIC, then the format version and the header size as little endian uint32,
+- a JSON header holding the generation parameters and the dtype, shape and offset of each array,
+- the raw content of each array, starting on a multiple of ALIGNMENT bytes from the start of the file.
+The arrays are mapped from the file when loading, rather than read, so only the pages used are read from disk.
+'''
+import json
+import os
+
+import numpy as np
+
+STRAND_FILE_MAGIC = b'FURSTRND'
+
+# increase when the layout changes, files of other versions being rejected
+STRAND_FILE_VERSION = 1
+
+# alignment of the arrays in the file, so that they can be mapped as they are
+ALIGNMENT = 64
+
+# size of the magic bytes, version and header size
+PREAMBLE_SIZE = len(STRAND_FILE_MAGIC) + 8
+
+
+def aligned(offset):
+    '''
+    :return: the first multiple of ALIGNMENT at or after the offset
+    '''
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def save_strands(file_name, arrays, parameters):
+    '''
+    Save a set of hairs.
+    :param file_name: the file to write
+    :param arrays: dictionary of the arrays to save, by name
+    :param parameters: dictionary of the parameters the hairs were generated with, saved as JSON
+    '''
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    # the offsets of the arrays depend on the size of the header holding them, so the first array is moved after
+    # the header until it fits
+    start = PREAMBLE_SIZE
+    while True:
+        layout = {}
+        offset = aligned(start)
+        for name, array in arrays.items():
+            layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            offset = aligned(offset + array.nbytes)
+        header = json.dumps({'parameters': parameters, 'arrays': layout}).encode()
+
+        if PREAMBLE_SIZE + len(header) <= aligned(start):
+            break
+        start = PREAMBLE_SIZE + len(header)
+
+    # write to a temporary file first, so that an interrupted save never leaves a broken file
+    with open(file_name + '.tmp', 'wb') as strandfile:
+        strandfile.write(STRAND_FILE_MAGIC)
+        strandfile.write(np.array([STRAND_FILE_VERSION, len(header)], dtype='<u4').tobytes())
+        strandfile.write(header)
+        for name, array in arrays.items():
+            strandfile.seek(layout[name]['offset'])
+            strandfile.write(array.tobytes())
+    os.replace(file_name + '.tmp', file_name)
+
+
+def read_header(file_name):
+    '''
+    :param file_name: a file written by save_strands()
+    :return: the header of the file, with the parameters and the layout of the arrays
+    '''
+    with open(file_name, 'rb') as strandfile:
+        preamble = strandfile.read(PREAMBLE_SIZE)
+        if len(preamble) < PREAMBLE_SIZE or preamble[:len(STRAND_FILE_MAGIC)] != STRAND_FILE_MAGIC:
+            raise ValueError('(E) Error: {} is not a strand file'.format(file_name))
+
+        version, header_size = np.frombuffer(preamble[len(STRAND_FILE_MAGIC):], dtype='<u4')
+        if version != STRAND_FILE_VERSION:
+            raise ValueError('(E) Error: {} is a version {} strand file, version {} expected'.format(
+                file_name, version, STRAND_FILE_VERSION))
+
+        return json.loads(strandfile.read(int(header_size)).decode())
+
+
+def load_strands(file_name):
+    '''
+    Map the arrays of a set of hairs. The mappings are copy on write: the arrays can be changed, eg when moving the
+    hair tips, without changing the file or copying the arrays up front.
+    :param file_name: a file written by save_strands()
+    :return: the dictionary of the arrays, by name, and the dictionary of the parameters
+    '''
+    header = read_header(file_name)
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        shape = tuple(layout['shape'])
+        if np.prod(shape) == 0:
+            # an empty array cannot be mapped
+            arrays[name] = np.zeros(shape, dtype=layout['dtype'])
+        else:
+            arrays[name] = np.memmap(file_name, dtype=layout['dtype'], mode='c', offset=layout['offset'], shape=shape)
+
+    return arrays, header['parameters']
@@ -0,0 +1,67 @@
+# The modules of the project are imported from the Graphics directory, where main.py runs, and load their
+# shaders and models from paths relative to it.
+
+import os
+import sys
+
+import pytest
+
+GRAPHICS_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, GRAPHICS_DIRECTORY)
+
+
+@pytest.fixture(autouse=True)
+def graphics_directory(monkeypatch):
+    monkeypatch.chdir(GRAPHICS_DIRECTORY)
+
+
+@pytest.fixture
+def gl():
+    from glstub import RecordingGL
+    return RecordingGL()
+
+
+@pytest.fixture
+def fur_scene(gl):
+    '''
+    A scene without a window, the OpenGL calls of the models and the fur being recorded by the stub
+    '''
+    import importlib
+    from glstub import StubScene, linked_shaders, GL_MODULES
+
+    with gl.patch(*[importlib.import_module(name) for name in GL_MODULES]):
+        yield StubScene(gl, linked_shaders(gl))
+
+
+@pytest.fixture(scope='session')
+def bunny():
+    os.chdir(GRAPHICS_DIRECTORY)
+    from glstub import load_bunny
+    return load_bunny()
+
+
+@pytest.fixture
+def make_fur(fur_scene, bunny):
+    '''
+    :return: a function creating the fur of the bunny, generated on the calling thread, with the given parameters
+    '''
+    from FurUtil import FurUtils
+    from glstub import BUNNY_POSE
+
+    def make(density=1, length=0.1, angle=False, **parameters):
+        parameters.setdefault('background', False)
+        parameters.setdefault('seed', 1)
+        return FurUtils(BUNNY_POSE, fur_scene, bunny.vertices, bunny.normals, bunny.faces, length, density, angle,
+                        **parameters)
+    return make
+
+
+@pytest.fixture
+def stub_compile(monkeypatch, gl):
+    '''
+    Link the uniforms of the shader programs to program names from the stub instead of compiling them
+    '''
+    import shaders
+    from glstub import link_program
+
+    monkeypatch.setattr(shaders.Shaders, 'compile', lambda program: link_program(program, gl))
@@ -0,0 +1,116 @@
+import types
+
+import numpy as np
+from OpenGL.GL import GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER
+
+import BaseModel
+import HairModel
+from buffers import BufferManager
+
+
+def test_create_buffer_uploads_new_buffer(gl):
+    buffers = BufferManager(gl=gl)
+    data = np.zeros((10, 3), dtype='f')
+
+    buffer = buffers.create_buffer('model', data)
+
+    assert gl.count('glGenBuffers') == 1
+    assert gl.count('glBufferData') == 1
+    assert gl.count('glBufferSubData') == 0
+    assert buffers.stats()['buffers'] == 1
+    assert buffers.stats()['bytes'] == data.nbytes
+    assert buffers.capacity[buffer] == data.nbytes
+
+
+def test_released_buffer_is_reused_with_buffer_sub_data(gl):
+    buffers = BufferManager(gl=gl)
+    first = buffers.create_buffer('first', np.zeros((10, 3), dtype='f'))
+    buffers.release('first')
+    gl.reset()
+
+    second = buffers.create_buffer('second', np.zeros((8, 3), dtype='f'))
+
+    assert second == first
+    assert gl.count('glGenBuffers') == 0
+    assert gl.count('glBufferData') == 0
+    assert gl.count('glBufferSubData') == 1
+    assert buffers.stats()['free_buffers'] == 0
+
+
+def test_buffer_not_reused_when_too_small_wasteful_or_other_target(gl):
+    buffers = BufferManager(gl=gl)
+    buffers.create_buffer('first', np.zeros((10, 3), dtype='f'))
+    buffers.release('first')
+
+    buffers.create_buffer('larger', np.zeros((20, 3), dtype='f'))
+    buffers.create_buffer('much smaller', np.zeros((2, 3), dtype='f'))
+    buffers.create_buffer('indices', np.zeros((10, 3), dtype=np.uint32), GL_ELEMENT_ARRAY_BUFFER)
+
+    assert gl.count('glGenBuffers') == 4
+    assert gl.count('glBufferSubData') == 0
+    assert buffers.stats()['free_buffers'] == 1
+
+
+def test_smallest_fitting_buffer_is_reused(gl):
+    buffers = BufferManager(gl=gl)
+    large = buffers.create_buffer('large', np.zeros(150, dtype='f'))
+    small = buffers.create_buffer('small', np.zeros(110, dtype='f'))
+    buffers.release('large')
+    buffers.release('small')
+
+    assert buffers.create_buffer('model', np.zeros(100, dtype='f')) == small
+    assert buffers.create_buffer('model', np.zeros(100, dtype='f')) == large
+
+
+def test_release_deletes_vertex_arrays_and_textures_and_pools_buffers(gl):
+    buffers = BufferManager(gl=gl)
+    buffers.create_vertex_array('model')
+    buffers.create_texture('model', 0)
+    buffers.create_buffer('model', np.zeros((10, 3), dtype='f'), GL_ARRAY_BUFFER)
+
+    buffers.release('model')
+
+    assert gl.count('glDeleteVertexArrays') == 1
+    assert gl.count('glDeleteTextures') == 1
+    assert gl.count('glDeleteBuffers') == 0
+    assert buffers.stats() == {'vertex_arrays': 0, 'textures': 0, 'buffers': 0, 'bytes': 0,
+                               'free_buffers': 1, 'free_bytes': 120}
+
+
+def test_pool_is_trimmed_to_its_bounds(gl):
+    buffers = BufferManager(gl=gl, max_free=2, max_free_bytes=1000)
+    for owner in range(4):
+        buffers.create_buffer(owner, np.zeros(10 * (owner + 1), dtype='f'))
+    for owner in range(4):
+        buffers.release(owner)
+
+    # the oldest released buffers, of 40 and 80 bytes, are deleted first
+    assert gl.count('glDeleteBuffers') == 2
+    assert buffers.stats()['free_buffers'] == 2
+    assert buffers.free_bytes() == 120 + 160
+
+    buffers.clear()
+    assert gl.count('glDeleteBuffers') == 4
+    assert buffers.stats()['free_buffers'] == 0
+
+
+def test_hair_model_buffers_are_released_and_reused(gl):
+    scene = types.SimpleNamespace(buffers=BufferManager(gl=gl), shaders=types.SimpleNamespace(program=1))
+    vertices = np.zeros((20, 3), dtype='f')
+    indices = np.arange(20, dtype=np.uint32).reshape(-1, 2)
+
+    with gl.patch(BaseModel, HairModel):
+        first = HairModel.HairModel(scene, vertices, vertices, indices)
+        first.bind()
+        first.release()
+        gl.reset()
+
+        second = HairModel.HairModel(scene, vertices, vertices, indices)
+        second.bind()
+
+    # position, normal, colour and index buffers all come from the pool
+    assert gl.count('glGenBuffers') == 0
+    assert gl.count('glBufferSubData') == 4
+    assert gl.count('glGenVertexArrays') == 1
+    assert gl.count('glEnableVertexAttribArray') == 3
+    assert scene.buffers.stats()['buffers'] == 4
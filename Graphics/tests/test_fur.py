@@ -0,0 +1,242 @@
+import numpy as np
+import pytest
+
+from FurUtil import StrandCache, subdivide_faces, strand_count, strand_budget, golden_ratio_order
+from mesh import triangulate_faces
+from OpenGL.GL import GL_LINES
+
+
+def test_strand_cache_evicts_least_recently_used():
+    cache = StrandCache(max_bytes=300)
+    for key in 'abc':
+        cache.put(key, np.zeros(25, dtype='f'))
+
+    # reading 'a' makes 'b' the least recently used entry
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(25, dtype='f'))
+
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert cache.total_bytes == 300
+    assert (cache.hits, cache.misses) == (1, 0)
+    assert cache.get('b') is None
+    assert cache.misses == 1
+
+
+def test_strand_cache_skips_values_larger_than_the_cache():
+    cache = StrandCache(max_bytes=100)
+    cache.put('small', (np.zeros(10, dtype='f'), None))
+    cache.put('large', np.zeros(26, dtype='f'))
+    assert 'large' not in cache
+    assert cache.total_bytes == 40
+
+    # replacing an entry by a value too large drops it
+    cache.put('small', np.zeros(26, dtype='f'))
+    assert 'small' not in cache
+    assert cache.total_bytes == 0
+
+
+def test_fur_density_reuses_cached_hairs(make_fur, gl):
+    fur = make_fur(density=1)
+    first = fur.roots
+    fur.update_fur_density(1)
+    fur.update_fur_density(-1)
+
+    assert fur.roots is first
+    assert fur.cache.hits == 1
+
+
+def test_background_regeneration_follows_the_latest_density(make_fur, bunny):
+    import threading
+    fur = make_fur(density=1, background=True)
+    first_model = fur.hair_model
+
+    # the worker waits until released, so that the density keys are pressed while it is running
+    released = threading.Event()
+    generate = fur.generate_startpoints
+    submitted = []
+
+    def blocked(density):
+        submitted.append(density)
+        released.wait(10)
+        return generate(density)
+
+    fur.generate_startpoints = blocked
+    try:
+        fur.update_fur_density(1)
+        job = fur.job
+        fur.update_fur_density(1)
+        fur.update_fur_density(1)
+
+        # only the first press started a regeneration, the current model being drawn meanwhile
+        assert fur.job is job and job[0] == 2
+        fur.update()
+        assert fur.hair_model is first_model
+    finally:
+        released.set()
+
+    # the result for density 2 is superseded, a regeneration for the latest density replaces it
+    job[1].result()
+    fur.update()
+    assert fur.job is not None and fur.job[0] == 4
+    fur.job[1].result()
+    fur.update()
+
+    assert fur.job is None
+    assert submitted == [2, 4]
+    assert fur.roots.shape[0] == strand_count(bunny.vertices.shape[0], bunny.faces, 4)
+
+    # the hairs generated by the worker for density 2 were cached, so they replace the model on the main thread
+    fur.update_fur_density(-2)
+    assert fur.job is None
+    assert fur.roots.shape[0] == strand_count(bunny.vertices.shape[0], bunny.faces, 2)
+    fur.close()
+
+
+@pytest.mark.parametrize('sampling', ['subdivide', 'area', 'progressive'])
+def test_same_seed_gives_same_hairs(make_fur, sampling):
+    first = make_fur(sampling=sampling, seed=7, angle=True)
+    second = make_fur(sampling=sampling, seed=7, angle=True)
+    other = make_fur(sampling=sampling, seed=8, angle=True)
+
+    np.testing.assert_array_equal(first.hair_model.vertices, second.hair_model.vertices)
+    assert not np.array_equal(first.length_factors, other.length_factors)
+
+
+def test_fur_direction_does_not_change_with_the_number_of_hairs(make_fur):
+    fur = make_fur(sampling='progressive', angle=True)
+    direction = fur.fur_direction.copy()
+
+    # growing the pool of hairs keeps the direction shared by all hairs
+    pool = fur.roots.shape[0]
+    fur.update_fur_density(3)
+    assert fur.roots.shape[0] > pool
+    np.testing.assert_array_equal(fur.fur_direction, direction)
+
+    startpoints, endpoints = fur.hair_model.vertices.reshape(2, -1, 3)[:, :fur.roots.shape[0]]
+    np.testing.assert_allclose(np.cross(endpoints - startpoints, direction), 0, atol=1e-6)
+
+
+@pytest.mark.parametrize('instanced', [False, True])
+def test_growing_pool_only_uploads_the_new_hairs(make_fur, gl, stub_compile, instanced):
+    fur = make_fur(sampling='progressive', instanced=instanced)
+    model = fur.hair_model
+    roots = fur.roots.copy()
+    gl.reset()
+
+    fur.update_fur_density(0.25)
+
+    # the new hairs are appended to the buffers of the same model
+    assert fur.roots.shape[0] > roots.shape[0]
+    assert fur.hair_model is model
+    np.testing.assert_array_equal(fur.roots[:roots.shape[0]], roots)
+    assert gl.count('glBufferData') == gl.count('glGenBuffers') == 0
+    assert gl.count('glBufferSubData') > 0
+    np.testing.assert_array_equal(model.vertices[roots.shape[0]:fur.roots.shape[0]], fur.roots[roots.shape[0]:])
+
+    # the rows written are the ones of the new hairs only
+    pool_bytes = (fur.roots.shape[0] - roots.shape[0]) * 12
+    uploads = [call[1] for call in gl.calls if call[0] == 'glBufferSubData']
+    assert all(size <= pool_bytes for _, _, size, _ in uploads)
+    assert model.draw_count == fur.strands_drawn() * (1 if instanced else 2)
+
+
+def test_pool_growing_past_the_buffers_creates_a_new_model(make_fur, gl):
+    fur = make_fur(sampling='progressive')
+    model = fur.hair_model
+    fur.update_fur_density(2)
+
+    assert fur.hair_model is not model
+    assert fur.buffer_capacity == 2 * fur.roots.shape[0]
+    assert fur.hair_model.strand_capacity() == fur.buffer_capacity
+
+
+def grid(rows, quads):
+    '''
+    :return: vertices, normals and faces of a flat grid of quads, or of the triangles splitting them
+    '''
+    x, y = np.meshgrid(np.arange(rows + 1), np.arange(rows + 1))
+    vertices = np.stack((x.ravel(), y.ravel(), np.zeros(x.size)), axis=1).astype('f')
+    normals = np.tile(np.array([0, 0, 1], 'f'), (vertices.shape[0], 1))
+    first = (np.arange(rows)[:, np.newaxis] * (rows + 1) + np.arange(rows)).ravel()
+    faces = np.stack((first, first + 1, first + rows + 2, first + rows + 1), axis=1)
+    if not quads:
+        faces = triangulate_faces(faces)
+    return vertices, normals, faces
+
+
+@pytest.mark.parametrize('quads', [False, True])
+@pytest.mark.parametrize('density', [0, 1, 2, 3, 4])
+def test_strand_count_matches_the_subdivision(quads, density):
+    vertices, normals, faces = grid(4, quads)
+
+    roots, root_normals = subdivide_faces(vertices[faces], normals[faces], density)
+
+    assert strand_count(vertices.shape[0], faces, density) == vertices.shape[0] + roots.shape[0]
+    assert strand_budget(vertices.shape[0], faces, density) == vertices.shape[0] + roots.shape[0]
+
+
+@pytest.mark.parametrize('sampling', ['subdivide', 'area'])
+def test_fur_grows_on_the_quads_of_the_mesh(fur_scene, sampling):
+    from FurUtil import FurUtils
+    vertices, normals, faces = grid(4, True)
+
+    fur = FurUtils(np.identity(4, 'f'), fur_scene, vertices, normals, faces, 0.1, 1, False, background=False,
+                   sampling=sampling, seed=1)
+
+    assert fur.indices.shape == (16, 4)
+    assert fur.roots.shape[0] == strand_count(vertices.shape[0], faces, 1) == 41
+
+
+def test_interleaved_levels_are_spread_over_the_model():
+    vertices, normals, faces = grid(8, False)
+    plain, _ = subdivide_faces(vertices[faces], normals[faces], 2)
+    interleaved, _ = subdivide_faces(vertices[faces], normals[faces], 2, interleave=True)
+
+    # each level holds the same origins, in another order
+    levels = np.cumsum([0, faces.shape[0], 3 * faces.shape[0]])
+    for start, stop in zip(levels[:-1], levels[1:]):
+        order = golden_ratio_order(stop - start)
+        np.testing.assert_array_equal(interleaved[start:stop], plain[start:stop][order])
+
+    # the first eighth of the second level covers the whole grid, rather than its first rows
+    prefix = slice(levels[1], levels[1] + faces.shape[0] * 3 // 8)
+    assert np.ptp(interleaved[prefix, 1]) > 7
+    assert np.ptp(plain[prefix, 1]) < 2
+
+
+@pytest.mark.parametrize('base_instance', [False, True])
+def test_instanced_ranges_are_drawn_without_base_instance(make_fur, gl, stub_compile, base_instance):
+    fur = make_fur(instanced=True)
+    model = fur.hair_model
+    model.base_instance = base_instance
+    model.set_draw_ranges(np.array([0, 10]), np.array([5, 3]))
+    gl.reset()
+
+    model.draw(np.identity(4, 'f'), None)
+
+    draws = [call for call in gl.calls if call[0].startswith('glDraw')]
+    if base_instance:
+        assert draws == [('glDrawArraysInstancedBaseInstance', (GL_LINES, 0, 2, 5, 0)),
+                         ('glDrawArraysInstancedBaseInstance', (GL_LINES, 0, 2, 3, 10))]
+    else:
+        # the per hair attributes are pointed at the first hair of each range, then back at the first hair
+        assert draws == [('glDrawArraysInstanced', (GL_LINES, 0, 2, 5)),
+                         ('glDrawArraysInstanced', (GL_LINES, 0, 2, 3))]
+        offsets = [call[1][-1].value for call in gl.calls if call[0] == 'glVertexAttribPointer']
+        strides = [data.strides[0] for data in model.instance_attributes().values()]
+        assert offsets == [None] * len(strides) + [10 * stride for stride in strides] + [None] * len(strides)
+
+
+def test_culled_ranges_are_drawn_with_pointer_offsets(make_fur, gl):
+    model = make_fur().hair_model
+    model.set_draw_ranges(np.array([0, 6]), np.array([4, 2]))
+    gl.reset()
+
+    model.draw(np.identity(4, 'f'), model.scene.shaders)
+
+    # the offsets of the ranges are passed as an array of pointers, in bytes from the start of the index array
+    name, arguments = next(call for call in gl.calls if call[0] == 'glMultiDrawElements')
+    counts, offsets = arguments[1], arguments[3]
+    assert counts.dtype == np.int32 and counts.tolist() == [8, 4]
+    assert [offset or 0 for offset in offsets] == [0, 4 * 12]
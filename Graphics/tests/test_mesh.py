@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+
+import pytest
+
+from blender import parse_obj_file, parse_obj_file_parallel, load_obj_file_fast, split_on_lines
+from mesh import subdivide_mesh, triangle_areas, triangulate_polygons, weld_vertices
+
+
+def tetrahedron():
+    vertices = np.array([[1, 1, 1], [-1, -1, 1], [-1, 1, -1], [1, -1, -1]], dtype='f')
+    faces = np.array([[0, 2, 1], [0, 1, 3], [0, 3, 2], [1, 2, 3]], dtype=np.uint32)
+    normals = vertices / np.linalg.norm(vertices, axis=1, keepdims=True)
+    return vertices, faces, normals
+
+
+def test_subdivide_mesh_shares_edge_midpoints():
+    vertices, faces, normals = tetrahedron()
+
+    new_vertices, new_faces, new_normals = subdivide_mesh(vertices, faces, normals, levels=2)
+
+    # one new vertex per edge at each level: 4 + 6, then 10 + 24
+    assert new_faces.shape == (4 ** 2 * 4, 3)
+    assert new_vertices.shape == (34, 3)
+    assert new_normals.shape == (34, 3)
+    assert new_vertices.dtype == vertices.dtype and new_faces.dtype == faces.dtype
+    np.testing.assert_allclose(np.linalg.norm(new_normals, axis=1), 1, rtol=1e-6)
+
+    # the surface keeps its area, and every edge is still shared by two faces
+    np.testing.assert_allclose(triangle_areas(new_vertices[new_faces]).sum(), triangle_areas(vertices[faces]).sum(),
+                               rtol=1e-5)
+    edges = np.sort(np.stack((new_faces, np.roll(new_faces, -1, axis=1)), axis=2).reshape(-1, 2), axis=1)
+    assert np.all(np.unique(edges, axis=0, return_counts=True)[1] == 2)
+
+
+def test_subdivide_mesh_keeps_face_orientation():
+    vertices, faces, normals = tetrahedron()
+
+    new_vertices, new_faces, new_normals = subdivide_mesh(vertices, faces, normals)
+
+    corners = new_vertices[new_faces]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    assert np.all(np.sum(face_normals * corners.mean(axis=1), axis=1) > 0)
+
+
+def test_subdivide_mesh_without_levels_keeps_the_mesh():
+    vertices, faces, normals = tetrahedron()
+
+    new_vertices, new_faces, new_normals = subdivide_mesh(vertices, faces, normals, levels=0)
+
+    assert new_vertices is vertices and new_faces is faces and new_normals is normals
+
+
+# an L shaped hexagon, concave at its second corner, in the plane z = 1 and turning around +z
+L_SHAPE = np.array([[2, 1, 1], [1, 1, 1], [1, 2, 1], [0, 2, 1], [0, 0, 1], [2, 0, 1]], dtype='f')
+
+
+def test_concave_polygons_are_ear_clipped():
+    # the fan around the first corner covers the notch, the ear clipped triangles do not
+    fan = triangulate_polygons(np.arange(6), [6])
+    triangles = triangulate_polygons(np.arange(6), [6], L_SHAPE)
+
+    assert triangles.shape == (4, 3)
+    corners = L_SHAPE[triangles]
+    turns = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    assert np.all(turns[:, 2] > 0)
+    np.testing.assert_allclose(triangle_areas(corners).sum(), 3)
+    assert triangle_areas(L_SHAPE[fan]).sum() > 3
+
+
+def test_convex_polygons_keep_their_fan():
+    vertices = np.array([[0, 0, 0], [2, 0, 0], [3, 1, 0], [2, 2, 0], [0, 2, 0], [-1, 1, 0]], dtype='f')
+    indices = np.array([0, 1, 2, 0, 1, 2, 3, 4, 5])
+    sizes = [3, 6]
+
+    np.testing.assert_array_equal(triangulate_polygons(indices, sizes, vertices), triangulate_polygons(indices, sizes))
+
+
+def test_obj_files_split_concave_faces(tmp_path):
+    lines = ['v {} {} {}'.format(*vertex) for vertex in L_SHAPE] + ['f 1/1 2/2 3/3 4/4 5/5 6/6', 'f 1 2 3']
+    (tmp_path / 'shape.obj').write_text('\n'.join(lines) + '\n')
+
+    vertices, groups, library = parse_obj_file(str(tmp_path / 'shape.obj'))
+
+    faces = groups[0][1]
+    assert faces.shape == (5, 3) and faces.min() == 1
+    np.testing.assert_allclose(triangle_areas(vertices[faces[:4] - 1]).sum(), 3)
+
+
+def test_weld_merges_vertices_across_cell_boundaries():
+    # the first two vertices are close on both sides of a cell boundary, the last two in neighbouring cells but
+    # farther than the tolerance
+    vertices = np.array([[0.9999, 2, 0], [1.0001, 2, 0], [3.5, 0, 0], [4.6, 0, 0]], dtype='f') * 1e-3
+    faces = np.array([[0, 2, 3], [1, 2, 3], [0, 1, 2]])
+
+    welded, welded_faces = weld_vertices(vertices, faces, tolerance=1e-3)
+
+    # the last face becomes degenerate
+    assert welded.shape == (3, 3)
+    assert welded_faces.shape == (2, 3)
+    np.testing.assert_array_equal(welded_faces[0], welded_faces[1])
+
+
+def test_obj_files_without_material_library_are_cached(tmp_path):
+    lines = ['v 0 0 0', 'v 1 0 0', 'v 0 1 0', 'f 1 2 3']
+    file_name = str(tmp_path / 'triangle.obj')
+    (tmp_path / 'triangle.obj').write_text('\n'.join(lines) + '\n')
+
+    parsed = load_obj_file_fast(file_name)
+    cached = load_obj_file_fast(file_name)
+
+    assert [mesh.faces.shape for mesh in cached] == [mesh.faces.shape for mesh in parsed] == [(1, 3)]
+    np.testing.assert_array_equal(cached[0].vertices, parsed[0].vertices)
+
+
+def test_corrupt_mesh_cache_is_parsed_again(tmp_path, capsys):
+    lines = ['v 0 0 0', 'v 1 0 0', 'v 0 1 0', 'f 1 2 3']
+    file_name = str(tmp_path / 'triangle.obj')
+    (tmp_path / 'triangle.obj').write_text('\n'.join(lines) + '\n')
+    load_obj_file_fast(file_name)
+    cache_name = file_name + '.cache.npz'
+    with open(cache_name, 'r+b') as cachefile:
+        cachefile.truncate(os.path.getsize(cache_name) // 2)
+
+    meshes = load_obj_file_fast(file_name)
+
+    assert meshes[0].faces.shape == (1, 3)
+    assert 'could not read mesh cache' in capsys.readouterr().out
+    # the cache is written again
+    assert load_obj_file_fast(file_name)[0].faces.shape == (1, 3)
+    assert 'Loading mesh(es) from cache' in capsys.readouterr().out
+
+
+def write_multi_material_obj(file_name, groups=12, faces_per_group=5):
+    '''
+    Write an object file switching between three materials every few faces, with quads and vertices in between
+    '''
+    lines = ['mtllib materials.mtl']
+    for g in range(groups):
+        base = 4 * g
+        lines += ['v {} {} 0'.format(base + x, y) for x, y in ((0, 0), (1, 0), (1, 1), (0, 1))]
+        lines.append('usemtl material{}'.format(g % 3))
+        for f in range(faces_per_group):
+            lines.append('f {}/1 {}/2 {}/3 {}/4'.format(base + 1, base + 2, base + 3, base + 4) if f % 2 else
+                         'f {} {} {}'.format(base + 1, base + 2, base + 3))
+    with open(file_name, 'w') as objfile:
+        objfile.write('\n'.join(lines) + '\n')
+
+
+@pytest.mark.parametrize('workers', [2, 3, 4, 8])
+def test_parallel_parsing_matches_the_serial_parser(tmp_path, workers):
+    file_name = str(tmp_path / 'materials.obj')
+    write_multi_material_obj(file_name)
+
+    # the material changes fall inside the ranges, not only at their start
+    with open(file_name, 'rb') as objfile:
+        text = objfile.read()
+    ranges = split_on_lines(file_name, workers)
+    assert len(ranges) == workers
+    assert all(b'\nusemtl' in text[start:end] for start, end in ranges)
+
+    vertices, groups, library = parse_obj_file(file_name)
+    assert len(groups) == 12
+    parallel_vertices, parallel_groups, parallel_library = parse_obj_file_parallel(file_name, workers)
+
+    np.testing.assert_array_equal(parallel_vertices, vertices)
+    assert parallel_library == library == 'materials.mtl'
+    assert [material for material, faces in parallel_groups] == [material for material, faces in groups]
+    for (_, parallel_faces), (_, faces) in zip(parallel_groups, groups):
+        np.testing.assert_array_equal(parallel_faces, faces)
@@ -0,0 +1,75 @@
+import numpy as np
+
+from FurPhysics import StrandPhysics, rest_strands
+
+
+def horizontal_hairs(count=3, segments=4, length=0.1):
+    '''
+    :return: the rest shape of hairs growing along x, away from a collision centre far on the other side
+    '''
+    roots = np.zeros((count, 3), dtype='f')
+    roots[:, 2] = np.arange(count)
+    return rest_strands(roots, roots + [length, 0, 0], segments)
+
+
+def settle(physics, steps=2000, **parameters):
+    for _ in range(steps):
+        physics.step(**parameters)
+        if physics.at_rest:
+            return True
+    return False
+
+
+def test_hairs_bend_more_towards_their_tips():
+    physics = StrandPhysics(horizontal_hairs(), center=(-10, 0, 0))
+    assert settle(physics)
+
+    # the stiffness keeps the shape of each segment relative to the one before it, so the segments bend further
+    # and further down, rather than each point hanging just under its rest position
+    drops = -physics.positions[:, 0, 1]
+    assert drops[-1] > 0.3 * 0.1
+    assert np.all(np.diff(np.diff(drops)) > 0)
+    np.testing.assert_allclose(np.linalg.norm(np.diff(physics.positions[:, 0], axis=0), axis=1), 0.025, rtol=1e-4)
+
+
+def test_only_the_hairs_given_are_simulated():
+    rest = horizontal_hairs(count=6)
+    physics = StrandPhysics(rest, center=(-10, 0, 0))
+
+    physics.step(hairs=2)
+    physics.step(hairs=np.array([4]))
+
+    moved = np.any(physics.positions != rest, axis=(0, 2))
+    np.testing.assert_array_equal(moved, [True, True, False, False, True, False])
+
+
+def test_fur_stops_uploading_once_at_rest(make_fur, gl):
+    fur = make_fur(density=1, physics=True, segments=2)
+    for _ in range(2000):
+        fur.simulate()
+        if fur.physics.at_rest:
+            break
+    assert fur.physics.at_rest
+
+    gl.reset()
+    fur.simulate()
+    assert gl.count('glBufferSubData') == 0
+
+    # new rest shape, simulated again
+    fur.update_fur_length(0.05)
+    gl.reset()
+    fur.simulate()
+    assert gl.count('glBufferSubData') > 0
+
+
+def test_fur_only_simulates_the_hairs_drawn(make_fur):
+    fur = make_fur(density=1, physics=True, segments=2, sampling='progressive')
+    fur.update_fur_density(-0.5)
+    drawn = fur.strands_drawn()
+    rest = fur.physics.positions.copy()
+
+    fur.simulate()
+
+    assert drawn < fur.roots.shape[0]
+    assert np.any(fur.physics.positions[:, :drawn] != rest[:, :drawn])
+    np.testing.assert_array_equal(fur.physics.positions[:, drawn:], rest[:, drawn:])
@@ -0,0 +1,167 @@
+import types
+
+import numpy as np
+import pytest
+
+import BaseModel
+import BatchedModel
+import HairModel
+import shaders
+from camera import Camera
+from lightSource import LightSource
+from buffers import BufferManager
+from glstub import link_program
+from matutils import frustumMatrix, poseMatrix
+from mesh import Mesh
+
+
+def uploads(gl, name):
+    '''
+    :return: the values sent by the recorded calls of a glUniform function
+    '''
+    return [args[-1] for function, args in gl.calls if function == name]
+
+
+@pytest.fixture
+def scene(gl):
+    scene = types.SimpleNamespace(P=frustumMatrix(-1.0, 1.0, -1.0, 1.0, 1.5, 20), camera=Camera((800, 600)),
+                                  light=LightSource(None), mode=6, buffers=BufferManager(gl=gl))
+    scene.shaders = scene
+    return scene
+
+
+def test_fur_shader_reuses_flat_fragment_shader():
+    fur = shaders.FurShader()
+    assert fur.fragment_shader_source == shaders.FlatShader().fragment_shader_source
+    assert set(fur.uniforms) >= {'fur_length', 'fur_angle', 'fur_direction'}
+
+
+def test_instanced_hair_model_sends_fur_uniforms(gl, scene):
+    with gl.patch(BaseModel, HairModel, shaders):
+        fur = link_program(shaders.FurShader(), gl)
+        roots = np.zeros((5, 3), dtype='f')
+        model = HairModel.InstancedHairModel(scene, roots, roots, np.ones(5), 0.1, True, [0., 1., 0.], shaders=fur)
+        model.bind()
+        assert gl.count('glVertexAttribDivisor') == 3
+
+        model.draw(Mp=poseMatrix(), shaders=None)
+        assert sorted(uploads(gl, 'glUniform1f')) == [pytest.approx(0.1), 10.0]
+        assert sorted(uploads(gl, 'glUniform1i')) == [1, 6]
+        assert gl.count('glDrawArraysInstanced') == 1
+
+        # only the length is sent again when only the length changes
+        gl.reset()
+        model.set_fur(0.2, True, [0., 1., 0.])
+        model.draw(Mp=poseMatrix(), shaders=None)
+        assert uploads(gl, 'glUniform1f') == [pytest.approx(0.2)]
+        assert gl.count('glUniform1i') == 0
+        assert gl.count('glUniform3fv') == 0
+
+
+def uniform_calls(gl):
+    return sum(1 for function, args in gl.calls if function.startswith('glUniform'))
+
+
+def test_unchanged_uniforms_are_not_sent_again(gl, scene):
+    material = BaseModel.Material(Ka=[0.1, 0.1, 0.1], Kd=[0.5, 0.5, 0.5], Ks=[1., 1., 1.], Ns=10.0)
+
+    with gl.patch(shaders):
+        program = link_program(shaders.Shaders(), gl)
+        program.bind(scene.P, scene.camera.V, poseMatrix(), scene.mode, scene.light, material)
+        assert uniform_calls(gl) == len(program.uniforms)
+
+        gl.reset()
+        shaders.Uniform.calls_saved = 0
+        program.bind(scene.P, scene.camera.V, poseMatrix(), scene.mode, scene.light, material)
+        assert uniform_calls(gl) == 0
+        assert shaders.Uniform.calls_saved == len(program.uniforms)
+
+        # a translated model only changes PVM and VM, the normal matrix only depending on the rotation
+        gl.reset()
+        program.bind(scene.P, scene.camera.V, poseMatrix(position=[1, 0, 0]), scene.mode, scene.light, material)
+        assert [function for function, args in gl.calls if function.startswith('glUniform')] == [
+            'glUniformMatrix4fv', 'glUniformMatrix4fv']
+
+        # a new view also moves the light in view coordinates
+        gl.reset()
+        scene.camera.phi = 0.5
+        scene.camera.update()
+        program.bind(scene.P, scene.camera.V, poseMatrix(position=[1, 0, 0]), scene.mode, scene.light, material)
+        assert uniform_calls(gl) == 4
+
+
+def test_material_changes_send_only_the_material_uniforms(gl, scene):
+    wood = BaseModel.Material(Ka=[0.1, 0.1, 0.1], Kd=[0.5, 0.3, 0.1], Ks=[1., 1., 1.], Ns=10.0)
+    stone = BaseModel.Material(Ka=[0.1, 0.1, 0.1], Kd=[0.5, 0.5, 0.5], Ks=[1., 1., 1.], Ns=10.0)
+
+    with gl.patch(shaders):
+        program = link_program(shaders.Shaders(), gl)
+        program.bind(scene.P, scene.camera.V, poseMatrix(), scene.mode, scene.light, wood)
+
+        gl.reset()
+        program.bind_material(wood)
+        assert uniform_calls(gl) == 0
+
+        program.bind_material(stone)
+        assert [function for function, args in gl.calls] == ['glUniform3fv']
+
+
+def test_linking_again_sends_every_uniform(gl, scene):
+    material = BaseModel.Material()
+
+    with gl.patch(shaders):
+        program = link_program(shaders.Shaders(), gl)
+        program.bind(scene.P, scene.camera.V, poseMatrix(), scene.mode, scene.light, material)
+
+        link_program(program, gl)
+        gl.reset()
+        program.bind(scene.P, scene.camera.V, poseMatrix(), scene.mode, scene.light, material)
+        assert uniform_calls(gl) == len(program.uniforms)
+
+
+def triangle_meshes(materials):
+    '''
+    :return: one mesh of two triangles over 4 vertices for each material
+    '''
+    meshes = []
+    for m, material in enumerate(materials):
+        vertices = np.arange(12, dtype='f').reshape(4, 3) + 100 * m
+        faces = np.array([[0, 1, 2], [0, 2, 3]], dtype=np.uint32)
+        meshes.append(Mesh(vertices, faces, np.ones((4, 3), 'f'), material, verbose=False))
+    return meshes
+
+
+def test_meshes_sharing_a_material_are_one_index_range():
+    wood = BaseModel.Material(name='wood')
+    stone = BaseModel.Material(name='stone')
+    meshes = triangle_meshes([wood, stone, wood])
+
+    vertices, normals, indices, batches = BatchedModel.batch_meshes(meshes)
+
+    assert vertices.shape == normals.shape == (12, 3)
+    assert [(material.name, first, count) for material, first, count in batches] == [('wood', 0, 12), ('stone', 12, 6)]
+    # the faces of each mesh point at its own vertices in the merged array
+    np.testing.assert_array_equal(vertices[indices[:2]], meshes[0].vertices[meshes[0].faces])
+    np.testing.assert_array_equal(vertices[indices[2:4]], meshes[2].vertices[meshes[2].faces])
+    np.testing.assert_array_equal(vertices[indices[4:]], meshes[1].vertices[meshes[1].faces])
+
+
+def test_batched_model_draws_once_per_material(gl, scene, monkeypatch):
+    wood = BaseModel.Material(name='wood', Kd=[0.5, 0.3, 0.1])
+    stone = BaseModel.Material(name='stone', Kd=[0.5, 0.5, 0.5])
+
+    with gl.patch(BaseModel, BatchedModel, shaders):
+        program = link_program(shaders.Shaders(), gl)
+        scene.shaders = program
+        model = BatchedModel.BatchedModel(scene, triangle_meshes([wood, stone, wood, stone]))
+        model.bind()
+
+        switches = []
+        monkeypatch.setattr(program, 'bind_material', lambda material: switches.append(material.name))
+        gl.reset()
+        model.draw(Mp=poseMatrix(), shaders=program)
+
+        assert gl.count('glBindVertexArray') == 2
+        draws = [args for function, args in gl.calls if function == 'glDrawElements']
+        assert [(count, offset.value or 0) for _, count, _, offset in draws] == [(12, 0), (12, 4 * 12)]
+        assert switches == ['stone']
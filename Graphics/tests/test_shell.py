@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import ShellFur
+import shaders
+from glstub import BUNNY_POSE
+from ShellFur import ShellFurUtils, density_texture
+
+
+def test_density_texture_is_seeded():
+    np.testing.assert_array_equal(density_texture(16, seed=[1, 3]), density_texture(16, seed=[1, 3]))
+    assert not np.array_equal(density_texture(16, seed=[1, 3]), density_texture(16, seed=[2, 3]))
+
+
+def test_shell_fur_texture_repeats_match_the_strand_density(gl, fur_scene, bunny, stub_compile):
+    with gl.patch(ShellFur, shaders):
+        fur = ShellFurUtils(BUNNY_POSE, fur_scene, bunny.vertices, bunny.normals, bunny.faces, 0.1, 3, False,
+                            texture_size=32, seed=1)
+        fur.shell_model.draw(np.identity(4), None)
+    program = fur.shell_model.shaders
+
+    # the texture coordinates cover the whole texture per unit, so the cells per unit are divided by its size
+    assert program.uniforms['fur_scale'].value == pytest.approx(fur.scale() / 32)
+    assert fur.shell_model.texture.shape == (32, 32, 32)
+
+
+def test_shell_fur_is_seeded(fur_scene, bunny, gl, stub_compile):
+    with gl.patch(ShellFur, shaders):
+        furs = [ShellFurUtils(BUNNY_POSE, fur_scene, bunny.vertices, bunny.normals, bunny.faces, 0.1, 3, True,
+                              texture_size=16, seed=seed) for seed in (1, 1, 2)]
+
+    np.testing.assert_array_equal(furs[0].shell_model.texture, furs[1].shell_model.texture)
+    np.testing.assert_array_equal(furs[0].fur_direction, furs[1].fur_direction)
+    assert not np.array_equal(furs[0].shell_model.texture, furs[2].shell_model.texture)
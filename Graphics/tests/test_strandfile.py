@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pytest
+
+import strandfile
+
+
+def test_strand_file_round_trip(tmp_path):
+    file_name = str(tmp_path / 'hairs.strands')
+    arrays = {
+        'roots': np.arange(30, dtype='f').reshape(10, 3),
+        'length_factors': np.linspace(0.5, 1, 10, dtype='f'),
+        'empty': np.zeros((0, 3), dtype=np.uint32),
+    }
+    parameters = {'sampling': 'area', 'seed': 7, 'fur_density': 1.5}
+
+    strandfile.save_strands(file_name, arrays, parameters)
+    loaded, loaded_parameters = strandfile.load_strands(file_name)
+
+    assert loaded_parameters == parameters
+    assert not os.path.exists(file_name + '.tmp')
+    for name, array in arrays.items():
+        assert loaded[name].dtype == array.dtype
+        np.testing.assert_array_equal(loaded[name], array)
+
+    # the arrays are mapped from aligned offsets, and changing them does not change the file
+    header = strandfile.read_header(file_name)
+    assert all(layout['offset'] % strandfile.ALIGNMENT == 0 for layout in header['arrays'].values())
+    loaded['roots'][0] = -1
+    np.testing.assert_array_equal(strandfile.load_strands(file_name)[0]['roots'], arrays['roots'])
+
+
+# an empty file, another format, and a strand file of another version
+@pytest.mark.parametrize('content', [b'', b'NOTSTRND' + bytes(8),
+                                     strandfile.STRAND_FILE_MAGIC + np.array([2, 2], '<u4').tobytes() + b'{}'])
+def test_strand_file_rejects_other_files(tmp_path, content):
+    file_name = tmp_path / 'other.strands'
+    file_name.write_bytes(content)
+
+    with pytest.raises(ValueError):
+        strandfile.load_strands(str(file_name))
+
+
+def test_groom_is_loaded_with_the_saved_parameters(make_fur, tmp_path, capsys):
+    file_name = str(tmp_path / 'fur.strands')
+    make_fur(density=1, seed=3).save_strands(file_name)
+    capsys.readouterr()
+
+    fur = make_fur(density=2, seed=3, strands=file_name)
+
+    assert fur.loaded_strands
+    assert fur.fur_density == 1
+    assert 'fur_density 1 instead of 2' in capsys.readouterr().out
+    np.testing.assert_array_equal(fur.roots, make_fur(density=1, seed=3).roots)
+
+
+def test_random_seed_is_replaced_without_warning(make_fur, tmp_path, capsys):
+    file_name = str(tmp_path / 'fur.strands')
+    make_fur(seed=3).save_strands(file_name)
+    capsys.readouterr()
+
+    fur = make_fur(seed=None, strands=file_name)
+
+    assert fur.seed == 3
+    assert 'Warning' not in capsys.readouterr().out
+
+
+def test_truncated_groom_is_generated_again(make_fur, tmp_path, capsys):
+    file_name = str(tmp_path / 'fur.strands')
+    make_fur().save_strands(file_name)
+    with open(file_name, 'r+b') as strandfile:
+        strandfile.truncate(os.path.getsize(file_name) // 2)
+
+    fur = make_fur(strands=file_name)
+
+    assert not fur.loaded_strands
+    assert fur.roots.shape[0] > 0
+    assert 'cannot be loaded' in capsys.readouterr().out
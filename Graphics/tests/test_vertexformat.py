@@ -0,0 +1,42 @@
+import numpy as np
+
+from vertexformat import encode_normals, decode_normals, pack_vertices, unpack_vertices, constant_color, SNORM10
+
+
+def random_normals(count, seed=0):
+    normals = np.random.default_rng(seed).normal(size=(count, 3))
+    return (normals / np.linalg.norm(normals, axis=1, keepdims=True)).astype('f')
+
+
+def test_normals_round_trip_within_a_step():
+    normals = random_normals(10000)
+
+    decoded = decode_normals(encode_normals(normals))
+
+    # each component is rounded to the nearest of the 1023 steps of the signed normalized format
+    assert np.abs(decoded - normals).max() <= 0.5 / SNORM10 + 1e-6
+
+
+def test_axis_normals_round_trip_exactly():
+    normals = np.concatenate((np.identity(3, 'f'), -np.identity(3, 'f')))
+
+    np.testing.assert_array_equal(decode_normals(encode_normals(normals)), normals)
+
+
+def test_packed_vertices_keep_their_positions():
+    positions = np.random.default_rng(1).uniform(-100, 100, size=(1000, 3)).astype('f')
+    normals = random_normals(1000, seed=2)
+
+    packed = pack_vertices(positions, normals)
+    unpacked_positions, unpacked_normals = unpack_vertices(packed)
+
+    assert packed.shape == (1000, 4) and packed.dtype == np.uint32
+    np.testing.assert_array_equal(unpacked_positions, positions)
+    assert np.abs(unpacked_normals - normals).max() <= 1 / SNORM10
+
+
+def test_constant_color():
+    assert constant_color(None) is None
+    assert constant_color(np.zeros((0, 3), 'f')) is None
+    np.testing.assert_array_equal(constant_color(np.ones((5, 3), 'f')), [1, 1, 1])
+    assert constant_color(np.array([[1, 1, 1], [1, 0.5, 1]], 'f')) is None
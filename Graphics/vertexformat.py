@@ -0,0 +1,70 @@
+'''
+Compact interleaved vertex format: each vertex is stored as its float32 position followed by its normal packed in a
+single 32 bit word (GL_INT_2_10_10_10_REV, three signed normalized 10 bit components), so 16 bytes per vertex
+instead of 36 for the separate float32 position, normal and colour buffers. The shaders still receive a vec3 normal,
+OpenGL unpacking it when reading the attribute.
+'''
+import numpy as np
+
+# size in bytes of a packed vertex, and offsets of its attributes
+STRIDE = 16
+POSITION_OFFSET = 0
+NORMAL_OFFSET = 12
+
+# largest value of a signed normalized 10 bit component
+SNORM10 = 511
+
+
+def encode_normals(normals):
+    '''
+    Pack normals as GL_INT_2_10_10_10_REV words, x in the lowest bits, the 2 bit w component left to 0.
+    :param normals: (N, 3) array of normals, with components in [-1, 1]
+    :return: (N,) uint32 array
+    '''
+    components = np.round(np.clip(normals, -1.0, 1.0) * SNORM10).astype(np.int32) & 0x3FF
+    return (components[:, 0] | (components[:, 1] << 10) | (components[:, 2] << 20)).astype(np.uint32)
+
+
+def decode_normals(words):
+    '''
+    Unpack normals the way OpenGL does, to check the precision of the packed format without a GPU.
+    :param words: (N,) uint32 array of GL_INT_2_10_10_10_REV words
+    :return: (N, 3) float32 array of normals
+    '''
+    shifts = np.array([0, 10, 20], dtype=np.uint32)
+    components = ((words[:, np.newaxis] >> shifts) & 0x3FF).astype(np.int32)
+
+    # sign extension of the 10 bit components
+    components = np.where(components >= 512, components - 1024, components)
+    return np.maximum(components / SNORM10, -1.0).astype('f')
+
+
+def pack_vertices(positions, normals):
+    '''
+    Interleave the float32 positions and packed normals of the vertices.
+    :param positions: (N, 3) array of positions
+    :param normals: (N, 3) array of normals
+    :return: (N, 4) uint32 array, each row being one vertex of STRIDE bytes
+    '''
+    vertices = np.empty((positions.shape[0], 4), dtype=np.uint32)
+    vertices[:, :3] = np.ascontiguousarray(positions, dtype='f').view(np.uint32)
+    vertices[:, 3] = encode_normals(normals)
+    return vertices
+
+
+def unpack_vertices(vertices):
+    '''
+    :param vertices: (N, 4) uint32 array of packed vertices
+    :return: (N, 3) float32 arrays of positions and normals
+    '''
+    return np.ascontiguousarray(vertices[:, :3]).view('f'), decode_normals(vertices[:, 3])
+
+
+def constant_color(colors):
+    '''
+    :param colors: (N, 3) array of vertex colours, or None
+    :return: the colour shared by all vertices, or None if they differ
+    '''
+    if colors is None or colors.shape[0] == 0 or not np.all(colors == colors[0]):
+        return None
+    return colors[0]